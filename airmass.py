@@ -2,17 +2,32 @@ from astroplan import Observer
 from astroplan import FixedTarget
 import astropy
 import astropy.units as u
-import matplotlib.pyplot as plt
+from matplotlib.artist import setp
 import numpy as np
 import matplotlib.dates as mdates
 
 import dino_tools as tools
 
 def plot(observer, times, targets, do_moon=True, do_moon_labels=True,
-                 path="./report_plots"):
+                 path="./report_plots", moon=None, altaz=None):
+    """
+    Plot the altitude and airmass of the targets over the night.
+
+    moon can be a moon grid from dino_tools.moon_grid computed over
+    times['plot_window'] for the same targets. If it is None it is computed
+    here. The moon curve and the moon separation labels are both looked up in
+    this grid.
+
+    altaz can be the altitude and azimuth grids from dino_tools.altaz_grid
+    over times['plot_window'] for the same targets, e.g. from a night plan.
+    If it is None they are computed here.
+
+    If path is None nothing is written, and the image is returned as an
+    io.BytesIO instead of the figure.
+    """
     # do airmass plot
-    fig, ax = plt.subplots(1, 1)
-    fig.set_size_inches(10, 5)
+    fig = tools.new_figure(figsize=(10, 5))
+    ax = fig.add_subplot()
     #ax2.set_aspect('equal', adjustable='box')
     
     if type(targets) != list:
@@ -24,7 +39,7 @@ def plot(observer, times, targets, do_moon=True, do_moon_labels=True,
     #ax.set_xlim([xlo.plot_date, xhi.plot_date])
     #date_formatter = dates.DateFormatter('%d %H:%M')
     #ax.xaxis.set_major_formatter(date_formatter)
-    plt.setp(ax.get_xticklabels(), rotation=20, ha='right')
+    setp(ax.get_xticklabels(), rotation=20, ha='right')
     
     # vertical lines for times
     #ax.axvline(times['obs_window'][0].to_datetime())
@@ -48,13 +63,11 @@ def plot(observer, times, targets, do_moon=True, do_moon_labels=True,
                linestyle='-', alpha=0.8,
                color="xkcd:grey")
     
+    if (do_moon or do_moon_labels) and moon is None:
+        moon = tools.moon_grid(observer, target_list, times['plot_window'])
+
     if do_moon:
-        alt = []
-        for time in times['plot_window']:
-            moon = FixedTarget(name="Moon",
-                               coord=astropy.coordinates.get_moon(time))
-            alt.append(observer.altaz(time, moon).alt)
-        moon_alts = astropy.coordinates.Latitude(alt, unit=u.deg)
+        moon_alts = astropy.coordinates.Latitude(moon['alt'], unit=u.deg)
         mm_alts = np.ma.array(moon_alts, mask=moon_alts < 0)
         ax.plot(times['plot_window'].to_datetime(), mm_alts, label='Moon',
                 marker=None, linestyle="--", color="xkcd:black", linewidth=2,
@@ -63,7 +76,9 @@ def plot(observer, times, targets, do_moon=True, do_moon_labels=True,
     for i in range(0, len(target_list)):
         target = target_list[i]['target']
         color = target_list[i]['color']
-        if target_list[i]['type'] != "fixed":
+        if altaz is not None:
+            altitude = astropy.coordinates.Latitude(altaz[0][i], unit=u.deg)
+        elif target_list[i]['type'] != "fixed":
             #continue
             alt = []
             for time in times['plot_window']:
@@ -86,15 +101,15 @@ def plot(observer, times, targets, do_moon=True, do_moon_labels=True,
         if do_moon_labels:
             this_window = times['plot_window'][5:-6]
             these_alts  = masked_altitude[5:-6]
-            n_times = len(this_window)
-            for j in range(0, n_times, n_times//13):
+            these_seps = moon['sep'][i][5:-6]
+            # evenly spaced in time, also when the samples are not
+            label_jds = np.linspace(this_window[0].jd, this_window[-1].jd,
+                                    15)
+            label_indices = np.unique(np.searchsorted(this_window.jd,
+                                                      label_jds))
+            for j in label_indices:
                 time = this_window[j]
-                c1 = target.coord
-                c2 = astropy.coordinates.get_moon(time)
-
-                # important! separation gives the angle in the frame of the
-                # first SkyCoord object, which must be the moon here
-                d = c2.separation(c1)
+                d = astropy.coordinates.Angle(these_seps[j], unit=u.deg)
                 
                 if type(these_alts[j]) == astropy.coordinates.angles.Latitude:
                     this_y = these_alts[j].value
@@ -139,6 +154,7 @@ def plot(observer, times, targets, do_moon=True, do_moon_labels=True,
     ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.15), fancybox=True,
               ncol=3, framealpha=0, fontsize=12)
     
-    plt.savefig('{0}/airmass.jpg'.format(path), bbox_inches='tight')
-    plt.close()
+    image = tools.save_figure(fig, path, "airmass.jpg", bbox_inches='tight')
+    if path is None:
+        return image
     return fig
\ No newline at end of file
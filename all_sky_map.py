@@ -7,23 +7,297 @@ from astropy.coordinates import AltAz
 from astropy.coordinates import solar_system_ephemeris
 from astropy.coordinates import get_body
 
+import io
+import os
+import json
+import hashlib
+import warnings
+
 import pandas as pd
 from seaborn import desaturate
 import numpy as np
+from PIL import Image
 
 import matplotlib
 matplotlib.use('agg') 
-import matplotlib.pyplot as plt
 import matplotlib.image as mpl_image
 from matplotlib.offsetbox import (OffsetImage, AnnotationBbox)
 from matplotlib.artist import Artist
 from matplotlib.patches import Rectangle
+from matplotlib.collections import LineCollection
 from matplotlib import dates
+from matplotlib.colors import to_rgba_array
 import matplotlib.dates as mdates
 from matplotlib.ticker import FormatStrFormatter
 from astroplan import FixedTarget
 
 import dino_tools as tools
+import catalogs
+import sky_cultures
+
+const_color = '#ff2620'
+zodiac_color = '#fcb322'
+nonzodiac_color = '#77a9da'
+other_color = '#979330'
+
+def _draw_static_layers(ax, do_stars=True, do_asterisms=True,
+                        do_constellations=False, sky_culture="rey",
+                        mag_limit=8.5, star_marker="o", epoch=None,
+                        lod_mag=8.5, lod_bins=1200):
+    """
+    Draws the parts of the map that are the same every night: the
+    constellation boundaries, the asterisms and the stars, moved to epoch if
+    it is given (see catalogs.load_index). Stars fainter than lod_mag are
+    drawn as a raster, see _draw_star_raster.
+    """
+    if do_constellations:
+        constellations = pd.read_csv('./data/processed/constellations.csv')
+        for index, row in constellations.iterrows():
+            ras = [float(x)*360/24 for x in 
+                   row['ra'].replace('[', '').replace(']', '').split(',')]
+            decs = [float(x) for x in
+                    row['dec'].replace('[', '').replace(']', '').split(',')]
+            ax.plot(ras, decs, transform=ccrs.Geodetic(), lw=0.5, alpha=0.7,
+                    color=const_color)
+        
+    if do_asterisms:
+        try:
+            segments = catalogs.load_asterism_segments(sky_culture)
+        except ValueError:
+            warnings.warn("Sky culture {0} is unrecognized in this version. "
+                          "Defaulting to the H.A. Rey "
+                          "asterisms".format(sky_culture))
+            segments = catalogs.load_asterism_segments("rey")
+        lines = np.stack([np.stack([segments['ra1'], segments['dec1']], -1),
+                          np.stack([segments['ra2'], segments['dec2']], -1)],
+                         axis=1)
+        for zodiac, color in [(False, nonzodiac_color), (True, zodiac_color)]:
+            ax.add_collection(LineCollection(
+                lines[segments['zodiac'] == zodiac], colors=color,
+                linewidths=0.75, transform=ccrs.Geodetic()))
+
+    if do_stars:
+        stars = catalogs.load_index("stars", epoch=epoch)['data']
+        stars = stars[(stars['color'] != '#000000') &
+                      (stars['mag'] < mag_limit)]
+        if lod_mag is not None:
+            _draw_star_raster(ax, stars[stars['mag'] >= lod_mag],
+                              lod_mag=lod_mag, lod_bins=lod_bins)
+            stars = stars[stars['mag'] < lod_mag]
+        # the colors only take a few values, so they are desaturated once each
+        colors = stars['color'].astype("category")
+        palette = to_rgba_array([desaturate(c, 0.75)
+                                 for c in colors.cat.categories])
+        rgba = palette[colors.cat.codes.to_numpy()]
+        mag = stars['mag'].to_numpy(dtype=float)
+        rgba[:, 3] = np.minimum(1, 0.6 - np.arctan((mag - 4)/5)/np.pi)
+        ax.scatter(stars['ra']*360/24, stars['dec'], transform=ccrs.Geodetic(),
+                   s=35*np.exp(-(1.44 + mag)/4), color=rgba, lw=0,
+                   edgecolor='none', marker=star_marker)
+
+def _draw_star_raster(ax, stars, lod_mag=8.5, lod_bins=1200):
+    """
+    Draws faint stars as one image instead of one marker each. Their fluxes,
+    and their colors weighted by flux, are summed into a lod_bins by
+    lod_bins/2 grid in the coordinates of the map projection, so the cost
+    hardly depends on how many stars there are. A bin holding one star of
+    magnitude lod_mag is about as opaque as that star's marker would be, and
+    dense regions like the Milky Way saturate smoothly.
+    """
+    if len(stars) == 0:
+        return None
+    projection = ax.projection
+    points = projection.transform_points(
+        ccrs.Geodetic(), stars['ra'].to_numpy(dtype=float)*360/24,
+        stars['dec'].to_numpy(dtype=float))
+    flux = 10**(-0.4*(stars['mag'].to_numpy(dtype=float) - lod_mag))
+
+    colors = stars['color'].astype("category")
+    palette = to_rgba_array([desaturate(c, 0.75)
+                             for c in colors.cat.categories])[:, :3]
+    rgb = palette[colors.cat.codes.to_numpy()]
+
+    extent = list(projection.x_limits) + list(projection.y_limits)
+    bins = [int(lod_bins), int(lod_bins)//2]
+    ranges = [extent[:2], extent[2:]]
+    density = np.histogram2d(points[:, 0], points[:, 1], bins=bins,
+                             range=ranges, weights=flux)[0]
+    image = np.zeros(density.shape + (4,))
+    for k in range(0, 3):
+        image[..., k] = np.histogram2d(points[:, 0], points[:, 1],
+                                       bins=bins, range=ranges,
+                                       weights=flux*rgb[:, k])[0]
+    filled = density > 0
+    image[filled, :3] /= density[filled, np.newaxis]
+    image[..., 3] = 1 - np.exp(-0.5*density)
+    # histogram2d puts x along the first axis, imshow wants rows of y, and
+    # bytes are much faster to resample than floats
+    image = np.round(255*np.transpose(image, (1, 0, 2))).astype(np.uint8)
+    return ax.imshow(image, origin='lower',
+                     extent=extent, transform=projection,
+                     interpolation='nearest', zorder=0.5)
+
+def _draw_gridlines(ax, do_xticks=False, do_yticks=True):
+    """
+    Draws the RA and DEC gridlines and their labels.
+    """
+    draw_labels=[]
+    if do_xticks:
+        draw_labels += ["x"]
+        gl = ax.gridlines(draw_labels=draw_labels, alpha=0.4,
+                  xlocs=range(-180, 180, 15), x_inline=True,
+                  ylocs=range(-90, 90, 15))
+        gl.xlabel_style = {'size':15}
+    if do_yticks:
+        draw_labels += ["y",  "left", "right","geo"]
+        gl = ax.gridlines(draw_labels=draw_labels, alpha=0.4,
+                          xlocs=range(-180, 180, 15), x_inline=False,
+                          ylocs=range(-90, 90, 15))
+        gl.ylabel_style = {'size': 15}
+
+def _plot_fixed_target(ax, target, color, target_marker="*"):
+    """
+    Marks a fixed target on the map and writes its name next to it.
+    """
+    ax.plot(target.coord.ra, target.coord.dec,
+            transform=ccrs.Geodetic(),
+            marker=target_marker, markersize=12, linestyle='none',
+            color=color, label=target.name)
+    ax.text(x=(target.coord.ra-3*u.deg).value,
+            y=(target.coord.dec).value,
+            s=target.name, transform=ccrs.Geodetic(),
+            color=color, size=20)
+
+def _background_sources(do_asterisms=True, do_constellations=False,
+                        sky_culture="rey"):
+    """
+    Returns the files the sky background is drawn from, with their
+    modification times, so a cached background is rendered again when the
+    star catalog or a sky culture changes.
+    """
+    paths = [catalogs.catalog_path("stars")]
+    if do_asterisms:
+        if sky_culture not in sky_cultures.SKY_CULTURES:
+            sky_culture = "rey"
+        paths += sky_cultures.sources(sky_culture)
+    if do_constellations:
+        paths.append('./data/processed/constellations.csv')
+    return {path:os.path.getmtime(path) if os.path.exists(path) else None
+            for path in paths}
+
+def render_background(projection=ccrs.Mollweide(), do_stars=True,
+                      do_asterisms=True, do_constellations=False,
+                      sky_culture="rey", mag_limit=8.5, star_marker="o",
+                      ax_color="xkcd:black", fig_color="xkcd:white",
+                      do_xticks=False, do_yticks=True, epoch=None,
+                      lod_mag=8.5, lod_bins=1200, cache_dir="./data/cache"):
+    """
+    Renders the static sky background of the all-sky map once and caches it.
+
+    The stars, asterisms, constellations and gridlines only depend on the
+    projection, the sky culture, mag_limit, the styling and the year of epoch
+    the stars are moved to (see catalogs.load_index), so the whole canvas is
+    rendered once and saved in cache_dir, together with the extent of the map
+    in projection coordinates and the tight bounding box of the background in
+    inches. Later calls with the same settings just read the
+    cached raster. The star catalog and the sky culture files, with their
+    modification times, are part of the settings, so changing them renders
+    the background again.
+
+    Returns a dict with the 'image' as an RGBA array of the full canvas, the
+    'extent' as [x0, x1, y0, y1] in projection coordinates, the
+    'bbox_inches' as [x0, y0, x1, y1], and the 'settings'.
+    """
+    settings = {"projection":type(projection).__name__ + " " +
+                             projection.proj4_init,
+                "do_stars":do_stars, "do_asterisms":do_asterisms,
+                "do_constellations":do_constellations,
+                "sky_culture":sky_culture, "mag_limit":float(mag_limit),
+                "star_marker":star_marker, "ax_color":ax_color,
+                "fig_color":fig_color, "do_xticks":do_xticks,
+                "do_yticks":do_yticks, "epoch":catalogs.epoch_year(epoch),
+                "lod_mag":None if lod_mag is None else float(lod_mag),
+                "lod_bins":int(lod_bins),
+                "figsize":[30, 15], "dpi":250,
+                "sources":_background_sources(
+                    do_asterisms=do_asterisms,
+                    do_constellations=do_constellations,
+                    sky_culture=sky_culture)}
+    key = hashlib.sha1(json.dumps(settings,
+                                  sort_keys=True).encode()).hexdigest()[:16]
+    image_path = "{0}/sky_background_{1}.png".format(cache_dir, key)
+    meta_path = "{0}/sky_background_{1}.json".format(cache_dir, key)
+
+    if os.path.exists(image_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta['image'] = np.asarray(Image.open(image_path))
+        return meta
+
+    fig = tools.new_figure(figsize=(30, 15), dpi=250, facecolor=fig_color)
+    ax = fig.add_subplot(projection=projection)
+    ax.set_facecolor(ax_color)
+    _draw_gridlines(ax, do_xticks=do_xticks, do_yticks=do_yticks)
+    _draw_static_layers(ax, do_stars=do_stars, do_asterisms=do_asterisms,
+                        do_constellations=do_constellations,
+                        sky_culture=sky_culture, mag_limit=mag_limit,
+                        star_marker=star_marker, epoch=epoch,
+                        lod_mag=lod_mag, lod_bins=lod_bins)
+    ax.set_global()
+    extent = list(ax.get_xlim()) + list(ax.get_ylim())
+    ax.set_xlim(ax.get_xlim()[::-1])
+
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba()).copy()
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer())
+    meta = {"extent":extent,
+            "bbox_inches":[bbox.x0, bbox.y0, bbox.x1, bbox.y1],
+            "settings":settings}
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    Image.fromarray(image).save(image_path)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+    meta['image'] = image
+    return meta
+
+def _save_over_background(fig, background, path, filename, pad_inches=0.1):
+    """
+    Draws a transparent overlay figure, composites it over a cached
+    background from render_background, crops it to the tight bounding box of
+    both, and saves it as path/filename, or into an io.BytesIO if path is
+    None, like dino_tools.save_figure.
+
+    Returns the path of the file or the buffer.
+    """
+    fig.canvas.draw()
+    overlay = Image.fromarray(np.asarray(fig.canvas.buffer_rgba()))
+    image = Image.alpha_composite(Image.fromarray(background['image']),
+                                  overlay)
+
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer())
+    x0 = min(bbox.x0, background['bbox_inches'][0]) - pad_inches
+    y0 = min(bbox.y0, background['bbox_inches'][1]) - pad_inches
+    x1 = max(bbox.x1, background['bbox_inches'][2]) + pad_inches
+    y1 = max(bbox.y1, background['bbox_inches'][3]) + pad_inches
+    dpi = fig.dpi
+    height = image.size[1]
+    crop = (max(int(np.floor(x0*dpi)), 0),
+            max(int(np.floor(height - y1*dpi)), 0),
+            min(int(np.ceil(x1*dpi)), image.size[0]),
+            min(int(np.ceil(height - y0*dpi)), height))
+    image = image.crop(crop).convert("RGB")
+    if path is None:
+        buffer = io.BytesIO()
+        image.save(buffer, dpi=(dpi, dpi), format=Image.registered_extensions()[
+            os.path.splitext(filename)[1]])
+        buffer.seek(0)
+        return buffer
+    this_path = "{0}/{1}".format(path, filename)
+    image.save(this_path, dpi=(dpi, dpi))
+    return this_path
 
 def plot(targets=None, do_stars=True, do_asterisms=True,
          do_constellations=False, do_moon=True, do_time_text=False,
@@ -32,7 +306,8 @@ def plot(targets=None, do_stars=True, do_asterisms=True,
          path="./report_plots", star_marker="o", ax_color="xkcd:black", 
          fig_color="xkcd:white", do_title=True, do_legend=True,
          target_marker="*", do_target_colors=True, move_moon=False,
-         do_obs_lines=False):
+         do_obs_lines=False, cache_background=True, lod_mag=8.5,
+         lod_bins=1200, cache_dir="./data/cache"):
     """
     Create a plot of the celestial sphere, with the targets of interest
     
@@ -48,11 +323,22 @@ def plot(targets=None, do_stars=True, do_asterisms=True,
         Defaults to True.
         
     mag_limit : float
-        The dimmest magnitude that will be plotted if do_stars is True. High
-        values may cause significant run times. Going past 10 gets into some
-        serious diminishing returns, but you can go up to 21 with these data if 
-        you really want. Lowest magnitude in the data is -1.44 FYI.
+        The dimmest magnitude that will be plotted if do_stars is True. Stars
+        fainter than lod_mag are drawn as a raster, so high values cost
+        little. You can go up to 21 with these data if you really want.
+        Lowest magnitude in the data is -1.44 FYI.
         Defaults to 8.5.
+
+    lod_mag : float or None
+        Stars fainter than this are summed into a raster of lod_bins by
+        lod_bins/2 pixels instead of being drawn one marker each, which
+        shows them as a glow like the Milky Way. If None, every star is a
+        marker, which gets slow past magnitude 9 or so.
+        Defaults to 8.5.
+
+    lod_bins : int
+        The width of the faint-star raster in pixels.
+        Defaults to 1200.
         
     star_marker : str
         The marker for the background stars. Follows the same list as plt
@@ -99,14 +385,28 @@ def plot(targets=None, do_stars=True, do_asterisms=True,
     
     do_legend : 
     
-    path : 
-    
+    path : str or None
+        The directory all_sky_map.jpg is saved in. If None nothing is
+        written, and the image is returned as an io.BytesIO instead of the
+        figure.
+        Defaults to "./report_plots".
+
     ax_color : 
     
     fig_color : 
     
     do_target_colors : 
 
+    cache_background : bool
+        Reuse a cached raster of the stars, asterisms, constellations and
+        gridlines instead of drawing them again, see render_background. The
+        targets, moon and observation lines are always drawn on top.
+        Defaults to True.
+
+    cache_dir : str
+        Where the cached backgrounds are kept.
+        Defaults to "./data/cache".
+
     """
 
     # check if we use one time or several
@@ -127,76 +427,37 @@ def plot(targets=None, do_stars=True, do_asterisms=True,
             times = Time.now()
         time_list = [times]"""
     
-    const_color = '#ff2620'
-    zodiac_color = '#fcb322'
-    nonzodiac_color = '#77a9da'
-    other_color = '#979330'
-    
-    thing = plt.rc('figure', dpi=250)
-    fig = plt.figure(figsize=(30, 15), facecolor=fig_color)
-    ax = plt.axes(projection=ccrs.Mollweide())
-    ax.set_facecolor(ax_color)
-    draw_labels=[]
-    if do_xticks:
-        draw_labels += ["x"]
-        gl = ax.gridlines(draw_labels=draw_labels, alpha=0.4,
-                  xlocs=range(-180, 180, 15), x_inline=True,
-                  ylocs=range(-90, 90, 15))
-        gl.xlabel_style = {'size':15}
-    if do_yticks:
-        draw_labels += ["y",  "left", "right","geo"]
-        gl = ax.gridlines(draw_labels=draw_labels, alpha=0.4,
-                          xlocs=range(-180, 180, 15), x_inline=False,
-                          ylocs=range(-90, 90, 15))
-        gl.ylabel_style = {'size': 15}
-    
-    if do_constellations:
-        constellations = pd.read_csv('./data/processed/constellations.csv')
-        for index, row in constellations.iterrows():
-            ras = [float(x)*360/24 for x in 
-                   row['ra'].replace('[', '').replace(']', '').split(',')]
-            decs = [float(x) for x in
-                    row['dec'].replace('[', '').replace(']', '').split(',')]
-            ax.plot(ras, decs, transform=ccrs.Geodetic(), lw=0.5, alpha=0.7,
-                    color=const_color)
-        
-    if do_asterisms:
-        if sky_culture == "rey":
-            asterisms = pd.read_csv('./data/processed/asterisms_rey.csv')
-        elif sky_culture == "IAU":
-            asterisms = pd.read_csv('./data/processed/asterisms_rey.csv')
-        else:
-            warnings.warn("Sky culture {0} is unrecognized in this version. " + 
-                          "Defaulting to the H.A. Rey " +
-                          "asterisms".format(sky_culture))
-            asterisms = pd.read_csv('./data/processed/asterisms_rey.csv')
-            
-        for index, row in asterisms.iterrows():
-            ras = [float(x)*360/24 for x in
-                   row['ra'].replace('[', '').replace(']', '').split(',')]
-            decs = [float(x) for x in
-                    row['dec'].replace('[', '').replace(']', '').split(',')]
-            color = nonzodiac_color
-            if row['zodiac'] == True: 
-                color = zodiac_color
-            assert len(asterisms)%2 == 0
-            for n in range(int(len(asterisms)/2)):
-                ax.plot(ras[n*2:(n+1)*2], decs[n*2:(n+1)*2],
-                        transform=ccrs.Geodetic(), color=color, lw=0.75)
-        
-    if do_stars:
-        stars = pd.read_csv('./data/processed/hygdata_processed.csv')
-        stars_plot = stars[(stars['color'] != '#000000') & 
-                           (stars['mag'] < mag_limit)].copy()
-        
-        stars_plot['c'] = [desaturate(c, 0.75) for c in stars_plot['color']]
-        stars_plot['s'] = [35*np.exp(-(1.44 + m)/(4)) for m in stars_plot['mag']]
-        stars_plot['alpha'] = [min(1, 0.6-np.arctan((m-4)/5)/(np.pi)) for m in stars_plot['mag']]
-        #stars_plot['alpha'] = [min(1, np.exp(-(1.44 + m)/(8))) for m in stars_plot['mag']]
-        #print(stars_plot['alpha'])
-        ax.scatter(stars_plot['ra']*360/24, stars_plot['dec'], transform=ccrs.Geodetic(),
-                   s=stars_plot['s'], color=stars_plot['c'], lw=0, edgecolor='none', 
-                   alpha=stars_plot['alpha'], marker=star_marker)
+    if cache_background:
+        background = render_background(projection=projection,
+                                       do_stars=do_stars,
+                                       do_asterisms=do_asterisms,
+                                       do_constellations=do_constellations,
+                                       sky_culture=sky_culture,
+                                       mag_limit=mag_limit,
+                                       star_marker=star_marker,
+                                       ax_color=ax_color,
+                                       fig_color=fig_color,
+                                       do_xticks=do_xticks,
+                                       do_yticks=do_yticks,
+                                       epoch=time_list[0],
+                                       lod_mag=lod_mag, lod_bins=lod_bins,
+                                       cache_dir=cache_dir)
+        # only the nightly overlay is drawn, on a transparent canvas
+        fig = tools.new_figure(figsize=(30, 15), dpi=250,
+                               facecolor=(0, 0, 0, 0))
+        ax = fig.add_subplot(projection=projection)
+        ax.set_facecolor((0, 0, 0, 0))
+        ax.set_global()
+    else:
+        fig = tools.new_figure(figsize=(30, 15), dpi=250, facecolor=fig_color)
+        ax = fig.add_subplot(projection=projection)
+        ax.set_facecolor(ax_color)
+        _draw_gridlines(ax, do_xticks=do_xticks, do_yticks=do_yticks)
+        _draw_static_layers(ax, do_stars=do_stars, do_asterisms=do_asterisms,
+                            do_constellations=do_constellations,
+                            sky_culture=sky_culture, mag_limit=mag_limit,
+                            star_marker=star_marker, epoch=time_list[0],
+                            lod_mag=lod_mag, lod_bins=lod_bins)
 
     if targets is not None:
         if type(targets) != list:
@@ -211,14 +472,7 @@ def plot(targets=None, do_stars=True, do_asterisms=True,
                 color = "xkcd:white"
                 
             if target_list[i]['type'] == "fixed":
-                ax.plot(target.coord.ra, target.coord.dec,
-                        transform=ccrs.Geodetic(),
-                        marker=target_marker, markersize=12, linestyle='none',
-                        color=color, label=target.name)
-                ax.text(x=(target.coord.ra-3*u.deg).value,
-                        y=(target.coord.dec).value,
-                        s=target.name, transform=ccrs.Geodetic(),
-                        color=color, size=20)
+                _plot_fixed_target(ax, target, color, target_marker)
             else:
                 for time in time_list:
                     if observer is None:
@@ -248,7 +502,7 @@ def plot(targets=None, do_stars=True, do_asterisms=True,
             for time in time_list:
                 # get the moon's location
                 moon = FixedTarget(name="Moon",
-                                   coord=astropy.coordinates.get_moon(time))
+                                   coord=tools.body_position("moon", time))
 
                 # place the moon image
                 transform = ccrs.Geodetic()._as_mpl_transform(ax)
@@ -265,8 +519,7 @@ def plot(targets=None, do_stars=True, do_asterisms=True,
         else:
             time = time_list[0]
             # get the moon's location
-            moon = FixedTarget(name="Moon",
-                               coord=astropy.coordinates.get_moon(time))
+            moon = FixedTarget(name="Moon", coord=tools.body_position("moon", time))
 
             # place the moon image
             transform = ccrs.Geodetic()._as_mpl_transform(ax)
@@ -308,7 +561,7 @@ def plot(targets=None, do_stars=True, do_asterisms=True,
                     label="Observation End")
             
     if do_legend:
-        handles, labels = plt.gca().get_legend_handles_labels()
+        handles, labels = ax.get_legend_handles_labels()
         by_label = dict(zip(labels, handles))
         ax.legend(by_label.values(), by_label.keys(), loc='upper center',
                   bbox_to_anchor=(0.5, -0.005), fancybox=True, ncol=5,
@@ -327,7 +580,15 @@ def plot(targets=None, do_stars=True, do_asterisms=True,
                      fontsize=32, pad=20)
         if fig_color == "xkcd:black":
             ax.title.set_color("xkcd:white")
-    plt.savefig('{0}/all_sky_map.jpg'.format(path), facecolor=fig.get_facecolor(),
-                edgecolor='none', bbox_inches='tight')
-    plt.close()
+    if cache_background:
+        ax.set_xlim(background['extent'][1], background['extent'][0])
+        ax.set_ylim(background['extent'][2:])
+        image = _save_over_background(fig, background, path,
+                                      "all_sky_map.jpg")
+    else:
+        image = tools.save_figure(fig, path, "all_sky_map.jpg",
+                                  facecolor=fig.get_facecolor(),
+                                  edgecolor='none', bbox_inches='tight')
+    if path is None:
+        return image
     return fig
\ No newline at end of file
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+from astropy.time import Time
+from astropy.coordinates import AltAz
+from astropy.coordinates import TETE
+from astropy.coordinates import get_body
+
+import multisite
+import observability
+
+def _time_strings(jd):
+    """
+    Formats an array of Julian dates as UTC "YYYY-MM-DD HH:MM:SS", with "NA"
+    for NaN.
+    """
+    jd = np.asarray(jd)
+    strings = np.full(jd.shape, "NA", dtype=object)
+    ok = np.isfinite(jd)
+    if ok.any():
+        strings[ok] = [t[:19] for t in
+                       Time(jd[ok], format='jd', scale='utc').iso]
+    return strings
+
+def compute(observer, start, end, time_step=5.0):
+    """
+    Computes an almanac for every night from the evening of start to the
+    evening of end: sunset and sunrise, the civil, nautical and astronomical
+    twilights, moonrise and moonset, the moon illumination and the length of
+    the dark time.
+
+    The sun comes from the same grids as observability.compute. The moon is
+    computed once an hour over the whole range and interpolated. All events
+    are found from sign changes on these grids, so no per-night root finding
+    is needed.
+
+    Parameters
+    -----------
+
+    observer : astroplan.Observer
+        The observer, from dino_tools.setup_location.
+
+    start, end : str
+        The dates of the evenings of the first and last night, e.g.
+        "2024-01-01".
+
+    time_step : float
+        The spacing of the samples within each night in minutes.
+        Defaults to 5.0.
+
+    Returns a DataFrame with one row per night, times in UTC.
+    """
+    dates, jd = observability.night_grid(start, end, observer,
+                                         time_step=time_step)
+    lon = observer.location.lon.deg
+    lat = observer.location.lat.deg
+    window = np.ones(jd.shape, dtype=bool)
+
+    # the sun, once a day
+    noons = Time(np.append(jd[:, 0], jd[-1, 0] + 1), format='jd', scale='utc')
+    sun = get_body("sun", noons).transform_to(TETE(obstime=noons))
+    sun_ra = np.interp(jd, noons.jd,
+                       np.degrees(np.unwrap(np.radians(sun.ra.deg))))
+    sun_dec = np.interp(jd, noons.jd, sun.dec.deg)
+    gast = noons[:-1].sidereal_time('apparent', 'greenwich').deg
+    lst = (gast[:, np.newaxis] + lon
+           + observability.SIDEREAL_RATE*(jd - jd[:, :1]))
+    sun_alt = multisite._altitude(lat, lst - sun_ra, sun_dec)
+
+    # the moon, once an hour, seen from the observer
+    hours = Time(np.arange(jd[0, 0], jd[-1, -1] + 1/24, 1/24), format='jd',
+                 scale='utc')
+    moon_alt = get_body("moon", hours, observer.location).transform_to(
+        AltAz(obstime=hours, location=observer.location)).alt.deg
+    moon_alt = np.interp(jd, hours.jd, moon_alt)
+
+    events = {}
+    for event, level in multisite.SUN_EVENTS.items():
+        events[event] = (multisite._crossing(sun_alt, jd, level, window,
+                                             rising=False),
+                         multisite._crossing(sun_alt, jd, level, window,
+                                             rising=True))
+    columns = {"night":dates,
+               "sunset":_time_strings(events['sunset'][0]),
+               "sunrise":_time_strings(events['sunset'][1])}
+    for event in ["civ_twl", "nau_twl", "ast_twl"]:
+        columns[event + "_evening"] = _time_strings(events[event][0])
+        columns[event + "_morning"] = _time_strings(events[event][1])
+    columns['moonrise'] = _time_strings(multisite._crossing(
+        moon_alt, jd, 0.0, window, rising=True))
+    columns['moonset'] = _time_strings(multisite._crossing(
+        moon_alt, jd, 0.0, window, rising=False))
+    midnight = Time(jd[:, jd.shape[1]//2], format='jd', scale='utc')
+    columns['moon_illumination'] = np.round(np.atleast_1d(
+        observer.moon_illumination(midnight)), 3)
+    dark = sun_alt < multisite.SUN_EVENTS['ast_twl']
+    columns['dark_hours'] = np.round(dark.sum(axis=1)*time_step/60, 2)
+    columns['moonless_dark_hours'] = np.round(
+        (dark & (moon_alt < 0)).sum(axis=1)*time_step/60, 2)
+    return pd.DataFrame(columns)
+
+def report_table(almanac):
+    """
+    Returns a short version of an almanac for the report, with the sun, the
+    astronomical twilights and the moon as HH:MM.
+    """
+    table = almanac[["night", "sunset", "sunrise", "ast_twl_evening",
+                     "ast_twl_morning", "moonrise", "moonset",
+                     "moon_illumination", "dark_hours",
+                     "moonless_dark_hours"]].copy()
+    for column in ["sunset", "sunrise", "ast_twl_evening", "ast_twl_morning",
+                   "moonrise", "moonset"]:
+        table[column] = [value[11:16] if value != "NA" else value
+                         for value in table[column]]
+    return table
+
+def write_reports(observer, start, end, parquet=True, path="./report_plots",
+                  **compute_kwargs):
+    """
+    Computes the almanac for a date range and writes it to almanac.csv, and
+    to almanac.parquet if parquet is True and pandas can write Parquet
+    files, which needs the pyarrow or fastparquet package. The short version
+    for the report, see report_table, goes to almanac_report.csv.
+
+    Returns the almanac DataFrame.
+    """
+    almanac = compute(observer, start, end, **compute_kwargs)
+    almanac.to_csv("{0}/almanac.csv".format(path), index=False)
+    if parquet:
+        try:
+            almanac.to_parquet("{0}/almanac.parquet".format(path),
+                               index=False)
+        except ImportError:
+            print("pyarrow or fastparquet is needed for almanac.parquet, "
+                  "only writing almanac.csv")
+    report_table(almanac).to_csv("{0}/almanac_report.csv".format(path),
+                                 index=False)
+    return almanac
@@ -0,0 +1,496 @@
+import os
+import re
+import json
+import pickle
+import unicodedata
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from matplotlib.path import Path
+
+CATALOGS = {
+    "stars":'./data/processed/hygdata_processed.csv',
+    "deep_sky":'./data/processed/messier_ngc_processed.csv'
+}
+
+# used for the stars if the full HYG catalog has not been processed
+FALLBACK = {
+    "stars":'./data/processed/hygdata_processed_mag65.csv'
+}
+
+# the columns DINOS uses from each catalog, with compact types for them
+COLUMNS = {
+    "stars":{"id":"int32", "hip":"Int32", "proper":"category",
+             "ra":"float32", "dec":"float32", "mag":"float32",
+             "bayer":"category", "flam":"Int16", "con":"category",
+             "color":"category", "pmra":"float32", "pmdec":"float32",
+             "rv":"float32", "dist":"float32"},
+    "deep_sky":{"name":"string", "type":"category", "ra":"float32",
+                "dec":"float32", "magnitude":"float32",
+                "proper_name":"string"}
+}
+
+# the epoch of the positions in the processed catalogs, as a Julian year
+CATALOG_EPOCH = 2000.0
+# radial velocity in km/s times parallax in mas to radial proper motion in
+# mas/yr, one AU per year in km/s
+AU_YEAR_KMS = 4.740470446
+
+# compiled sky cultures, see sky_cultures.py
+SKY_CULTURE_PATH = './data/processed/sky_culture_{0}.npz'
+
+# indexes already loaded in this process
+_indexes = {}
+# sky cultures already loaded in this process
+_segments = {}
+_name_index = {}
+
+# Bayer letters as HYG writes them, with their names and Greek letters
+GREEK = [("Alp", "Alpha", "α"), ("Bet", "Beta", "β"), ("Gam", "Gamma", "γ"),
+         ("Del", "Delta", "δ"), ("Eps", "Epsilon", "ε"), ("Zet", "Zeta", "ζ"),
+         ("Eta", "Eta", "η"), ("The", "Theta", "θ"), ("Iot", "Iota", "ι"),
+         ("Kap", "Kappa", "κ"), ("Lam", "Lambda", "λ"), ("Mu", "Mu", "μ"),
+         ("Nu", "Nu", "ν"), ("Xi", "Xi", "ξ"), ("Omi", "Omicron", "ο"),
+         ("Pi", "Pi", "π"), ("Rho", "Rho", "ρ"), ("Sig", "Sigma", "σ"),
+         ("Tau", "Tau", "τ"), ("Ups", "Upsilon", "υ"), ("Phi", "Phi", "φ"),
+         ("Chi", "Chi", "χ"), ("Psi", "Psi", "ψ"), ("Ome", "Omega", "ω")]
+_greek_keys = {}
+for abbreviation, full, letter in GREEK:
+    for spelling in [abbreviation, full, letter]:
+        _greek_keys[spelling.upper()] = abbreviation.upper()
+
+def catalog_path(catalog):
+    """
+    Returns the path of a processed catalog, falling back to the smaller
+    version that comes with DINOS if the full one is missing.
+    """
+    path = CATALOGS[catalog]
+    if not os.path.exists(path) and catalog in FALLBACK:
+        path = FALLBACK[catalog]
+    return path
+
+def memory_usage(data):
+    """
+    Returns the memory used by a catalog DataFrame in MB, including the
+    contents of string columns.
+    """
+    return data.memory_usage(deep=True).sum()/1024**2
+
+def load_catalog(catalog="stars", columns=None, verbose=False):
+    """
+    Reads a processed catalog with only the columns DINOS uses, stored in
+    compact types: float32 coordinates and magnitudes, nullable 32 bit ids
+    and categorical colours and names.
+
+    Parameters
+    -----------
+
+    catalog : str
+        "stars" for the HYG star catalog or "deep_sky" for the Messier and NGC
+        catalog.
+        Defaults to "stars".
+
+    columns : list of str or None
+        The columns to read. If None, the columns in COLUMNS are read.
+
+    verbose : bool
+        Print the memory footprint of the catalog.
+        Defaults to False.
+    """
+    if columns is None:
+        columns = list(COLUMNS[catalog].keys())
+    dtypes = {column:COLUMNS[catalog].get(column) for column in columns
+              if column in COLUMNS[catalog]}
+    data = pd.read_csv(catalog_path(catalog), usecols=columns, dtype=dtypes)
+    if verbose:
+        print("{0} catalog: {1} rows, {2:.1f} MB".format(catalog, len(data),
+                                                        memory_usage(data)))
+    return data
+
+def _unit_vectors(ra, dec):
+    """
+    Converts RA and DEC in degrees to an (n, 3) array of unit vectors.
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    return np.stack([np.cos(dec)*np.cos(ra),
+                     np.cos(dec)*np.sin(ra),
+                     np.sin(dec)], axis=-1)
+
+def _chord(radius):
+    """
+    Converts an angular radius in degrees to the chord length between unit
+    vectors, which is the distance the k-d tree works with.
+    """
+    return 2*np.sin(np.radians(np.minimum(radius, 180.0))/2)
+
+def _index_path(catalog, epoch=None):
+    if epoch is None:
+        return os.path.splitext(catalog_path(catalog))[0] + "_index.pkl"
+    return "{0}_{1:d}_index.pkl".format(
+        os.path.splitext(catalog_path(catalog))[0], epoch)
+
+def epoch_year(epoch):
+    """
+    Rounds an epoch, an astropy Time or a Julian year, to the whole year the
+    catalogs are propagated to. Returns None for None, which stands for the
+    catalog positions themselves.
+    """
+    if epoch is None:
+        return None
+    if hasattr(epoch, "jyear"):
+        epoch = np.mean(epoch.jyear)
+    return int(np.round(epoch))
+
+def propagate(ra, dec, pmra, pmdec, years, rv=None, dist=None):
+    """
+    Moves catalog positions along their proper motions by years Julian
+    years, for all stars in one array operation.
+
+    Each star moves on a straight line in space, so the radial velocity and
+    distance, if given, add the perspective acceleration of nearby fast
+    stars. Missing proper motions, radial velocities and distances count as
+    zero.
+
+    Parameters
+    -----------
+
+    ra, dec : arrays
+        The positions in degrees.
+
+    pmra, pmdec : arrays
+        The proper motions in mas/yr, pmra including the cos(dec) factor, as
+        in HYG and Hipparcos.
+
+    years : float
+        The time to propagate by, in Julian years.
+
+    rv : array or None
+        The radial velocities in km/s.
+
+    dist : array or None
+        The distances in parsecs.
+
+    Returns the new RA and DEC in degrees.
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    mas = np.radians(1/3.6e6)
+    pmra = np.nan_to_num(np.asarray(pmra, dtype=float))*mas
+    pmdec = np.nan_to_num(np.asarray(pmdec, dtype=float))*mas
+    zeta = np.zeros(ra.shape)
+    if rv is not None and dist is not None:
+        # parallax in mas, radial proper motion in mas/yr
+        parallax = 1000/np.asarray(dist, dtype=float)
+        zeta = np.nan_to_num(np.asarray(rv, dtype=float)*parallax
+                             / AU_YEAR_KMS)*mas
+
+    sin_ra, cos_ra = np.sin(ra), np.cos(ra)
+    sin_dec, cos_dec = np.sin(dec), np.cos(dec)
+    r = np.stack([cos_dec*cos_ra, cos_dec*sin_ra, sin_dec])
+    p = np.stack([-sin_ra, cos_ra, np.zeros(ra.shape)])
+    q = np.stack([-sin_dec*cos_ra, -sin_dec*sin_ra, cos_dec])
+    moved = r*(1 + zeta*years) + (p*pmra + q*pmdec)*years
+    new_ra = np.degrees(np.arctan2(moved[1], moved[0])) % 360
+    new_dec = np.degrees(np.arctan2(moved[2], np.hypot(moved[0], moved[1])))
+    return new_ra, new_dec
+
+def star_name(row):
+    """
+    Returns a readable name for a row of the star catalog: the proper name if
+    it has one, otherwise the Bayer or Flamsteed designation, otherwise the HIP
+    number, otherwise the HYG id.
+    """
+    if isinstance(row.get('proper'), str):
+        return row['proper']
+    if isinstance(row.get('bayer'), str):
+        return "{0} {1}".format(row['bayer'], row['con'])
+    if not pd.isna(row.get('flam', np.nan)):
+        return "{0:d} {1}".format(int(row['flam']), row['con'])
+    if not pd.isna(row.get('hip', np.nan)):
+        return "HIP {0:d}".format(int(row['hip']))
+    return "HYG {0}".format(row['id'])
+
+def _read_catalog(catalog, epoch=None):
+    """
+    Reads a processed catalog and adds 'ra_deg', 'dec_deg' and 'mag' columns
+    so that all catalogs can be queried the same way. If epoch, a Julian
+    year, is given the stars are moved to it, see propagate, and 'ra' and
+    'dec' are replaced too.
+    """
+    data = load_catalog(catalog)
+    # RA is in hours in all the processed catalogs
+    data['ra_deg'] = data['ra']*360/24
+    data['dec_deg'] = data['dec']
+    if epoch is not None and catalog == "stars":
+        ra, dec = propagate(data['ra_deg'], data['dec_deg'], data['pmra'],
+                            data['pmdec'], epoch - CATALOG_EPOCH,
+                            rv=data['rv'], dist=data['dist'])
+        data['ra_deg'] = ra
+        data['dec_deg'] = dec
+        data['ra'] = (ra*24/360).astype(np.float32)
+        data['dec'] = dec.astype(np.float32)
+    if catalog == "deep_sky":
+        data['mag'] = data['magnitude']
+    return data
+
+def _index_epoch(catalog, epoch):
+    # only the stars have proper motions
+    if catalog != "stars":
+        return None
+    return epoch_year(epoch)
+
+def build_index(catalog="stars", epoch=None):
+    """
+    Builds a k-d tree over the unit vectors of a processed catalog and saves
+    it next to the catalog, so it only has to be built again when the catalog
+    changes. Star indexes for an epoch are saved separately for every year.
+
+    Parameters
+    -----------
+
+    catalog : str
+        "stars" for the HYG star catalog or "deep_sky" for the Messier and NGC
+        catalog.
+        Defaults to "stars".
+
+    epoch : astropy.time.Time, float or None
+        The epoch to move the stars to, rounded to a whole year, see
+        epoch_year. If None, the positions of the catalog are used.
+        Defaults to None.
+
+    Returns the index, a dict with the catalog 'data', the 'tree', and the
+    'ra', 'dec' and 'mag' arrays in the order of the tree.
+    """
+    epoch = _index_epoch(catalog, epoch)
+    data = _read_catalog(catalog, epoch=epoch)
+    index = {"catalog":catalog,
+             "epoch":epoch,
+             "tree":cKDTree(_unit_vectors(data['ra_deg'], data['dec_deg'])),
+             "ra":data['ra_deg'].to_numpy(),
+             "dec":data['dec_deg'].to_numpy(),
+             "mag":data['mag'].to_numpy(),
+             "source_mtime":os.path.getmtime(catalog_path(catalog))}
+    with open(_index_path(catalog, epoch), 'wb') as f:
+        pickle.dump(index, f)
+    index['data'] = data
+    _indexes[(catalog, epoch)] = index
+    return index
+
+def load_index(catalog="stars", epoch=None):
+    """
+    Loads the spatial index of a processed catalog, building it first if it
+    is missing or older than the catalog. Indexes are kept in memory after
+    the first load. epoch is the same as for build_index.
+    """
+    epoch = _index_epoch(catalog, epoch)
+    if (catalog, epoch) in _indexes:
+        return _indexes[(catalog, epoch)]
+
+    path = _index_path(catalog, epoch)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+        if index['source_mtime'] == os.path.getmtime(catalog_path(catalog)):
+            index['data'] = _read_catalog(catalog, epoch=epoch)
+            _indexes[(catalog, epoch)] = index
+            return index
+    return build_index(catalog, epoch=epoch)
+
+def _select(index, rows, ra, dec, mag_limit=None):
+    """
+    Returns the catalog rows at the given tree positions with their
+    separation from (ra, dec), brightest-cut and sorted by separation.
+    """
+    rows = np.asarray(rows, dtype=int)
+    if mag_limit is not None:
+        rows = rows[index['mag'][rows] < mag_limit]
+    # the chord between unit vectors is 2 sin(sep/2)
+    vectors = _unit_vectors(index['ra'][rows], index['dec'][rows])
+    chord = np.linalg.norm(vectors - _unit_vectors(ra, dec), axis=-1)
+    result = index['data'].iloc[rows].copy()
+    result['sep'] = np.degrees(2*np.arcsin(np.clip(chord/2, 0, 1)))
+    return result.sort_values('sep')
+
+def cone_query(index, ra, dec, radius, mag_limit=None):
+    """
+    Finds everything in the catalog within radius degrees of (ra, dec), both
+    in degrees. Only objects brighter than mag_limit are kept if it is given.
+
+    Returns the matching catalog rows, with a 'sep' column in degrees, sorted
+    by separation.
+    """
+    rows = index['tree'].query_ball_point(_unit_vectors(ra, dec),
+                                          _chord(radius))
+    return _select(index, rows, ra, dec, mag_limit=mag_limit)
+
+def polygon_query(index, ras, decs, mag_limit=None):
+    """
+    Finds everything in the catalog inside a polygon on the sky, given by the
+    RA and DEC of its corners in degrees. The polygon has to be smaller than a
+    hemisphere.
+
+    The candidates come from a cone query around the center of the polygon,
+    and are then tested against the polygon in a gnomonic projection around
+    that center, where the edges of the polygon are straight lines.
+    """
+    corners = _unit_vectors(ras, decs)
+    center = corners.mean(axis=0)
+    center = center/np.linalg.norm(center)
+    ra0 = np.degrees(np.arctan2(center[1], center[0])) % 360
+    dec0 = np.degrees(np.arcsin(center[2]))
+    radius = np.degrees(np.arccos(np.clip(corners @ center, -1, 1))).max()
+
+    candidates = cone_query(index, ra0, dec0, radius, mag_limit=mag_limit)
+
+    # gnomonic projection around the center
+    east = np.cross([0, 0, 1], center)
+    if np.linalg.norm(east) == 0:
+        east = np.array([0.0, 1.0, 0.0])
+    east = east/np.linalg.norm(east)
+    north = np.cross(center, east)
+
+    def project(vectors):
+        return np.stack([(vectors @ east)/(vectors @ center),
+                         (vectors @ north)/(vectors @ center)], axis=-1)
+
+    polygon = Path(project(corners))
+    points = project(_unit_vectors(candidates['ra_deg'],
+                                   candidates['dec_deg']))
+    return candidates[polygon.contains_points(points)]
+
+def nearest(index, ra, dec, k=1, mag_limit=None, max_radius=180.0):
+    """
+    Finds the k nearest catalog objects to (ra, dec), in degrees, that are
+    brighter than mag_limit if it is given.
+
+    Returns the matching catalog rows with a 'sep' column in degrees, sorted
+    by separation.
+    """
+    target = _unit_vectors(ra, dec)
+    n = len(index['ra'])
+    n_query = k
+    while True:
+        n_query = min(n_query, n)
+        distance, rows = index['tree'].query(target, k=n_query,
+                                             distance_upper_bound=_chord(
+                                                 max_radius))
+        rows = np.atleast_1d(rows)
+        rows = rows[rows < n]
+        if mag_limit is not None:
+            rows = rows[index['mag'][rows] < mag_limit]
+        if len(rows) >= k or n_query >= n:
+            break
+        # not enough bright enough objects yet, look further out
+        n_query *= 4
+    return _select(index, rows[:k], ra, dec)
+
+def normalize_name(name):
+    """
+    Returns the key of an object name in the name index: upper case with
+    single spaces, catalog numbers without spaces or leading zeros ("M 31",
+    "Messier 031" and "m31" are all "M31", "HIP 91262" is "HIP91262") and
+    Bayer letters abbreviated like HYG ("alpha Lyr", "α Lyr" and "Alp Lyr"
+    are all "ALP LYR", "Kappa-1 Cen" is "KAP1 CEN").
+    """
+    key = unicodedata.normalize('NFKC', str(name)).upper().replace("_", " ")
+    key = " ".join(key.split())
+    match = re.match(r'^(MESSIER|M|NGC|HIP)\s*-?\s*0*(\d+)(?:\.0)?$', key)
+    if match is not None:
+        prefix = "M" if match.group(1) == "MESSIER" else match.group(1)
+        return prefix + match.group(2)
+    words = key.split(" ")
+    if len(words) == 2:
+        match = re.match(r'^(\D+?)-?(\d?)$', words[0])
+        if match is not None and match.group(1) in _greek_keys:
+            return "{0}{1} {2}".format(_greek_keys[match.group(1)],
+                                       match.group(2), words[1])
+    return key
+
+def build_name_index():
+    """
+    Builds the name index from the Messier and NGC catalog and the HYG star
+    catalog, so common names can be resolved without SIMBAD.
+
+    Returns a dict from normalized name, see normalize_name, to the RA and
+    DEC in degrees.
+    """
+    index = {}
+
+    def add(names, ra, dec):
+        for name, this_ra, this_dec in zip(names, ra, dec):
+            if isinstance(name, str) and not re.match(r'^[\d.]*$', name):
+                # brighter objects come first and win
+                index.setdefault(normalize_name(name),
+                                 (float(this_ra)*360/24, float(this_dec)))
+
+    deep_sky = load_catalog("deep_sky",
+                            columns=["name", "ra", "dec", "proper_name"])
+    add(deep_sky['name'], deep_sky['ra'], deep_sky['dec'])
+    add(deep_sky['proper_name'], deep_sky['ra'], deep_sky['dec'])
+
+    stars = load_catalog("stars", columns=["hip", "proper", "ra", "dec", "mag",
+                                           "bayer", "flam", "con"])
+    stars = stars.sort_values('mag')
+    ra = stars['ra'].to_numpy()
+    dec = stars['dec'].to_numpy()
+    con = stars['con'].astype(str).to_numpy()
+    add(stars['proper'].astype(object).to_numpy(), ra, dec)
+    add(["HIP{0}".format(hip) if not pd.isna(hip) else None
+         for hip in stars['hip']], ra, dec)
+    add(["{0} {1}".format(bayer, c) if isinstance(bayer, str) else None
+         for bayer, c in zip(stars['bayer'].astype(object), con)], ra, dec)
+    add(["{0} {1}".format(flam, c) if not pd.isna(flam) else None
+         for flam, c in zip(stars['flam'], con)], ra, dec)
+    return index
+
+def resolve_name(name):
+    """
+    Looks an object name up in the name index, which is built the first time
+    it is needed. Messier and NGC objects, proper star names, HIP numbers and
+    Bayer and Flamsteed designations are known.
+
+    Returns the RA and DEC in degrees, or None if the name is not known.
+    """
+    if "index" not in _name_index:
+        _name_index['index'] = build_name_index()
+    return _name_index['index'].get(normalize_name(name))
+
+def _segments_stale(path):
+    """
+    Checks whether a compiled sky culture is missing or older than one of
+    the files it was built from.
+    """
+    if not os.path.exists(path):
+        return True
+    with np.load(path) as compiled:
+        meta = json.loads(str(compiled['meta']))
+    return any(not os.path.exists(source) or os.path.getmtime(source) != mtime
+               for source, mtime in meta['sources'].items())
+
+def load_asterism_segments(sky_culture="rey"):
+    """
+    Reads the asterisms of a sky culture as line segments, from the file
+    compiled by sky_cultures.build. The file is built the first time it is
+    needed and again when one of its sources changes, and kept in memory
+    after that, so switching between sky cultures costs nothing.
+
+    Raises ValueError if the sky culture is not in
+    sky_cultures.SKY_CULTURES.
+
+    Returns a dict with 'ra1', 'dec1', 'ra2', 'dec2' arrays in degrees, one
+    entry per segment, a boolean 'zodiac' array, and the 'constellation' and
+    HIP numbers 'hip1' and 'hip2' of each segment.
+    """
+    if sky_culture in _segments:
+        return _segments[sky_culture]
+    path = SKY_CULTURE_PATH.format(sky_culture)
+    if _segments_stale(path):
+        import sky_cultures
+        sky_cultures.build(sky_culture)
+    with np.load(path) as compiled:
+        segments = {key:compiled[key] for key in compiled.files
+                    if key != "meta"}
+    _segments[sky_culture] = segments
+    return segments
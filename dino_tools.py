@@ -1,3 +1,8 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
@@ -17,6 +22,8 @@ from astroplan import Observer
 from astroplan import FixedTarget
 
 #import matplotlib as mpl
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 #import matplotlib.pyplot as plt
 #import matplotlib.image as mpl_image
 #from matplotlib.offsetbox import (OffsetImage, AnnotationBbox)
@@ -31,6 +38,10 @@ import seaborn as sns
 
 from astroquery.jplhorizons import Horizons
 
+import network
+import orbits
+import catalogs
+
 from datetime import timezone
 from datetime import datetime
 
@@ -38,6 +49,116 @@ from datetime import datetime
 
 import warnings
 
+# NAIF ids of the bodies in the JPL kernels, so Horizons style ids also work
+# with the local ephemeris
+NAIF_IDS = {"10":"sun", "199":"mercury", "299":"venus", "301":"moon",
+            "499":"mars", "599":"jupiter", "699":"saturn", "799":"uranus",
+            "899":"neptune", "999":"pluto"}
+
+# the positions of solar-system bodies are memoized with the times rounded to
+# 'quantum' seconds, see body_position. Seen from the ground the moon moves
+# up to about 1.5 arcseconds per second, the planets much less. At most
+# 'size' results are kept, the least recently used are dropped first.
+BODY_CACHE = {"quantum":10.0, "size":4096}
+
+# memoized positions, see _memoized
+_body_positions = OrderedDict()
+_body_positions_lock = threading.Lock()
+
+def configure_body_cache(quantum=None, size=None):
+    """
+    Changes the time quantum, in seconds, and the size of the memoized
+    solar-system positions, see body_position. A size of 0 turns the
+    memoization off. Positions already kept are dropped.
+    """
+    if quantum is not None:
+        BODY_CACHE['quantum'] = float(quantum)
+    if size is not None:
+        BODY_CACHE['size'] = int(size)
+    with _body_positions_lock:
+        _body_positions.clear()
+
+def _location_key(location):
+    """
+    Returns a hashable version of an EarthLocation, or None.
+    """
+    if location is None:
+        return None
+    return tuple(np.round(u.Quantity(location.geocentric).to_value(u.m),
+                          3).ravel())
+
+def _memoized(key, times, location, compute):
+    """
+    Returns compute(quantized_times), memoized by key, the times rounded to
+    BODY_CACHE['quantum'] seconds and the location. As every call with times
+    in the same quanta computes at the same rounded times, the result does
+    not depend on which call came first. Both single times and arrays of
+    times work, an array is kept as one result.
+    """
+    times = Time(times)
+    if BODY_CACHE['size'] <= 0:
+        return compute(times)
+    quantum = BODY_CACHE['quantum']/86400
+    utc = times.utc
+    steps = np.round((utc.jd1 - 2451545.0 + utc.jd2)/quantum).astype(np.int64)
+    full_key = (key, times.shape, steps.tobytes(), quantum,
+                _location_key(location))
+    with _body_positions_lock:
+        if full_key in _body_positions:
+            _body_positions.move_to_end(full_key)
+            return _body_positions[full_key]
+    quantized = Time(2451545.0, steps*quantum, format='jd', scale='utc')
+    result = compute(quantized)
+    with _body_positions_lock:
+        _body_positions[full_key] = result
+        while len(_body_positions) > BODY_CACHE['size']:
+            _body_positions.popitem(last=False)
+    return result
+
+def body_position(body, times, location=None):
+    """
+    Memoized astropy.coordinates.get_body for the current solar-system
+    ephemeris. body can also be a NAIF id, see local_body. The times are
+    rounded to BODY_CACHE['quantum'] seconds, so the plots that need the
+    moon or a planet at the same, or nearly the same, times share one
+    computation, see configure_body_cache.
+    """
+    body = local_body(body) or body
+    return _memoized(("body", body, str(solar_system_ephemeris.get())),
+                     times, location,
+                     lambda t: get_body(body, t, location))
+
+def setup_ephemeris(kernel="builtin"):
+    """
+    Sets the solar-system ephemeris used for the planets and the moon.
+
+    Parameters
+    -----------
+
+    kernel : str
+        "builtin" for the ephemeris that comes with astropy, the name of a JPL
+        kernel such as "de432s" or "de440s", or the path or URL of a JPL
+        kernel file. JPL kernels need the jplephem package, and named kernels
+        are downloaded once and then read from the astropy cache.
+        Defaults to "builtin".
+
+    Returns the names of the bodies the ephemeris provides.
+    """
+    solar_system_ephemeris.set(kernel)
+    return solar_system_ephemeris.bodies
+
+def local_body(target_id):
+    """
+    Returns the name of the body in the current solar-system ephemeris that
+    target_id refers to, by name or NAIF id, or None if it is not in there.
+    """
+    name = str(target_id).strip()
+    body = NAIF_IDS.get(name, name.lower())
+    if body in solar_system_ephemeris.bodies and body not in [
+            "earth", "earth-moon-barycenter"]:
+        return body
+    return None
+
 def get_ephemerides(target_id, id_type, time=None, location=None):
     """
     Credit rmquimby on GitHub. This function is taken from their
@@ -58,9 +179,40 @@ def get_ephemerides(target_id, id_type, time=None, location=None):
     if time is None:
         # use current time by default
         time = Time.now()   
-    obj = Horizons(id=target_id, id_type=id_type, location=location,
-                   epochs=time.jd)
-    return obj.ephemerides()
+    if time.isscalar:
+        epochs = time.jd
+    else:
+        epochs = list(time.jd)
+    return network.run(network.horizons_ephemerides(target_id, id_type,
+                                                    epochs, location))
+
+def interpolate_ephemeris(ephemeris, times):
+    """
+    Interpolates a stored ephemeris, a dict with 'jd', 'ra' and 'dec' arrays
+    in degrees such as nightplan.attach_ephemerides makes, to the given times.
+
+    Raises ValueError for times outside the ephemeris, as they would
+    otherwise all get the position at its first or last time.
+
+    Returns a SkyCoord array in ICRS.
+    """
+    times = Time(times)
+    if times.isscalar:
+        times = times.reshape((1,))
+    # allow for rounding in the conversions of the times to JD
+    tolerance = 1e-6
+    if (times.jd.min() < ephemeris['jd'][0] - tolerance
+            or times.jd.max() > ephemeris['jd'][-1] + tolerance):
+        raise ValueError("the ephemeris covers JD {0:.5f} to {1:.5f}, not JD "
+                         "{2:.5f} to {3:.5f}".format(ephemeris['jd'][0],
+                                                     ephemeris['jd'][-1],
+                                                     times.jd.min(),
+                                                     times.jd.max()))
+    # unwrap so RA interpolates across 0h
+    ra = np.degrees(np.unwrap(np.radians(ephemeris['ra'])))
+    return SkyCoord(ra=(np.interp(times.jd, ephemeris['jd'], ra) % 360)*u.deg,
+                    dec=np.interp(times.jd, ephemeris['jd'],
+                                  ephemeris['dec'])*u.deg)
 
 def _setup_non_fixed_target(target_dict, time, location):
     """
@@ -71,65 +223,279 @@ def _setup_non_fixed_target(target_dict, time, location):
     target = None
     marker = None
     
-    if this_type == "smallbody":
-        target_eph = get_ephemerides(this_name, "smallbody", time=time)
+    if this_type == "smallbody" and 'elements' in target_dict:
         target = FixedTarget(name=this_name,
-                             coord=SkyCoord(ra=target_eph['RA'],
-                                            dec=target_eph['DEC'])[0])
+                             coord=orbits.propagate(target_dict['elements'],
+                                                    time, location)[0])
         marker = "d"
-    elif this_type == "majorbody":
-        target_eph = get_ephemerides(this_name, None, time=time)
+    elif this_type in ["smallbody", "majorbody"] and 'ephemeris' in target_dict:
+        target = FixedTarget(name=this_name,
+                             coord=interpolate_ephemeris(
+                                 target_dict['ephemeris'], time)[0])
+        if this_type == "smallbody":
+            marker = "d"
+        else:
+            marker = "s"
+    elif this_type in ["smallbody", "majorbody"]:
+        # Horizons answers are memoized like the local positions
+        id_type = "smallbody" if this_type == "smallbody" else None
+        def query(t):
+            target_eph = get_ephemerides(this_name, id_type, time=t)
+            return SkyCoord(ra=target_eph['RA'], dec=target_eph['DEC'])[0]
         target = FixedTarget(name=this_name,
-                             coord=SkyCoord(ra=target_eph['RA'],
-                                            dec=target_eph['DEC'])[0])
-        marker = "s"
+                             coord=_memoized(("horizons", this_name, id_type),
+                                             time, None, query))
+        if this_type == "smallbody":
+            marker = "d"
+        else:
+            marker = "s"
     elif this_type == "planet":
         target = FixedTarget(name=this_name,
-                             coord=get_body(this_name, time, location))
+                             coord=body_position(this_name, time, location))
         marker = "o"
 
     return target, marker
 
+def get_target_coords(target_dict, times, location):
+    """
+    Returns the coordinates of a single target at each of the given times as
+    one SkyCoord array. Fixed targets are broadcast over the times, planets are
+    computed in one vectorized call from the local ephemeris (see
+    setup_ephemeris), small bodies with orbital elements are propagated
+    locally (see orbits.setup_orbits), targets with a stored ephemeris are
+    interpolated, and everything else comes from Horizons queries of many
+    epochs each, issued concurrently.
+    """
+    times = Time(times)
+    if times.isscalar:
+        times = times.reshape((1,))
+    this_type = target_dict['type']
+
+    if this_type == "fixed":
+        coord = target_dict['target'].coord.icrs
+        return SkyCoord(ra=np.full(times.shape, coord.ra.deg)*u.deg,
+                        dec=np.full(times.shape, coord.dec.deg)*u.deg)
+    elif this_type == "planet":
+        return body_position(target_dict['name'], times, location)
+
+    elif 'elements' in target_dict:
+        # comets and asteroids with orbital elements, see orbits.setup_orbits
+        return orbits.propagate(target_dict['elements'], times, location)
+
+    elif 'ephemeris' in target_dict:
+        # ephemerides stored in a night plan, see nightplan.attach_ephemerides
+        return interpolate_ephemeris(target_dict['ephemeris'], times)
+
+    if this_type == "smallbody":
+        id_type = "smallbody"
+    else:
+        id_type = None
+    # one Horizons query per chunk of times, all chunks at once
+    chunks = [times[k:k + 50] for k in range(0, len(times), 50)]
+    tables = network.run(network.gather(*[
+        network.horizons_ephemerides(target_dict['name'], id_type,
+                                     list(chunk.jd))
+        for chunk in chunks]))
+    ras = np.concatenate([np.asarray(table['RA']) for table in tables])
+    decs = np.concatenate([np.asarray(table['DEC']) for table in tables])
+    return SkyCoord(ra=ras*u.deg, dec=decs*u.deg)
+
+def altaz_grid(observer, targets, times):
+    """
+    Computes the altitude and azimuth of every target at every time.
+
+    All fixed targets are transformed together in a single broadcast
+    (n_targets, n_times) transformation. Non-fixed targets are transformed one
+    target at a time, but still vectorized over the times.
+
+    Returns two (n_targets, n_times) arrays, altitude and azimuth in degrees.
+    """
+    if type(targets) != list:
+        target_list = [targets]
+    else:
+        target_list = targets
+    times = Time(times)
+    if times.isscalar:
+        times = times.reshape((1,))
+
+    alt = np.zeros((len(target_list), len(times)))
+    az = np.zeros((len(target_list), len(times)))
+    frame = AltAz(obstime=times, location=observer.location)
+
+    fixed = [i for i in range(0, len(target_list))
+             if target_list[i]['type'] == "fixed"]
+    if len(fixed) > 0:
+        ra = np.array([target_list[i]['target'].coord.icrs.ra.deg
+                       for i in fixed])
+        dec = np.array([target_list[i]['target'].coord.icrs.dec.deg
+                        for i in fixed])
+        coords = SkyCoord(ra=ra[:, np.newaxis]*u.deg,
+                          dec=dec[:, np.newaxis]*u.deg)
+        altaz = coords.transform_to(frame)
+        alt[fixed] = altaz.alt.deg
+        az[fixed] = altaz.az.deg
+
+    for i in range(0, len(target_list)):
+        if target_list[i]['type'] == "fixed":
+            continue
+        coords = get_target_coords(target_list[i], times, observer.location)
+        altaz = coords.transform_to(frame)
+        alt[i] = altaz.alt.deg
+        az[i] = altaz.az.deg
+
+    return alt, az
+
+def _angular_separation(lon1, lat1, lon2, lat2):
+    """
+    Vincenty angular separation between two sets of points, all in degrees.
+    The inputs only need to broadcast against each other.
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(lon1), np.radians(lat1),
+                              np.radians(lon2), np.radians(lat2))
+    sdlon = np.sin(lon2 - lon1)
+    cdlon = np.cos(lon2 - lon1)
+    num1 = np.cos(lat2)*sdlon
+    num2 = np.cos(lat1)*np.sin(lat2) - np.sin(lat1)*np.cos(lat2)*cdlon
+    denominator = np.sin(lat1)*np.sin(lat2) + np.cos(lat1)*np.cos(lat2)*cdlon
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator))
+
+def moon_separation_grid(observer, targets, times, moon=None):
+    """
+    Computes the separation between the moon and every target at every time.
+
+    The moon is computed once for all times, unless it is given as a SkyCoord
+    already computed at the same times. The targets are transformed into the
+    geocentric frame of the moon, all fixed targets in one broadcast
+    transformation, so the separation is measured as seen from Earth.
+
+    Returns an (n_targets, n_times) array of separations in degrees.
+    """
+    if type(targets) != list:
+        target_list = [targets]
+    else:
+        target_list = targets
+    times = Time(times)
+    if times.isscalar:
+        times = times.reshape((1,))
+
+    if moon is None:
+        moon = body_position("moon", times, observer.location)
+    frame = moon.frame.replicate_without_data()
+    sep = np.zeros((len(target_list), len(times)))
+
+    fixed = [i for i in range(0, len(target_list))
+             if target_list[i]['type'] == "fixed"]
+    if len(fixed) > 0:
+        ra = np.array([target_list[i]['target'].coord.icrs.ra.deg
+                       for i in fixed])
+        dec = np.array([target_list[i]['target'].coord.icrs.dec.deg
+                        for i in fixed])
+        coords = SkyCoord(ra=ra[:, np.newaxis]*u.deg,
+                          dec=dec[:, np.newaxis]*u.deg).transform_to(frame)
+        sep[fixed] = _angular_separation(moon.ra.deg, moon.dec.deg,
+                                         coords.ra.deg, coords.dec.deg)
+
+    for i in range(0, len(target_list)):
+        if target_list[i]['type'] == "fixed":
+            continue
+        coords = get_target_coords(target_list[i], times,
+                                   observer.location).transform_to(frame)
+        sep[i] = _angular_separation(moon.ra.deg, moon.dec.deg,
+                                     coords.ra.deg, coords.dec.deg)
+
+    return sep
+
+def moon_grid(observer, targets, times):
+    """
+    Computes everything about the moon that the plots and reports need, in one
+    vectorized pass over the given times.
+
+    Returns a dict with
+        'times' : the times, as an astropy Time array
+        'coord' : the moon position at each time, as a SkyCoord array
+        'alt', 'az' : the moon altitude and azimuth at each time, in degrees
+        'illumination' : the illuminated fraction of the moon at each time
+        'sep' : an (n_targets, n_times) array of moon separations in degrees
+    """
+    times = Time(times)
+    if times.isscalar:
+        times = times.reshape((1,))
+
+    moon = body_position("moon", times, observer.location)
+    altaz = moon.transform_to(AltAz(obstime=times,
+                                    location=observer.location))
+    return {"times":times,
+            "coord":moon,
+            "alt":altaz.alt.deg,
+            "az":altaz.az.deg,
+            "illumination":np.atleast_1d(observer.moon_illumination(times)),
+            "sep":moon_separation_grid(observer, targets, times, moon=moon)}
+
+def moon_constraint(moon, min_moon_sep=30.0):
+    """
+    Checks the moon separation constraint on a moon grid from moon_grid.
+
+    Returns an (n_targets, n_times) boolean array which is True where a target
+    is at least min_moon_sep degrees from the moon.
+    """
+    return moon['sep'] >= min_moon_sep
+
+async def _resolve_target(target_id, location):
+    """
+    Works out what kind of target a name is, trying the local ephemeris,
+    the local name index (see catalogs.resolve_name), Horizons, the planets
+    and SIMBAD in turn, and finally reading it as "RA DEC name".
+    Returns the type, the FixedTarget (None if not fixed) and the name.
+    """
+    # planets and the moon are computed locally, no need to ask Horizons
+    if local_body(target_id) is not None:
+        return "planet", None, target_id
+    # Messier, NGC and bright stars are known locally
+    position = catalogs.resolve_name(target_id)
+    if position is not None:
+        coord = SkyCoord(ra=position[0]*u.deg, dec=position[1]*u.deg)
+        return "fixed", FixedTarget(coord, name=target_id), target_id
+    # see if this is a solar-system target
+    try:
+        await network.horizons_ephemerides(target_id, 'smallbody',
+                                           Time.now().jd)
+        return "smallbody", None, target_id
+    except:
+        pass
+    # maybe it's a major body?
+    try:
+        await network.horizons_ephemerides(target_id, None, Time.now().jd)
+        return "majorbody", None, target_id
+    except:
+        pass
+    # maybe it's a planet? (Horizons gets upset about planet names)
+    try:
+        target_coord = get_body(target_id, Time.now(), location.location)
+        return "planet", None, target_id
+    except:
+        pass
+    # if not a solar system target, make a FixedTarget directly
+    try:
+        coord = await network.resolve_name(target_id)
+        return "fixed", FixedTarget(coord, name=target_id), target_id
+    except:
+        ra, dec, this_name = target_id.split()
+        this_coord = SkyCoord(ra=ra, dec=dec, unit=(u.hourangle, u.deg))
+        return "fixed", FixedTarget(this_coord, name=this_name), this_name
+
 def setup_target_list(target_ids, location):
     """
-    Sets up the targets in a list of dicts containing the relevant information
+    Sets up the targets in a list of dicts containing the relevant information.
+    All names are resolved concurrently.
     """
     targets = []
     n_targets = len(target_ids)
     #cmap = plt.cm.get_cmap('hsv', n_targets)
     cmap = sns.color_palette("husl", n_targets)
+    resolved = network.run(network.gather(*[
+        _resolve_target(target_id, location) for target_id in target_ids]))
     for i in range(0, n_targets):
-        # see if this is a solar-system target
-        this_type = None
-        this_target = None
-        try:
-            target_eph = get_ephemerides(target_ids[i], 'smallbody')
-            this_type = "smallbody"
-            this_name = target_ids[i]
-        except:
-            # maybe it's a major body?
-            try:
-                target_eph = get_ephemerides(target_ids[i], None)
-                this_type = "majorbody"
-                this_name = target_ids[i]
-            except:
-                # maybe it's a planet? (Horizons gets upset about planet names)
-                try:
-                    target_coord = get_body(target_ids[i], Time.now(),
-                                            location.location) 
-                    this_type = "planet"
-                    this_name = target_ids[i]
-                except:
-                    # if not a solar system target, make a FixedTarget directly
-                    try:
-                        this_target = FixedTarget.from_name(target_ids[i])
-                        this_type = "fixed"
-                        this_name = target_ids[i]
-                    except:
-                        ra, dec, this_name = target_ids[i].split()
-                        this_coord = SkyCoord(ra=ra, dec=dec, unit=(u.hourangle, u.deg))
-                        this_target = FixedTarget(this_coord, name=this_name)
-                        this_type = "fixed"
+        this_type, this_target, this_name = resolved[i]
         
         # give this target a color
         this_color = cmap[i]
@@ -138,12 +504,85 @@ def setup_target_list(target_ids, location):
         targets.append(this_dict)
     return targets
 
+def sample_window(start, end, n_samples, events=None, refine_window=15.0,
+                  refine_samples=10):
+    """
+    Samples the time between start and end.
+
+    Without events this is n_samples evenly spaced times. With events, a list
+    of times where the curves change quickly, refine_samples extra times are
+    spread over refine_window minutes on either side of each event that falls
+    between start and end. The result is sorted and keeps the format of start.
+    """
+    fractions = [np.linspace(0, 1, n_samples)]
+    if events is not None:
+        duration = (end - start).to_value(u.min)
+        if duration > 0:
+            for event in events:
+                center = (Time(event) - start).to_value(u.min)/duration
+                if center < 0 or center > 1:
+                    continue
+                width = refine_window/duration
+                fractions.append(np.clip(np.linspace(center - width,
+                                                     center + width,
+                                                     refine_samples), 0, 1))
+    fractions = np.unique(np.concatenate(fractions))
+    return start + (end - start)*fractions
+
+def refine_times(observer, times, targets, window='plot_window'):
+    """
+    Adds samples to times[window] around the rises and sets of the targets and
+    the moon, which are found from the sign changes of the altitude on the
+    existing samples. The sampling settings given to setup_times are reused,
+    and the night and block events are kept if the window was adaptive.
+    """
+    coarse = times[window]
+    try:
+        iter(coarse)
+    except:
+        return times
+    sampling = times['sampling']
+    alt, az = altaz_grid(observer, targets, coarse)
+    moon = body_position("moon", coarse, observer.location)
+    moon_alt = moon.transform_to(AltAz(obstime=coarse,
+                                       location=observer.location)).alt.deg
+    alt = np.vstack([alt, moon_alt])
+
+    # linearly interpolate the horizon crossings between samples
+    jd = coarse.jd
+    rows, cols = np.nonzero(np.diff(np.sign(alt), axis=1) != 0)
+    a0 = alt[rows, cols]
+    a1 = alt[rows, cols + 1]
+    crossings = jd[cols] + (jd[cols + 1] - jd[cols])*a0/(a0 - a1)
+    events = list(Time(crossings, format='jd'))
+    if window in sampling['adaptive']:
+        events += times['events']
+
+    times[window] = sample_window(coarse[0], coarse[-1], sampling[window],
+                                  events=events,
+                                  refine_window=sampling['refine_window'],
+                                  refine_samples=sampling['refine_samples'])
+    return times
+
 def setup_times(observer, obs_start, obs_end=None, block_start_times=None,
-                block_end_times=None, block_colors=None):
+                block_end_times=None, block_colors=None, plot_samples=100,
+                obs_samples=10, adaptive=False, refine_window=15.0,
+                refine_samples=10):
     """
     Sets up a times dictionary for the night which includes the observing window
     but also the twilight times, and information about observing blocks if any.
+
+    plot_samples and obs_samples set the number of evenly spaced times in the
+    plot window and the observing window. With adaptive=True, refine_samples
+    extra times are added within refine_window minutes of sunset, sunrise, the
+    twilights and the block edges, see sample_window. adaptive can also be a
+    list of the windows to refine, e.g. ['plot_window']. Rises and sets of the
+    targets can be refined afterwards with refine_times.
     """
+    if adaptive is True:
+        adaptive = ['plot_window', 'obs_window']
+    elif not adaptive:
+        adaptive = []
     start = Time(obs_start)
     end = Time(obs_end)
     times = {
@@ -158,16 +597,6 @@ def setup_times(observer, obs_start, obs_end=None, block_start_times=None,
                    observer.twilight_morning_astronomical(start, which='next')],
         'blocks':None
     }
-    # calculate the window for plotting
-    ps = Time(times['sunset'] - TimeDelta(0*u.h), format='iso')
-    pe = Time(times['sunrise'] + TimeDelta(0*u.h), format='iso')
-    times['plot_window'] = (ps + (pe - ps)*np.linspace(0, 1, 100))
-    
-    if end != None:
-        times['obs_window'] = start + (end - start)*np.linspace(0, 1, 10)
-    else:
-        times['obs_window'] = start
-    
     if block_start_times != None:
         n_blocks = len(block_start_times)
         if block_colors == None:
@@ -190,6 +619,40 @@ def setup_times(observer, obs_start, obs_end=None, block_start_times=None,
             block['color'] = cmap[i]
             times['blocks'].append(block)
             
+    # times at which the night curves change quickly
+    times['events'] = [times['sunset'], times['sunrise']] + \
+                      times['civ_twl'] + times['nau_twl'] + times['ast_twl']
+    if times['blocks'] != None:
+        for block in times['blocks']:
+            times['events'] += [block['times'][0], block['times'][-1]]
+    times['sampling'] = {'plot_window':plot_samples,
+                         'obs_window':obs_samples,
+                         'adaptive':adaptive,
+                         'refine_window':refine_window,
+                         'refine_samples':refine_samples}
+
+    # calculate the window for plotting
+    ps = Time(times['sunset'] - TimeDelta(0*u.h), format='iso')
+    pe = Time(times['sunrise'] + TimeDelta(0*u.h), format='iso')
+    if 'plot_window' in adaptive:
+        events = times['events']
+    else:
+        events = None
+    times['plot_window'] = sample_window(ps, pe, plot_samples, events=events,
+                                         refine_window=refine_window,
+                                         refine_samples=refine_samples)
+    
+    if end != None:
+        if 'obs_window' in adaptive:
+            events = times['events']
+        else:
+            events = None
+        times['obs_window'] = sample_window(start, end, obs_samples,
+                                            events=events,
+                                            refine_window=refine_window,
+                                            refine_samples=refine_samples)
+    else:
+        times['obs_window'] = start
     
     return times
 
@@ -213,3 +676,38 @@ def setup_location(observer_name, lat=None, long=None, elev=None, tz=None):
         me_irl = Observer(location=location, name=observer_name, timezone=tz)
         
     return me_irl
+
+def new_figure(pyplot=False, **kwargs):
+    """
+    Makes a matplotlib figure on its own Agg canvas, without going through
+    pyplot. Nothing global is touched, so figures can be made and drawn in
+    several threads at once. The kwargs are passed to
+    matplotlib.figure.Figure.
+
+    With pyplot, the figure is made with pyplot.figure instead, so it gets a
+    window with the current backend, e.g. for the live view.
+    """
+    if pyplot:
+        import matplotlib.pyplot as plt
+        return plt.figure(**kwargs)
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+def save_figure(fig, path, filename, **kwargs):
+    """
+    Saves a figure as path/filename, or, if path is None, into an in-memory
+    buffer in the format given by the extension of filename. The kwargs are
+    passed to Figure.savefig.
+
+    Returns the path of the file, or the io.BytesIO buffer, rewound.
+    """
+    if path is None:
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format=os.path.splitext(filename)[1][1:],
+                    **kwargs)
+        buffer.seek(0)
+        return buffer
+    this_path = "{0}/{1}".format(path, filename)
+    fig.savefig(this_path, **kwargs)
+    return this_path
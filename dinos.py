@@ -7,6 +7,7 @@ import shutil
 import pandas as pd
 
 # Astropy utilities
+import astropy.units as u
 from astropy.time import Time
 
 # DINOS utilities
@@ -16,6 +17,15 @@ import local_sky
 import airmass
 import finder_image
 import object_stats
+import scheduler
+import catalogs
+import network
+import orbits
+import timelapse
+import nightplan
+import multisite
+import observability
+import almanac
 
 # read command line arguments
 parser = argparse.ArgumentParser(description="Just an example",
@@ -23,6 +33,8 @@ parser = argparse.ArgumentParser(description="Just an example",
 parser.add_argument("-i", "--input", help="input path")
 parser.add_argument("-o", "--output", help="output path")
 parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
+parser.add_argument("--plan", help="night plan to make the plots and report from, instead of computing the night")
+parser.add_argument("--save-plan", help="save the night plan to this file")
 
 args = vars(parser.parse_args())
 
@@ -100,6 +112,107 @@ temp_finder = """
 \end{{minipage}}
 """
 
+temp_schedule = """
+\\newpage
+
+\DIV[1]{{section}}*{{Schedule}}\label{{Ueff}}
+\\vspace{{-0.2cm}}\hrule
+\\vspace{{0.5cm}}
+
+\\begin{{center}}
+\\begin{{longtable}}{{l|l|c|c|c|c}}%
+    \\bfseries Block & \\bfseries Object & \\bfseries Priority & \\bfseries Start Time & \\bfseries End Time & \\bfseries Mean Airmass
+    \csvreader[head to column names]{{schedule.csv}}{{}}
+    {{\\\\\hline\\blockname & \\target & \\priority & \\starttime & \\endtime & \\airmass }}
+\end{{longtable}}
+\end{{center}}
+"""
+
+temp_sites = """
+\\newpage
+
+\DIV[1]{{section}}*{{Sites}}\label{{Ueff}}
+\\vspace{{-0.2cm}}\hrule
+\\vspace{{0.5cm}}
+
+\\begin{{center}}
+\\begin{{longtable}}{{l|c|c|c|c|c}}%
+    \\bfseries Site & \\bfseries Sunset & \\bfseries Sunrise & \\bfseries Evening Twilight & \\bfseries Morning Twilight & \\bfseries Dark Hours
+    \csvreader{{multisite_sites.csv}}{{1=\\sitename,2=\\sitesunset,3=\\sitesunrise,8=\\siteevening,9=\\sitemorning,10=\\sitedark}}
+    {{\\\\\hline\\sitename & \\sitesunset & \\sitesunrise & \\siteevening & \\sitemorning & \\sitedark }}
+\end{{longtable}}
+\end{{center}}
+"""
+
+temp_site = """
+\\newpage
+
+\DIV[1]{{section}}*{{Site: {0}}}\label{{Ueff}}
+\\vspace{{-0.2cm}}\hrule
+\\vspace{{0.5cm}}
+
+\\begin{{center}}
+    \includegraphics[width=0.9\\textwidth]{{{1}/multisite_{2}.jpg}}
+\\begin{{longtable}}{{l|c|c|c|c|c}}%
+    \\bfseries Object & \\bfseries Hours & \\bfseries Best Airmass & \\bfseries Best Time & \\bfseries From & \\bfseries Until
+    \csvreader{{multisite_{2}.csv}}{{2=\\sitetarget,3=\\sitehours,4=\\siteairmass,5=\\sitebest,6=\\sitestart,7=\\siteend}}
+    {{\\\\\hline\\sitetarget & \\sitehours & \\siteairmass & \\sitebest & \\sitestart & \\siteend }}
+\end{{longtable}}
+\end{{center}}
+"""
+
+temp_observability = """
+\\newpage
+
+\DIV[1]{{section}}*{{Observability}}\label{{Ueff}}
+\\vspace{{-0.2cm}}\hrule
+\\vspace{{0.5cm}}
+
+\\begin{{center}}
+    \includegraphics[width=1.0\\textwidth]{{{0}/observability.jpg}}
+    \captionof*{{figure}}{{\scriptsize Dark hours below the airmass limit for every night from {1} to {2}. Nights where the target is close to the moon are dimmed.}}
+\\begin{{longtable}}{{l|c|c|c|c|c|c}}%
+    \\bfseries Object & \\bfseries Best Night & \\bfseries Hours & \\bfseries Highest Altitude & \\bfseries Moon Distance & \\bfseries Transit Altitude & \\bfseries Nights
+    \csvreader{{observability_best.csv}}{{1=\\obstarget,2=\\obsnight,3=\\obshours,4=\\obsalt,5=\\obsmoon,6=\\obstransit,7=\\obsnights}}
+    {{\\\\\hline\\obstarget & \\obsnight & \\obshours & \\obsalt & \\obsmoon & \\obstransit & \\obsnights }}
+\end{{longtable}}
+\end{{center}}
+"""
+
+temp_almanac = """
+\\newpage
+
+\DIV[1]{{section}}*{{Almanac}}\label{{Ueff}}
+\\vspace{{-0.2cm}}\hrule
+\\vspace{{0.5cm}}
+
+\\begin{{center}}
+\\scriptsize
+\\begin{{longtable}}{{l|c|c|c|c|c|c|c|c|c}}%
+    \\bfseries Night & \\bfseries Sunset & \\bfseries Sunrise & \\bfseries Dark From & \\bfseries Dark Until & \\bfseries Moonrise & \\bfseries Moonset & \\bfseries Moon & \\bfseries Dark Hours & \\bfseries Moonless
+    \csvreader{{almanac_report.csv}}{{1=\\almnight,2=\\almsunset,3=\\almsunrise,4=\\almdarkfrom,5=\\almdarkuntil,6=\\almmoonrise,7=\\almmoonset,8=\\almmoon,9=\\almdark,10=\\almmoonless}}
+    {{\\\\\hline\\almnight & \\almsunset & \\almsunrise & \\almdarkfrom & \\almdarkuntil & \\almmoonrise & \\almmoonset & \\almmoon & \\almdark & \\almmoonless }}
+\end{{longtable}}
+\end{{center}}
+"""
+
+temp_ztf = """
+\\newpage
+
+\DIV[1]{{section}}*{{ZTF Photometry}}\label{{Ueff}}
+\\vspace{{-0.2cm}}\hrule
+\\vspace{{0.5cm}}
+
+\\begin{{center}}
+\\begin{{longtable}}{{l|c|c|c|c|c|c}}%
+    \\bfseries Object & \\bfseries Epochs & \\bfseries Last {0:g} Days & \\bfseries Newest Epoch & \\bfseries g & \\bfseries r & \\bfseries i
+    \csvreader{{ztf_summary.csv}}{{1=\\ztftarget,2=\\ztfepochs,3=\\ztfrecent,4=\\ztflast,5=\\ztfg,6=\\ztfr,7=\\ztfi}}
+    {{\\\\\hline\\ztftarget & \\ztfepochs & \\ztfrecent & \\ztflast & \\ztfg & \\ztfr & \\ztfi }}
+\end{{longtable}}
+\captionof*{{table}}{{\scriptsize Good ZTF epochs of each target and its newest magnitude in each band.}}
+\end{{center}}
+"""
+
 #print(temp_finder)
 
 
@@ -150,137 +263,329 @@ if __name__ == "__main__":
     # read configuration file
     print("reading configuration...")
     night_data, target_data, config_data = _read_input(args['input'])
-    
-    # define observer
-    print("defining observer...")
-    dino_loc = tools.setup_location(night_data['telescope_name'],
-                                    night_data['observer_lat'],
-                                    night_data['observer_long'],
-                                    night_data['observer_elevation'],
-                                    night_data['observer_timezone'])
-    print("setting up times...")
-    try:
-        bst = night_data['block_start_times']
-    except:
-        bst = None
-    try:
-        bet = night_data['block_end_times']
-    except:
-        bet = None        
+    if 'network' in config_data:
+        network.configure(**config_data['network'])
+    if 'body_cache' in config_data:
+        tools.configure_body_cache(**config_data['body_cache'])
+
+    # optional local JPL kernel for the planets and the moon, set up before
+    # anything is computed so a night from a plan uses the same ephemeris
     try:
-        bc = night_data['block_colors']
+        kernel = config_data['ephemeris']['kernel']
     except:
-        bc = None
+        kernel = "builtin"
+    tools.setup_ephemeris(kernel)
     
-    times = tools.setup_times(dino_loc,
-                              night_data['obs_start'],
-                              night_data['obs_end'],
-                              block_start_times=bst,
-                              block_end_times=bet,
-                              block_colors=bc)
+    if args['plan'] is not None:
+        # everything about the night comes from the plan, only the plots and
+        # the report are made again. The scheduler, multisite, observability,
+        # almanac and ZTF sections are not part of the plan and are skipped.
+        print("loading night plan...")
+        plan = nightplan.load_plan(args['plan'])
+        night_data = plan['night']
+        dino_loc = plan['observer']
+        times = plan['times']
+        targets = plan['targets']
+        altaz_plot = plan['altaz']['plot_window']
+        altaz_obs = plan['altaz']['obs_window']
+        moon_plot = plan['moon']['plot_window']
+        moon_obs = plan['moon']['obs_window']
+        hdus = plan['hdus']
+        cutouts = None
+        df = pd.DataFrame([{key:target[key] for key in nightplan.REPORT_KEYS
+                            if key in target} for target in targets],
+                          columns=nightplan.REPORT_KEYS, index=[0]*len(targets))
+    else:
+        # define observer
+        print("defining observer...")
+        dino_loc = tools.setup_location(night_data['telescope_name'],
+                                        night_data['observer_lat'],
+                                        night_data['observer_long'],
+                                        night_data['observer_elevation'],
+                                        night_data['observer_timezone'])
+        print("setting up times...")
+        try:
+            bst = night_data['block_start_times']
+        except:
+            bst = None
+        try:
+            bet = night_data['block_end_times']
+        except:
+            bet = None        
+        try:
+            bc = night_data['block_colors']
+        except:
+            bc = None
     
-    if args['verbose']:
-        print("----------------------------------")
-        print("---------- times -----------")
-        print("----------------------------------")
-        print(times)
-        print()
-        
-    # setup blocks.csv
-    blocks_df = pd.DataFrame(columns=["name", "starttime", "endtime"])
-    i = 1
-    for this_block in times['blocks']:
-        this_dict = {
-            "name":"Block " + str(i),
-            "starttime":this_block['times'][0].iso.split()[1][:8],
-            "endtime":this_block['times'][1].iso.split()[1][:8]
-        }
-        this_df = pd.DataFrame(this_dict, index=[0])
-        blocks_df = pd.concat([blocks_df, this_df], join="outer")
-        i += 1
-    blocks_df.to_csv("{0}/blocks.csv".format(args['output']))
+        # optional time sampling settings
+        sampling = {}
+        for key in ["plot_samples", "obs_samples", "adaptive", "refine_window",
+                    "refine_samples"]:
+            if key in night_data:
+                sampling[key] = night_data[key]
     
-    # define targets
-    if args['verbose']:
-        print("----------------------------------")
-        print("---------- target_data -----------")
-        print("----------------------------------")
-        print(target_data)
-        print()
+        times = tools.setup_times(dino_loc,
+                                  night_data['obs_start'],
+                                  night_data['obs_end'],
+                                  block_start_times=bst,
+                                  block_end_times=bet,
+                                  block_colors=bc,
+                                  **sampling)
+    
+        if args['verbose']:
+            print("----------------------------------")
+            print("---------- times -----------")
+            print("----------------------------------")
+            print(times)
+            print()
         
-    print("setting up targets...")
-    targets = tools.setup_target_list(target_data, dino_loc)
+        # define targets
+        if args['verbose']:
+            print("----------------------------------")
+            print("---------- target_data -----------")
+            print("----------------------------------")
+            print(target_data)
+            print()
     
-    if args['verbose']:
-        print("----------------------------------")
-        print("------------ targets -------------")
-        print("----------------------------------")
-        print(targets)
-        print()
+        print("setting up targets...")
+        targets = tools.setup_target_list(target_data, dino_loc)
+    
+        # start the SIMBAD and SkyView lookups now, they run in the background
+        # while the rest of the night is computed
+        lookups = network.start_lookups(targets)
+        finder_config = config_data['finder_images']
+        cutouts = finder_image.start_cutouts(
+            targets, survey=finder_config.get('survey', 'DSS'),
+            fov_radius=finder_config.get('fov_radius', 3.2))
+    
+        if args['verbose']:
+            print("----------------------------------")
+            print("------------ targets -------------")
+            print("----------------------------------")
+            print(targets)
+            print()
         
+        # propagate comets and asteroids locally from their orbital elements
+        try:
+            orbit_config = dict(config_data['orbits'])
+        except:
+            orbit_config = {}
+        if orbit_config.pop('local', True):
+            print("fetching orbital elements...")
+            orbits.setup_orbits(targets, times, dino_loc.location, **orbit_config)
     
-    # create targets.csv, rise_and_set.csv
-    df = pd.DataFrame(columns=["Object", "RA", "DEC", "oType", "spType",
-                               "d", "V", "rise", "set", "lowest_a"])
-    for target in targets:
-        # get target properties
+        # refine the sampling around the rises and sets of the targets
+        for window in times['sampling']['adaptive']:
+            times = tools.refine_times(dino_loc, times, targets, window=window)
+    
+        # moon separations and illumination for the whole night in one pass
+        print("computing moon separations...")
+        moon_obs = tools.moon_grid(dino_loc, targets, times['obs_window'])
+        moon_plot = tools.moon_grid(dino_loc, targets, times['plot_window'])
         try:
-            data = object_stats.simbad_query(target['name'])
+            min_moon_sep = config_data['scheduler']['min_moon_sep']
         except:
+            min_moon_sep = 30.0
+        moon_ok = tools.moon_constraint(moon_obs, min_moon_sep)
+        altaz_plot = tools.altaz_grid(dino_loc, targets, times['plot_window'])
+        altaz_obs = tools.altaz_grid(dino_loc, targets, times['obs_window'])
+    
+        # create targets.csv, rise_and_set.csv
+        df = pd.DataFrame(columns=["Object", "RA", "DEC", "oType", "spType",
+                                   "d", "V", "rise", "set", "lowest_a",
+                                   "moon_sep_min", "bright_star",
+                                   "bright_star_sep"])
+        star_index = catalogs.load_index("stars",
+                                         epoch=Time(night_data['obs_start']))
+        for i in range(0, len(targets)):
+            target = targets[i]
+            # get target properties
             try:
-                data = {"oType":" ",
-                        "spType":" ",
-                        "RA":str(target['target'].ra),
-                        "DEC":str(target['target'].dec),
-                        "d":" ",
-                        "V":" "}
+                data = object_stats.simbad_query(
+                    target['name'], lookups[target['name']]['simbad'].result())
             except:
-                data = {"oType":"non-fixed",
-                        "spType":" ",
-                        "RA":"variable",
-                        "DEC":"variable",
-                        "d":" ",
-                        "V":" "}
+                try:
+                    data = {"oType":" ",
+                            "spType":" ",
+                            "RA":str(target['target'].ra),
+                            "DEC":str(target['target'].dec),
+                            "d":" ",
+                            "V":" "}
+                except:
+                    data = {"oType":"non-fixed",
+                            "spType":" ",
+                            "RA":"variable",
+                            "DEC":"variable",
+                            "d":" ",
+                            "V":" "}
         
-        data['Object'] = target['name']
+            data['Object'] = target['name']
         
         
-        # get rise time
-        try:
-            data['rise'] = dino_loc.target_rise_time(night_data['obs_start'],
-                                                     target['target'],
-                                                     which="nearest").iso.split()[1][:8]
-            #print(dino_loc.target_rise_time(night_data['obs_start'],
-            #                                         target['target'],
-            #                                         which="nearest").scale)
-        except:
-            data['rise'] = "NA"
+            # get rise time
+            try:
+                data['rise'] = dino_loc.target_rise_time(night_data['obs_start'],
+                                                         target['target'],
+                                                         which="nearest").iso.split()[1][:8]
+                #print(dino_loc.target_rise_time(night_data['obs_start'],
+                #                                         target['target'],
+                #                                         which="nearest").scale)
+            except:
+                data['rise'] = "NA"
         
-        # get set time
-        try:
-            data['set'] = dino_loc.target_set_time(night_data['obs_start'],
-                                                   target['target'],
-                                                   which="nearest").iso.split()[1][:8]
-        except:
-            data['set'] = "NA"
+            # get set time
+            try:
+                data['set'] = dino_loc.target_set_time(night_data['obs_start'],
+                                                       target['target'],
+                                                       which="nearest").iso.split()[1][:8]
+            except:
+                data['set'] = "NA"
         
-        # get time of lowest airmass
+            # get time of lowest airmass
         
-        # append it to the dataframe
-        this_df = pd.DataFrame(data, index=[0])
-        df = pd.concat([df, this_df], join="outer")
-        target.update(data)
+            # get the nearest bright star, useful for pointing
+            try:
+                coord = target['target'].coord.icrs
+                star = catalogs.nearest(star_index, coord.ra.deg, coord.dec.deg,
+                                        mag_limit=3.0).iloc[0]
+                data['bright_star'] = catalogs.star_name(star)
+                data['bright_star_sep'] = "{0:.1f}".format(star['sep'])
+            except:
+                data['bright_star'] = "NA"
+                data['bright_star_sep'] = "NA"
         
-    if args['verbose']:
-        print("----------------------------------")
-        print("------------ targets -------------")
-        print("----------------------------------")
-        print(targets)
-        print()
+            # get the closest approach to the moon during the observing window
+            data['moon_sep_min'] = "{0:.1f}".format(moon_obs['sep'][i].min())
+            if not moon_ok[i].all():
+                print("warning: {0} comes within {1} deg of the moon".format(
+                      target['name'], data['moon_sep_min']))
+        
+            # append it to the dataframe
+            this_df = pd.DataFrame(data, index=[0])
+            df = pd.concat([df, this_df], join="outer")
+            target.update(data)
+        
+        if args['verbose']:
+            print("----------------------------------")
+            print("------------ targets -------------")
+            print("----------------------------------")
+            print(targets)
+            print()
 
+    # setup blocks.csv
+    blocks_df = pd.DataFrame(columns=["name", "starttime", "endtime"])
+    i = 1
+    for this_block in times['blocks']:
+        this_dict = {
+            "name":"Block " + str(i),
+            "starttime":this_block['times'][0].iso.split()[1][:8],
+            "endtime":this_block['times'][1].iso.split()[1][:8]
+        }
+        this_df = pd.DataFrame(this_dict, index=[0])
+        blocks_df = pd.concat([blocks_df, this_df], join="outer")
+        i += 1
+    blocks_df.to_csv("{0}/blocks.csv".format(args['output']))
     
     df.to_csv("{}/targets.csv".format(args['output']))
 
+    # schedule the targets into the observing blocks
+    schedule_page = ""
+    try:
+        schedule_config = config_data['scheduler']
+    except:
+        schedule_config = None
+    if schedule_config is not None and args['plan'] is None:
+        print("scheduling targets...")
+        schedule_df = scheduler.schedule(dino_loc, times, targets,
+                                         **schedule_config)
+        schedule_df.to_csv("{}/schedule.csv".format(args['output']))
+        schedule_page = temp_schedule.format()
+
+        if args['verbose']:
+            print("----------------------------------")
+            print("------------ schedule ------------")
+            print("----------------------------------")
+            print(schedule_df)
+            print()
+
+    # compare the targets across several sites
+    sites_page = ""
+    if 'multisite' in config_data and args['plan'] is None:
+        print("comparing sites...")
+        multisite_config = dict(config_data['multisite'])
+        site_data = [night_data] + multisite_config.pop('sites', [])
+        site_observers = multisite.setup_sites(site_data)
+        comparison = multisite.compare_sites(site_observers, targets,
+                                             night_data['obs_start'],
+                                             **multisite_config)
+        labels = multisite.write_reports(
+            comparison, targets,
+            max_airmass=multisite_config.get('max_airmass', 2.0),
+            path=args['output'])
+        sites_page = temp_sites.format()
+        for n in range(0, len(labels)):
+            sites_page += temp_site.format(comparison['sites']['site'][n],
+                                           args['output'], labels[n])
+
+        if args['verbose']:
+            print("----------------------------------")
+            print("------------- sites --------------")
+            print("----------------------------------")
+            print(comparison['comparison'])
+            print()
+
+    # how well placed the targets are over a range of nights
+    observability_page = ""
+    if 'observability' in config_data and args['plan'] is None:
+        print("computing observability...")
+        observability_config = dict(config_data['observability'])
+        start = observability_config.pop('start', night_data['obs_start'])
+        end = observability_config.pop('end', None)
+        if end is None:
+            end = (Time(start) + 364*u.day).iso
+        observability.write_reports(dino_loc, targets, start, end,
+                                    path=args['output'],
+                                    **observability_config)
+        observability_page = temp_observability.format(args['output'],
+                                                       start.split()[0],
+                                                       end.split()[0])
+
+    # sun and moon times for a range of nights
+    almanac_page = ""
+    if 'almanac' in config_data and args['plan'] is None:
+        print("computing almanac...")
+        almanac_config = dict(config_data['almanac'])
+        start = almanac_config.pop('start', night_data['obs_start'])
+        end = almanac_config.pop('end', None)
+        if end is None:
+            end = (Time(start) + 181*u.day).iso
+        do_page = almanac_config.pop('do_page', True)
+        almanac.write_reports(dino_loc, start, end, path=args['output'],
+                              **almanac_config)
+        if do_page:
+            almanac_page = temp_almanac.format()
+
+    # recent ZTF photometry of the targets, from the local cache where possible
+    ztf_page = ""
+    if 'ztf' in config_data and args['plan'] is None:
+        ztf_config = dict(config_data['ztf'])
+        recent_days = ztf_config.pop('recent_days', 30.0)
+        lightcurves = object_stats.ztf_query(targets, **ztf_config)
+        lightcurves.to_csv("{0}/ztf_lightcurves.csv".format(args['output']),
+                           index=False)
+        ztf_df = object_stats.ztf_summary(lightcurves, targets,
+                                          recent_days=recent_days)
+        ztf_df.to_csv("{0}/ztf_summary.csv".format(args['output']),
+                      index=False)
+        ztf_page = temp_ztf.format(recent_days)
+
+        if args['verbose']:
+            print("----------------------------------")
+            print("-------------- ZTF ---------------")
+            print("----------------------------------")
+            print(ztf_df)
+            print()
+
     # create all-sky map
     print("creating plots...")
     print("all sky map")
@@ -290,18 +595,65 @@ if __name__ == "__main__":
     # create local-sky map
     print("local sky map")
     local_sky.plot(dino_loc, times, targets, path=args['output'],
-                   **config_data['local_sky'])
+                   altaz=altaz_obs, moon=moon_obs, **config_data['local_sky'])
+    
+    # optional timelapse animations of the night
+    if 'timelapse' in config_data:
+        timelapse_config = dict(config_data['timelapse'])
+        do_local_sky = timelapse_config.pop('local_sky', True)
+        do_all_sky = timelapse_config.pop('all_sky_map', True)
+        if do_local_sky:
+            print("local sky timelapse")
+            local_config = {key:value for key, value in
+                            config_data['local_sky'].items() if key in
+                            ["do_moon", "do_stars", "do_asterisms",
+                             "mag_limit", "sky_culture", "do_grid",
+                             "az_label_offset"]}
+            timelapse.local_sky_timelapse(dino_loc, times, targets,
+                                          path=args['output'],
+                                          **{**local_config, **timelapse_config})
+        if do_all_sky:
+            print("all sky timelapse")
+            # the all_sky_map section also has settings of the single map,
+            # only the ones the timelapse takes are passed on
+            all_sky_config = {key:value for key, value in
+                              config_data['all_sky_map'].items() if key in
+                              timelapse.BACKGROUND_KEYS + ["do_moon",
+                              "target_marker", "do_target_colors"]}
+            timelapse.all_sky_timelapse(dino_loc, times, targets,
+                                        path=args['output'],
+                                        **{**all_sky_config,
+                                           **timelapse_config})
     
     # create airmass plot
     print("airmass")
     airmass.plot(dino_loc, times, targets, path=args['output'],
-                 **config_data['airmass'])
+                 moon=moon_plot, altaz=altaz_plot, **config_data['airmass'])
     
     # create finder images
-    for target in targets:
-        print("Finder image {0}".format(target['name']))
-        finder_image.plot(target, path=args['output'],
-                          **config_data['finder_images'])
+    print("finder images")
+    if cutouts is not None:
+        hdus = []
+        for cutout in cutouts:
+            try:
+                hdus.append(cutout.result())
+            except:
+                hdus.append(None)
+    finder_image.plot_batch(targets, hdus=hdus, path=args['output'],
+                            epoch=Time(night_data['obs_start']),
+                            **config_data['finder_images'])
+
+    # save the night so the plots and report can be made again from it
+    if args['save_plan'] is not None:
+        print("saving night plan...")
+        nightplan.attach_ephemerides(dino_loc, times, targets)
+        nightplan.save_plan(args['save_plan'], dino_loc, times, targets,
+                            night=night_data,
+                            altaz={"plot_window":altaz_plot,
+                                   "obs_window":altaz_obs},
+                            moon={"plot_window":moon_plot,
+                                  "obs_window":moon_obs},
+                            hdus=hdus)
 
     finder_charts = ""
     for target in targets:
@@ -346,6 +698,11 @@ if __name__ == "__main__":
                                       night_data['telescope_name'])
         file_data = file_data.replace("%FINDERCHARTS", finder_charts)
         file_data = file_data.replace("%THENIGHT", night_page)
+        file_data = file_data.replace("%SCHEDULE", schedule_page)
+        file_data = file_data.replace("%MULTISITE", sites_page)
+        file_data = file_data.replace("%OBSERVABILITY", observability_page)
+        file_data = file_data.replace("%ALMANAC", almanac_page)
+        file_data = file_data.replace("%PHOTOMETRY", ztf_page)
         file_data = file_data.replace("OUTPUTDIRECTORY", args['output'])
   
     # generate the name of the new tex file
@@ -1,13 +1,62 @@
-import matplotlib.pyplot as plt
+import io
+import concurrent.futures
+
+import numpy as np
+from scipy.spatial import cKDTree
 from astroquery.skyview import SkyView
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 from astropy.wcs import WCS
+from astropy.io import fits
+from astropy.nddata import Cutout2D
+from PIL import Image
+
+import dino_tools as tools
+import catalogs
+import network
+
+def _plot_catalog_objects(ax, coord, fov_radius, color="xkcd:red",
+                          epoch=None):
+    """
+    Marks and labels the catalog stars and deep-sky objects in the field of a
+    finder chart, found with cone queries on the catalog indexes, with the
+    stars moved to epoch if it is given.
+    Returns the artists it added.
+    """
+    radius = fov_radius.to_value(u.deg)*np.sqrt(2)
+    stars = catalogs.cone_query(catalogs.load_index("stars", epoch=epoch),
+                                coord.ra.deg, coord.dec.deg, radius)
+    deep_sky = catalogs.cone_query(catalogs.load_index("deep_sky"),
+                                   coord.ra.deg, coord.dec.deg, radius)
+    names = [catalogs.star_name(row) for index, row in stars.iterrows()] + \
+            list(deep_sky['name'])
+    ras = np.concatenate([stars['ra_deg'], deep_sky['ra_deg']])
+    decs = np.concatenate([stars['dec_deg'], deep_sky['dec_deg']])
+
+    # keep the view on the image, the corners of the cone stick out of it
+    xlim, ylim = ax.get_xlim(), ax.get_ylim()
+    transform = ax.get_transform('icrs')
+    artists = [ax.scatter(ras, decs, transform=transform, s=300,
+                          facecolors='none', edgecolors=color,
+                          linewidths=1.5)]
+    for i in range(0, len(names)):
+        artists.append(ax.text(ras[i], decs[i], "  " + names[i],
+                               transform=transform, color=color, fontsize=10,
+                               clip_on=True))
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    return artists
+
+def _finder_name(target_name):
+    return 'finder_{0}.jpg'.format(target_name.replace(" ", "").replace(".", "_"))
+
+def _finder_path(path, target_name):
+    return '{0}/{1}'.format(path, _finder_name(target_name))
 
 def plot(this_target, survey='DSS', fov_radius=3.2,
          log=False, ax=None, grid=False, reticle=True,
          style_kwargs=None, reticle_style_kwargs=None,
-         path="./report_plots"):
+         path="./report_plots", do_catalog=False, hdu=None, epoch=None):
     """
     Very heavily inspired (copied) from astroplan
     Plot survey image centered on ``target``.
@@ -39,7 +88,7 @@ def plot(this_target, survey='DSS', fov_radius=3.2,
 
     ax : `~matplotlib.axes.Axes` or None, optional.
         The `~matplotlib.axes.Axes` object to be drawn on.
-        If None, uses the current `~matplotlib.axes.Axes`.
+        If None, a new figure is made for the chart.
 
     grid : bool, optional.
         Grid is drawn if `True`. `False` by default.
@@ -55,6 +104,19 @@ def plot(this_target, survey='DSS', fov_radius=3.2,
         A dictionary of keywords passed into `~matplotlib.pyplot.axvline` and
         `~matplotlib.pyplot.axhline` to set reticle style.
 
+    do_catalog : bool, optional
+        Mark the catalog stars and deep-sky objects in the field if `True`.
+        `False` by default.
+
+    hdu : `~astropy.io.fits.PrimaryHDU` or None, optional
+        An already downloaded survey image, e.g. from
+        ``network.start_lookups``. If None, the image is downloaded here.
+
+    epoch : `~astropy.time.Time`, float or None, optional
+        The epoch the catalog stars are moved to along their proper motions,
+        usually the night, see ``catalogs.load_index``. If None, the catalog
+        positions are used.
+
     Returns
     -------
     ax : `~matplotlib.axes.Axes`
@@ -63,6 +125,9 @@ def plot(this_target, survey='DSS', fov_radius=3.2,
     hdu : `~astropy.io.fits.PrimaryHDU`
         FITS HDU of the retrieved image
 
+    If ``path`` is None nothing is written, and an `io.BytesIO` of the chart
+    is returned instead of ``ax``.
+
 
     Notes
     -----
@@ -71,19 +136,25 @@ def plot(this_target, survey='DSS', fov_radius=3.2,
     """
     fov_radius = fov_radius*u.arcmin
     target = this_target['target']
-    try:
-        coord = target if not hasattr(target, 'coord') else target.coord
+    coord = target if not hasattr(target, 'coord') else target.coord
+    if coord is None:
+        print("Finding chart failed, target has no coord object. Maybe the target is a solar system object?")
+    else:
         position = coord.icrs
-        coordinates = 'icrs'
         target_name = None if isinstance(target, SkyCoord) else target.name
-        hdu = SkyView.get_images(position=position, coordinates=coordinates,
-                             survey=survey, radius=fov_radius, grid=grid)[0][0]
-        wcs = WCS(hdu.header)
-    except:
-        print("Finding chart failed, target has no coord object. Maybe the target is a solar system object?")
+        if hdu is None:
+            try:
+                # grid is only for ax.grid, SkyView does not take it
+                hdu = network.run(network.skyview_image(position, survey,
+                                                        fov_radius,
+                                                        coordinates='icrs'))
+            except Exception as e:
+                print("Finding chart failed, the SkyView download for {0} "
+                      "did not work: {1}".format(this_target['name'], e))
+    if hdu is None:
         target_name = this_target['name']
         if ax is None:
-            ax = plt.gcf().add_subplot()
+            ax = tools.new_figure().add_subplot()
         if style_kwargs is None:
             style_kwargs = {}
         style_kwargs = dict(style_kwargs)
@@ -97,16 +168,17 @@ def plot(this_target, survey='DSS', fov_radius=3.2,
 
         # Redraw the figure for interactive sessions.
         ax.figure.canvas.draw()
-        plt.savefig('{0}/finder_{1}.jpg'.format(path, target_name.replace(" ", "").replace(".", "_")),
-                    edgecolor='none', bbox_inches='tight')
-        plt.close()
+        image = tools.save_figure(ax.figure, path, _finder_name(target_name),
+                                  edgecolor='none', bbox_inches='tight')
+        if path is None:
+            return image, None
         return ax, None
 
-    
+    wcs = WCS(hdu.header)
 
     # Set up axes & plot styles if needed.
     if ax is None:
-        ax = plt.gcf().add_subplot(projection=wcs)
+        ax = tools.new_figure().add_subplot(projection=wcs)
     if style_kwargs is None:
         style_kwargs = {}
     style_kwargs = dict(style_kwargs)
@@ -126,6 +198,7 @@ def plot(this_target, survey='DSS', fov_radius=3.2,
 
         if reticle_style_kwargs is None:
             reticle_style_kwargs = {}
+        reticle_style_kwargs = dict(reticle_style_kwargs)
         reticle_style_kwargs.setdefault('linewidth', 2)
         reticle_style_kwargs.setdefault('color', this_target['color'])
 
@@ -138,6 +211,10 @@ def plot(this_target, survey='DSS', fov_radius=3.2,
         ax.axhline(y=0.5*pixel_width, xmin=0.5-inner, xmax=0.5-outer,
                    **reticle_style_kwargs)
 
+    # Mark the known objects in the field
+    if do_catalog:
+        _plot_catalog_objects(ax, position, fov_radius, epoch=epoch)
+
     # Labels, title, grid
     ax.set(xlabel='RA', ylabel='DEC')
     if target_name is not None:
@@ -146,7 +223,326 @@ def plot(this_target, survey='DSS', fov_radius=3.2,
 
     # Redraw the figure for interactive sessions.
     ax.figure.canvas.draw()
-    plt.savefig('{0}/finder_{1}.jpg'.format(path, target_name.replace(" ", "").replace(".", "_")),
-                edgecolor='none', bbox_inches='tight')
-    plt.close()
-    return ax, hdu
\ No newline at end of file
+    image = tools.save_figure(ax.figure, path, _finder_name(target_name),
+                              edgecolor='none', bbox_inches='tight')
+    if path is None:
+        return image, hdu
+    return ax, hdu
+
+def plan_cutouts(coords, fov_radius=3.2, pixels=300, max_pixels=2000,
+                 max_separation=None):
+    """
+    Groups targets that are close together on the sky, so that one survey
+    image can be downloaded for the whole group and the finder charts cut out
+    of it.
+
+    Parameters
+    -----------
+
+    coords : list of SkyCoord or None
+        The coordinates of the targets. None (e.g. for solar-system targets)
+        are left out.
+
+    fov_radius : float
+        The radius of the finder charts in arcmin.
+        Defaults to 3.2.
+
+    pixels : int
+        The number of pixels across a single finder chart, which sets the
+        resolution every cutout keeps. SkyView uses 300 unless told otherwise.
+        Defaults to 300.
+
+    max_pixels : int
+        The largest image that may be downloaded for a group.
+        Defaults to 2000.
+
+    max_separation : float or None
+        How far, in arcmin, a target may be from the first target of its
+        group. If None, as far as max_pixels allows.
+
+    Groups are grown around the targets with the most neighbours first.
+    Returns a list of groups, dicts with the indices of the 'members', the
+    'center' as a SkyCoord, the 'radius' of the group image in arcmin and the
+    number of 'pixels' across it. Groups of one target have pixels None.
+    """
+    if max_separation is None:
+        # the center can be up to max_separation from the members
+        max_separation = fov_radius*(max_pixels/pixels - 1)/2
+    indices = [i for i in range(0, len(coords)) if coords[i] is not None]
+    if len(indices) == 0:
+        return []
+    ras = np.array([coords[i].icrs.ra.deg for i in indices])
+    decs = np.array([coords[i].icrs.dec.deg for i in indices])
+    vectors = catalogs._unit_vectors(ras, decs)
+    tree = cKDTree(vectors)
+    neighbours = tree.query_ball_point(vectors,
+                                       catalogs._chord(max_separation/60))
+
+    groups = []
+    assigned = np.zeros(len(indices), dtype=bool)
+    for seed in np.argsort([-len(n) for n in neighbours], kind='stable'):
+        if assigned[seed]:
+            continue
+        members = [k for k in neighbours[seed] if not assigned[k]]
+        assigned[members] = True
+        center = vectors[members].mean(axis=0)
+        center = center/np.linalg.norm(center)
+        center_coord = SkyCoord(
+            ra=np.degrees(np.arctan2(center[1], center[0])) % 360*u.deg,
+            dec=np.degrees(np.arcsin(center[2]))*u.deg)
+        if len(members) == 1:
+            radius = fov_radius
+            n_pixels = None
+            center_coord = coords[indices[members[0]]].icrs
+        else:
+            separation = np.degrees(np.arccos(np.clip(
+                vectors[members] @ center, -1, 1))).max()*60
+            radius = separation + fov_radius
+            n_pixels = int(np.ceil(pixels*radius/fov_radius))
+        groups.append({"members":sorted(indices[k] for k in members),
+                       "center":center_coord, "radius":radius,
+                       "pixels":n_pixels})
+    return groups
+
+def _crop(hdu, coord, fov_radius):
+    """
+    Cuts the finder chart of one target out of a group image, with the WCS
+    of the cutout.
+    """
+    cutout = Cutout2D(hdu.data, position=coord,
+                      size=2*fov_radius*u.arcmin, wcs=WCS(hdu.header))
+    return fits.PrimaryHDU(data=cutout.data, header=cutout.wcs.to_header())
+
+def start_cutouts(targets, survey='DSS', fov_radius=3.2, **plan_kwargs):
+    """
+    Starts the survey image downloads for the finder charts of all targets,
+    one download per group of targets from plan_cutouts.
+
+    Returns a list with a concurrent.futures.Future for the image HDU of each
+    target, in the order of the targets, or None for targets without
+    coordinates.
+    """
+    coords = []
+    for target in targets:
+        if target['target'] is None:
+            coords.append(None)
+        else:
+            coords.append(target['target'].coord.icrs)
+    futures = [None]*len(targets)
+    for group in plan_cutouts(coords, fov_radius=fov_radius, **plan_kwargs):
+        kwargs = {}
+        if group['pixels'] is not None:
+            kwargs['pixels'] = str(group['pixels'])
+        group_future = network.submit(network.skyview_image(
+            group['center'], survey, group['radius']*u.arcmin, **kwargs))
+        members = {i:concurrent.futures.Future() for i in group['members']}
+        for i in members:
+            futures[i] = members[i]
+
+        def crop_group(group_future, group=group, members=members):
+            for i in members:
+                try:
+                    hdu = group_future.result()
+                    if group['pixels'] is not None:
+                        hdu = _crop(hdu, coords[i], fov_radius)
+                    members[i].set_result(hdu)
+                except Exception as e:
+                    members[i].set_exception(e)
+        group_future.add_done_callback(crop_group)
+    return futures
+
+def plot_batch(targets, hdus=None, survey='DSS', fov_radius=3.2, log=False,
+               grid=False, reticle=True, style_kwargs=None,
+               reticle_style_kwargs=None, path="./report_plots",
+               do_catalog=False, sheet=False, sheet_columns=3, sheet_rows=4,
+               epoch=None):
+    """
+    Renders the finder charts of many targets with one figure.
+
+    The figure, WCS axes, image and reticle are created once. For every
+    target only the image data, the WCS, the reticle color, the title and the
+    catalog markers are swapped before the chart is saved, so a long target
+    list does not pay for setting up and tearing down a figure per chart.
+
+    Parameters
+    -----------
+
+    targets : list of dicts
+        The targets from dino_tools.setup_target_list.
+
+    hdus : list or None
+        Already downloaded survey images, one per target, e.g. from
+        start_cutouts. Missing images (None) are downloaded, all at once and
+        shared between targets that are close together, see start_cutouts.
+
+    sheet : bool
+        Also put the charts together on sheets of sheet_columns by sheet_rows
+        charts, saved as finder_sheet_1.jpg, finder_sheet_2.jpg, ...
+        Defaults to False.
+
+    The other parameters are the same as for plot. Targets without an image,
+    like solar-system objects, are handed to plot.
+
+    Returns the paths of the charts, in the order of the targets, and, if
+    sheet is True, also the paths of the sheets, as (charts, sheets). If
+    path is None nothing is written, and io.BytesIO buffers of the JPEGs are
+    returned instead of paths.
+    """
+    if hdus is None:
+        hdus = [None]*len(targets)
+    hdus = list(hdus)
+    fov_radius = fov_radius*u.arcmin
+    if style_kwargs is None:
+        style_kwargs = {}
+    style_kwargs = dict(style_kwargs)
+    style_kwargs.setdefault('cmap', 'Greys')
+    style_kwargs.setdefault('origin', 'lower')
+    if reticle_style_kwargs is None:
+        reticle_style_kwargs = {}
+    reticle_style_kwargs = dict(reticle_style_kwargs)
+    reticle_style_kwargs.setdefault('linewidth', 2)
+
+    # download the missing images concurrently
+    missing = [i for i in range(0, len(targets)) if hdus[i] is None
+               and targets[i]['target'] is not None]
+    futures = start_cutouts([targets[i] for i in missing], survey=survey,
+                            fov_radius=fov_radius.to_value(u.arcmin))
+    for k in range(0, len(missing)):
+        try:
+            hdus[missing[k]] = futures[k].result()
+        except:
+            hdus[missing[k]] = None
+
+    fig = None
+    charts = []
+    for i in range(0, len(targets)):
+        this_target = targets[i]
+        if hdus[i] is None:
+            chart = plot(this_target, survey=survey,
+                         fov_radius=fov_radius.to_value(u.arcmin), log=log,
+                         grid=grid, reticle=reticle,
+                         style_kwargs=dict(style_kwargs),
+                         reticle_style_kwargs=dict(reticle_style_kwargs),
+                         path=path, do_catalog=do_catalog, epoch=epoch)[0]
+            if path is not None:
+                chart = _finder_path(path, this_target['name'])
+            charts.append(chart)
+            continue
+
+        wcs = WCS(hdus[i].header)
+        if log:
+            image_data = np.log(hdus[i].data)
+        else:
+            image_data = hdus[i].data
+        ny, nx = image_data.shape
+
+        if fig is None:
+            # build the template on the first image
+            fig = tools.new_figure()
+            ax = fig.add_subplot(projection=wcs)
+            image = ax.imshow(image_data, **style_kwargs)
+            inner, outer = 0.03, 0.08
+            reticle_lines = []
+            if reticle:
+                for x, y in [([0.5, 0.5], [0.5+inner, 0.5+outer]),
+                             ([0.5, 0.5], [0.5-inner, 0.5-outer]),
+                             ([0.5+inner, 0.5+outer], [0.5, 0.5]),
+                             ([0.5-inner, 0.5-outer], [0.5, 0.5])]:
+                    reticle_lines += ax.plot(x, y, transform=ax.transAxes,
+                                             **reticle_style_kwargs)
+            catalog_artists = []
+        else:
+            ax.reset_wcs(wcs)
+            image.set_data(image_data)
+            image.autoscale()
+        image.set_extent((-0.5, nx - 0.5, -0.5, ny - 0.5))
+        ax.set_xlim(-0.5, nx - 0.5)
+        ax.set_ylim(-0.5, ny - 0.5)
+
+        for line in reticle_lines:
+            line.set_color(reticle_style_kwargs.get('color',
+                                                    this_target['color']))
+
+        for artist in catalog_artists:
+            artist.remove()
+        catalog_artists = []
+        if do_catalog:
+            catalog_artists = _plot_catalog_objects(
+                ax, this_target['target'].coord.icrs, fov_radius, epoch=epoch)
+
+        # the WCS axes make new coordinate helpers on reset_wcs
+        ax.set(xlabel='RA', ylabel='DEC')
+        ax.set_title(this_target['target'].name)
+        ax.grid(grid)
+
+        charts.append(_save_tight(fig, path,
+                                  _finder_name(this_target['target'].name)))
+
+    if sheet:
+        return charts, _save_sheets(charts, path, sheet_columns, sheet_rows)
+    return charts
+
+def _save_image(image, path, filename, **kwargs):
+    """
+    Saves a PIL image as path/filename, or, if path is None, as a JPEG into
+    an in-memory buffer, like dino_tools.save_figure.
+
+    Returns the path of the file, or the io.BytesIO buffer, rewound.
+    """
+    if path is None:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", **kwargs)
+        buffer.seek(0)
+        return buffer
+    this_path = "{0}/{1}".format(path, filename)
+    image.save(this_path, **kwargs)
+    return this_path
+
+def _save_tight(fig, path, filename, pad_inches=0.1):
+    """
+    Draws the figure once and saves the canvas cropped to its tight bounding
+    box. savefig with bbox_inches='tight' draws the figure twice, once to
+    measure it and once to save it.
+
+    Returns the path or buffer from _save_image.
+    """
+    fig.canvas.draw()
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(pad_inches)
+    image = Image.fromarray(np.asarray(fig.canvas.buffer_rgba()))
+    dpi = fig.dpi
+    width, height = image.size
+    crop = (max(int(np.floor(bbox.x0*dpi)), 0),
+            max(int(np.floor(height - bbox.y1*dpi)), 0),
+            min(int(np.ceil(bbox.x1*dpi)), width),
+            min(int(np.ceil(height - bbox.y0*dpi)), height))
+    return _save_image(image.crop(crop).convert("RGB"), path, filename,
+                       dpi=(dpi, dpi))
+
+def _save_sheets(charts, path, columns=3, rows=4):
+    """
+    Puts saved finder charts, paths or buffers, together on sheets of
+    columns by rows charts, without going through matplotlib again.
+
+    Returns the paths or buffers of the sheets.
+    """
+    images = []
+    for chart in charts:
+        images.append(Image.open(chart).convert("RGB"))
+        if hasattr(chart, 'seek'):
+            chart.seek(0)
+    width = max(image.size[0] for image in images)
+    height = max(image.size[1] for image in images)
+    per_sheet = columns*rows
+    sheets = []
+    for n in range(0, int(np.ceil(len(images)/per_sheet))):
+        these = images[n*per_sheet:(n+1)*per_sheet]
+        n_rows = int(np.ceil(len(these)/columns))
+        sheet = Image.new("RGB", (columns*width, n_rows*height), "white")
+        for k in range(0, len(these)):
+            # center each chart in its cell
+            x = (k % columns)*width + (width - these[k].size[0])//2
+            y = (k//columns)*height + (height - these[k].size[1])//2
+            sheet.paste(these[k], (x, y))
+        sheets.append(_save_image(sheet, path,
+                                  "finder_sheet_{0}.jpg".format(n + 1)))
+    return sheets
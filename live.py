@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+import astropy.units as u
+from astropy.time import Time
+import cartopy.crs as ccrs
+
+import matplotlib.pyplot as plt
+
+import dino_tools as tools
+import all_sky_map
+import timelapse
+import nightplan
+import orbits
+import network
+
+# the local_sky and all_sky_map settings of the input file the views accept
+LOCAL_SKY_KEYS = ["do_moon", "do_stars", "do_asterisms", "mag_limit",
+                  "sky_culture", "do_grid", "az_label_offset"]
+ALL_SKY_KEYS = timelapse.BACKGROUND_KEYS + ["do_moon", "target_marker",
+                                            "do_target_colors"]
+
+def _local_sky_view(observer, targets, now, do_moon=True, do_stars=True,
+                    do_asterisms=True, mag_limit=4.0, sky_culture="rey",
+                    do_grid=True, az_label_offset=0.0, dpi=100,
+                    pyplot=False):
+    """
+    Builds the local-sky view with the figure from the local-sky timelapse,
+    for one frame at the time now. With pyplot the figure gets a window.
+    """
+    def compute(t):
+        return timelapse._local_sky_data(observer, t.reshape((1,)), targets,
+                                         do_moon=do_moon, do_stars=do_stars,
+                                         do_asterisms=do_asterisms,
+                                         mag_limit=mag_limit,
+                                         sky_culture=sky_culture)
+    static, frames = compute(now)
+    fig, update, sky = timelapse._setup_local_sky(
+        static, frames, do_grid=do_grid, az_label_offset=az_label_offset,
+        trails=False, dpi=dpi, pyplot=pyplot)
+    return {"name":"local_sky", "compute":compute, "static":static,
+            "frames":frames, "fig":fig, "update":update}
+
+def _all_sky_view(observer, targets, now, do_moon=True,
+                  projection=ccrs.Mollweide(), target_marker="*",
+                  do_target_colors=True, dpi=40, pyplot=False,
+                  **background_kwargs):
+    """
+    Builds the all-sky view with the figure from the all-sky timelapse, for
+    one frame at the time now. The cached sky background is put under the
+    overlay once, so it is part of the static image. With pyplot the figure
+    gets a window.
+    """
+    background_kwargs.setdefault('epoch', now)
+    background = all_sky_map.render_background(projection=projection,
+                                               **background_kwargs)
+    def compute(t):
+        return timelapse._all_sky_data(observer, t.reshape((1,)), targets,
+                                       do_moon=do_moon)
+    static, frames = compute(now)
+    fig, update, sky = timelapse._setup_all_sky(
+        static, frames, background, projection=projection,
+        target_marker=target_marker, do_target_colors=do_target_colors,
+        dpi=dpi, pyplot=pyplot)
+    fig.figimage(np.asarray(sky), zorder=-1)
+    return {"name":"all_sky_map", "compute":compute, "static":static,
+            "frames":frames, "fig":fig, "update":update}
+
+def _draw(view, path=None):
+    """
+    Puts the static image of a view back, draws its moving artists on top and
+    shows the result, or saves it as path/live_<view>.png if path is given.
+    The file is replaced in one step, so a screen reading it never sees half
+    a frame.
+    """
+    fig = view['fig']
+    fig.canvas.restore_region(view['background'])
+    for artist in view['update'](0):
+        fig.draw_artist(artist)
+    if path is None:
+        fig.canvas.blit(fig.bbox)
+        fig.canvas.flush_events()
+    else:
+        this_path = "{0}/live_{1}.png".format(path, view['name'])
+        image = Image.fromarray(np.asarray(fig.canvas.buffer_rgba()))
+        image.convert("RGB").save(this_path + ".tmp", format="png",
+                                  compress_level=1)
+        os.replace(this_path + ".tmp", this_path)
+
+def _ensure_ephemerides(observer, targets, now, hours, step=10.0):
+    """
+    Makes sure the targets that come from Horizons have an ephemeris covering
+    now, downloading one for the next hours hours if not, so the live views
+    do not query Horizons on every refresh. Ephemerides that end before now
+    or start after it, e.g. from the night plan of tonight viewed during the
+    day, are replaced.
+    """
+    for target in targets:
+        ephemeris = target.get('ephemeris')
+        if ephemeris is not None and not (ephemeris['jd'][0] <= now.jd
+                                          <= ephemeris['jd'][-1]):
+            del target['ephemeris']
+    window = Time([now.jd, now.jd + hours/24], format='jd')
+    nightplan.attach_ephemerides(observer, {"plot_window":window,
+                                            "obs_window":window},
+                                 targets, step=step)
+
+def run(observer, targets, views=("local_sky", "all_sky_map"), refresh=60.0,
+        path=None, n_updates=None, hours=12.0, local_sky_kwargs=None,
+        all_sky_kwargs=None, backend="TkAgg"):
+    """
+    Keeps the local-sky and all-sky views of the current time up, refreshing
+    them every refresh seconds.
+
+    The figures, the sky background and the targets are set up once. On
+    every refresh only the time-dependent parts are computed again (the
+    altitudes and azimuths of the targets, stars and moon, the horizon and
+    the positions of non-fixed targets), and only the moving artists are
+    redrawn over the saved static image of each figure, the same way the
+    timelapse frames are made.
+
+    Parameters
+    -----------
+
+    observer : astroplan.Observer
+        The observer, from dino_tools.setup_location.
+
+    targets : list of dicts
+        The targets from dino_tools.setup_target_list.
+
+    views : list of str
+        "local_sky" and/or "all_sky_map".
+        Defaults to both.
+
+    refresh : float
+        Seconds between refreshes.
+        Defaults to 60.0.
+
+    path : str or None
+        If given, the views are written to path/live_local_sky.png and
+        path/live_all_sky_map.png on every refresh instead of being shown,
+        e.g. for a browser on the dome screen.
+        Defaults to None.
+
+    n_updates : int or None
+        Stop after this many refreshes. If None, run until interrupted.
+
+    hours : float
+        How far ahead the ephemerides of targets from Horizons are
+        downloaded at a time.
+        Defaults to 12.0.
+
+    local_sky_kwargs, all_sky_kwargs : dict or None
+        Settings of the views, see LOCAL_SKY_KEYS and ALL_SKY_KEYS, plus
+        'dpi'.
+
+    backend : str
+        The matplotlib backend of the windows, if path is None.
+        Defaults to "TkAgg".
+    """
+    if type(targets) != list:
+        targets = [targets]
+    if local_sky_kwargs is None:
+        local_sky_kwargs = {}
+    if all_sky_kwargs is None:
+        all_sky_kwargs = {}
+    if path is None:
+        plt.switch_backend(backend)
+        plt.ion()
+    elif not os.path.exists(path):
+        os.makedirs(path)
+
+    now = Time.now()
+    _ensure_ephemerides(observer, targets, now, hours)
+    setup = []
+    if "local_sky" in views:
+        setup.append(_local_sky_view(observer, targets, now,
+                                     pyplot=path is None,
+                                     **local_sky_kwargs))
+    if "all_sky_map" in views:
+        setup.append(_all_sky_view(observer, targets, now,
+                                   pyplot=path is None,
+                                   **dict(all_sky_kwargs)))
+    for view in setup:
+        if path is None:
+            view['fig'].show()
+        view['fig'].canvas.draw()
+        view['background'] = view['fig'].canvas.copy_from_bbox(
+            view['fig'].bbox)
+        _draw(view, path)
+
+    n = 1
+    while n_updates is None or n < n_updates:
+        wait = refresh - (Time.now() - now).to_value(u.s)
+        if path is None:
+            plt.pause(max(wait, 0.01))
+            if not any(plt.fignum_exists(view['fig'].number)
+                       for view in setup):
+                break
+        else:
+            time.sleep(max(wait, 0.0))
+        now = Time.now()
+        _ensure_ephemerides(observer, targets, now, hours)
+        for view in setup:
+            static, frames = view['compute'](now)
+            view['static'].update(static)
+            view['frames'].update(frames)
+            _draw(view, path)
+        n += 1
+
+    if path is None:
+        for view in setup:
+            plt.close(view['fig'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Show the sky above the observer right now",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-i", "--input", help="input path")
+    parser.add_argument("-o", "--output",
+                        help="write the views to this directory instead of "
+                             "showing them")
+    parser.add_argument("--plan", help="take the observer and targets from "
+                                       "this night plan")
+    parser.add_argument("--refresh", type=float, default=None,
+                        help="seconds between refreshes")
+    parser.add_argument("--views", nargs="+", default=None,
+                        choices=["local_sky", "all_sky_map"],
+                        help="the views to show")
+    parser.add_argument("--updates", type=int, default=None,
+                        help="stop after this many refreshes")
+    args = vars(parser.parse_args())
+
+    with open(args['input']) as f:
+        data = json.load(f)
+    night_data = data['Night']
+    config_data = data['Config']
+    if 'network' in config_data:
+        network.configure(**config_data['network'])
+    if 'body_cache' in config_data:
+        tools.configure_body_cache(**config_data['body_cache'])
+    try:
+        live_config = dict(config_data['live'])
+    except:
+        live_config = {}
+    if args['refresh'] is not None:
+        live_config['refresh'] = args['refresh']
+    if args['views'] is not None:
+        live_config['views'] = args['views']
+
+    if args['plan'] is not None:
+        plan = nightplan.load_plan(args['plan'])
+        observer = plan['observer']
+        targets = plan['targets']
+    else:
+        observer = tools.setup_location(night_data['telescope_name'],
+                                        night_data['observer_lat'],
+                                        night_data['observer_long'],
+                                        night_data['observer_elevation'],
+                                        night_data['observer_timezone'])
+        print("setting up targets...")
+        targets = tools.setup_target_list(data['Targets'], observer)
+        try:
+            orbit_config = dict(config_data['orbits'])
+        except:
+            orbit_config = {}
+        if orbit_config.pop('local', True):
+            window = Time.now() + np.linspace(
+                0, live_config.get('hours', 12.0), 3)*u.hour
+            orbits.setup_orbits(targets, {"obs_window":window},
+                                observer.location, **orbit_config)
+
+    local_sky_kwargs = {key:value for key, value in
+                        config_data.get('local_sky', {}).items()
+                        if key in LOCAL_SKY_KEYS}
+    all_sky_kwargs = {key:value for key, value in
+                      config_data.get('all_sky_map', {}).items()
+                      if key in ALL_SKY_KEYS}
+    for key, kwargs in [("local_sky_dpi", local_sky_kwargs),
+                        ("all_sky_dpi", all_sky_kwargs)]:
+        if key in live_config:
+            kwargs['dpi'] = live_config.pop(key)
+
+    print("running, stop with ctrl-c")
+    try:
+        run(observer, targets, path=args['output'], n_updates=args['updates'],
+            local_sky_kwargs=local_sky_kwargs, all_sky_kwargs=all_sky_kwargs,
+            **live_config)
+    except KeyboardInterrupt:
+        sys.exit(0)
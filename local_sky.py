@@ -1,74 +1,98 @@
 import astropy.units as u
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
+from seaborn import desaturate
 import dino_tools as tools
+import catalogs
 from astroplan import Observer
 from astroplan import FixedTarget
 import astropy
+from astropy.time import Time
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import AltAz
 
-def plot(observer, times, targets, do_moon=False, do_grid=True,
-             az_label_offset=0.0*u.deg, path="./report_plots"):
-    """
-    can take a single time or multiple
+def star_altaz(observer, times, mag_limit=4.0, do_asterisms=True,
+               sky_culture="rey"):
     """
-    #plt.rcParams["figure.figsize"] = (15, 15)
-    fig, ax = plt.subplots(ncols=1, subplot_kw={'projection':'polar'})
-    #ax = plt.subplot(121, projection='polar')
-    #fig, ax = plt.subplots(1, 1)
-    ax.set_rlim(90, 0)
-    #ax.set_rticks([30, 60, 90])
-    ax.set_theta_zero_location('N')
-    
-    if type(targets) != list:
-        target_list = [targets]
-    else:
-        target_list = targets
+    Transforms the bright stars, and the ends of the asterism lines, to
+    altitude and azimuth at all the given times in one vectorized
+    transformation. Stars are culled by magnitude before the transformation,
+    and moved along their proper motions to the year of the first time.
 
-    try:
-        iter(times['obs_window'])
-        time_list = times['obs_window']
-    except:
-        time_list = [times['obs_window']]
-        
-    for i in range(0, len(target_list)):
-        target = target_list[i]['target']
-        az = []
-        alt = []
-        for time in time_list:
-            if target_list[i]['type'] != "fixed":
-                target, marker = tools._setup_non_fixed_target(target_list[i],
-                                                            time,
-                                                            observer.location)
-            altitude = (observer.altaz(time, target).alt) * (1/u.deg)
-            azimuth = observer.altaz(time, target).az * (1/u.deg) * \
-                      (np.pi/180.0)
-
-            alt.append(altitude)
-            az.append(azimuth)
+    Returns a dict with (n_stars, n_times) 'alt' and 'az' arrays in degrees,
+    the 'mag' and 'color' of the stars, and if do_asterisms is True the
+    (n_segments, n_times) 'alt1', 'az1', 'alt2', 'az2' arrays of the asterism
+    line ends of sky_culture, see catalogs.load_asterism_segments.
+    """
+    times = Time(times)
+    if times.isscalar:
+        times = times.reshape((1,))
 
-        color = target_list[i]['color']
+    index = catalogs.load_index("stars", epoch=times[0])
+    bright = (index['mag'] < mag_limit) & \
+             (index['data']['color'].to_numpy() != '#000000')
+    ra = index['ra'][bright]
+    dec = index['dec'][bright]
+    n_stars = len(ra)
+    if do_asterisms:
+        segments = catalogs.load_asterism_segments(sky_culture)
+        ra = np.concatenate([ra, segments['ra1'], segments['ra2']])
+        dec = np.concatenate([dec, segments['dec1'], segments['dec2']])
 
-        ax.scatter(az, alt, marker='o', facecolors='none', edgecolors=color)
-        ax.plot(az[0], alt[0], marker='o', label=target.name, color=color,
-                linestyle='none')
+    coords = SkyCoord(ra=ra[:, np.newaxis]*u.deg, dec=dec[:, np.newaxis]*u.deg)
+    altaz = coords.transform_to(AltAz(obstime=times,
+                                      location=observer.location))
+    alt = altaz.alt.deg
+    az = altaz.az.deg
 
-    if do_moon:
-        alt = []
-        az = []
-        for time in time_list:
-            moon = FixedTarget(name="Moon",
-                               coord=astropy.coordinates.get_moon(time))
-            altitude = (observer.altaz(time, moon).alt) * (1/u.deg)
-            azimuth = observer.altaz(time, moon).az * (1/u.deg) * (np.pi/180.0)
+    stars = {"alt":alt[:n_stars], "az":az[:n_stars],
+             "mag":index['mag'][bright],
+             "color":index['data']['color'].to_numpy()[bright]}
+    if do_asterisms:
+        n_segments = len(segments['ra1'])
+        stars['alt1'] = alt[n_stars:n_stars + n_segments]
+        stars['az1'] = az[n_stars:n_stars + n_segments]
+        stars['alt2'] = alt[n_stars + n_segments:]
+        stars['az2'] = az[n_stars + n_segments:]
+    return stars
 
-            alt.append(altitude)
-            az.append(azimuth)
+def _star_style(stars):
+    """
+    Returns the marker sizes and RGBA colors of the stars from star_altaz.
+    """
+    size = 20*np.exp(-(1.44 + stars['mag'])/4)
+    rgba = to_rgba_array([desaturate(c, 0.75) for c in stars['color']])
+    rgba[:, 3] = np.minimum(1, 0.6 - np.arctan((stars['mag'] - 4)/5)/np.pi)
+    return size, rgba
 
-        ax.scatter(az, alt, marker='o', facecolors='none',
-                   edgecolors="xkcd:grey")
-        ax.plot(az[0], alt[0], marker='o', label=moon.name, color="xkcd:grey",
-                linestyle='none')
+def _plot_stars(ax, stars, do_stars=True, do_asterisms=True):
+    """
+    Draws the stars and asterism lines from star_altaz on the polar axes, for
+    every time in stars, leaving out everything below the horizon.
+    """
+    size, rgba = _star_style(stars)
+    n_times = stars['alt'].shape[1]
+    for j in range(0, n_times):
+        if do_stars:
+            up = stars['alt'][:, j] > 0
+            ax.scatter(np.radians(stars['az'][up, j]), stars['alt'][up, j],
+                       s=size[up], c=rgba[up], lw=0, zorder=1)
+        if do_asterisms:
+            up = (stars['alt1'][:, j] > 0) & (stars['alt2'][:, j] > 0)
+            lines = np.stack([
+                np.stack([np.radians(stars['az1'][up, j]),
+                          stars['alt1'][up, j]], axis=-1),
+                np.stack([np.radians(stars['az2'][up, j]),
+                          stars['alt2'][up, j]], axis=-1)], axis=1)
+            ax.add_collection(LineCollection(lines, colors='#77a9da',
+                                             linewidths=0.75, alpha=0.6,
+                                             zorder=1))
 
+def _setup_axes(ax, do_grid=True, az_label_offset=0.0*u.deg):
+    """
+    Sets the grid, ticks and labels of the polar local-sky axes.
+    """
     # Grid, ticks & labels.
     # May need to set ticks and labels AFTER plotting points.
     if do_grid is True:
@@ -109,9 +133,85 @@ def plot(observer, times, targets, do_moon=False, do_grid=True,
     # Set ticks and labels.
     ax.set_rgrids(range(1, 106, 15), r_labels, angle=-45)
     ax.set_thetagrids(range(0, 360, 45), theta_labels)
+
+def plot(observer, times, targets, do_moon=False, do_grid=True,
+             az_label_offset=0.0*u.deg, path="./report_plots",
+             do_stars=False, do_asterisms=False, mag_limit=4.0,
+             star_snapshots=1, altaz=None, moon=None, sky_culture="rey"):
+    """
+    can take a single time or multiple
+
+    With do_stars, the stars brighter than mag_limit, and with do_asterisms
+    the asterism lines, are drawn at star_snapshots evenly spaced times of the
+    observing window, starting at its first time. The asterisms are those of
+    sky_culture, see catalogs.load_asterism_segments.
+
+    altaz can be the altitude and azimuth grids from dino_tools.altaz_grid and
+    moon a moon grid from dino_tools.moon_grid, both over times['obs_window']
+    for the same targets, e.g. from a night plan. The ones that are None are
+    computed here.
+
+    If path is None nothing is written, and the image is returned as an
+    io.BytesIO instead of the figure.
+    """
+    #plt.rcParams["figure.figsize"] = (15, 15)
+    fig = tools.new_figure()
+    ax = fig.add_subplot(projection='polar')
+    #ax = plt.subplot(121, projection='polar')
+    #fig, ax = plt.subplots(1, 1)
+    ax.set_rlim(90, 0)
+    #ax.set_rticks([30, 60, 90])
+    ax.set_theta_zero_location('N')
+    
+    if type(targets) != list:
+        target_list = [targets]
+    else:
+        target_list = targets
+
+    try:
+        iter(times['obs_window'])
+        time_list = times['obs_window']
+    except:
+        time_list = [times['obs_window']]
         
+    if do_stars or do_asterisms:
+        n_times = len(time_list)
+        snapshots = np.unique(np.round(np.linspace(0, n_times - 1,
+                                            min(star_snapshots, n_times))))
+        snapshot_times = Time([time_list[int(j)] for j in snapshots])
+        stars = star_altaz(observer, snapshot_times, mag_limit=mag_limit,
+                           do_asterisms=do_asterisms, sky_culture=sky_culture)
+        _plot_stars(ax, stars, do_stars=do_stars, do_asterisms=do_asterisms)
+
+    if altaz is None:
+        altaz = tools.altaz_grid(observer, target_list, time_list)
+
+    for i in range(0, len(target_list)):
+        alt = altaz[0][i]
+        az = np.radians(altaz[1][i])
+        color = target_list[i]['color']
+
+        ax.scatter(az, alt, marker='o', facecolors='none', edgecolors=color)
+        ax.plot(az[0], alt[0], marker='o', label=target_list[i]['name'],
+                color=color, linestyle='none')
+
+    if do_moon:
+        if moon is None:
+            moon = tools.moon_grid(observer, target_list, time_list)
+        alt = moon['alt']
+        az = np.radians(moon['az'])
+
+        ax.scatter(az, alt, marker='o', facecolors='none',
+                   edgecolors="xkcd:grey")
+        ax.plot(az[0], alt[0], marker='o', label="Moon", color="xkcd:grey",
+                linestyle='none')
+
+    _setup_axes(ax, do_grid=do_grid, az_label_offset=az_label_offset)
+
     ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1), fancybox=True,
                   ncol=3, framealpha=0, fontsize=12)
-    plt.savefig('{0}/local_sky.jpg'.format(path), bbox_inches='tight')
-    plt.close()
+    image = tools.save_figure(fig, path, "local_sky.jpg",
+                              bbox_inches='tight')
+    if path is None:
+        return image
     return fig
\ No newline at end of file
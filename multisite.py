@@ -0,0 +1,318 @@
+import re
+
+import numpy as np
+import pandas as pd
+from matplotlib.artist import setp
+import matplotlib.dates as mdates
+
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import TETE
+from astropy.coordinates import get_body
+
+import dino_tools as tools
+
+# sun altitudes of sunset and sunrise and of the evening and morning
+# twilights, the same as dino_tools.setup_times gets from astroplan
+SUN_EVENTS = {"sunset":0.0, "civ_twl":-6.0, "nau_twl":-12.0,
+              "ast_twl":-18.0}
+
+def setup_sites(site_data):
+    """
+    Sets up an observer for each site, given as dicts with the same keys as
+    the "Night" section of the input file: 'telescope_name' and, for sites
+    that are not predefined in dino_tools.setup_location, 'observer_lat',
+    'observer_long', 'observer_elevation' and 'observer_timezone'.
+    """
+    observers = []
+    for site in site_data:
+        observers.append(tools.setup_location(site['telescope_name'],
+                                              site.get('observer_lat'),
+                                              site.get('observer_long'),
+                                              site.get('observer_elevation'),
+                                              site.get('observer_timezone')))
+    return observers
+
+def night_grid(date, time_step=5.0):
+    """
+    Returns UTC times time_step minutes apart over the two days starting at
+    date, which covers the night after date at every longitude.
+    """
+    start = Time(date.split()[0] + " 00:00:00", scale='utc')
+    n_samples = int(np.round(2*24*60/time_step)) + 1
+    return start + np.arange(n_samples)*time_step*u.min
+
+def _altitude(lat, hour_angle, dec):
+    """
+    Altitude in degrees from the latitude, hour angle and declination in
+    degrees. The inputs only need to broadcast against each other.
+    """
+    lat, hour_angle, dec = (np.radians(lat), np.radians(hour_angle),
+                            np.radians(dec))
+    return np.degrees(np.arcsin(np.sin(lat)*np.sin(dec)
+                                + np.cos(lat)*np.cos(dec)*np.cos(hour_angle)))
+
+def _apparent_coords(targets, grid):
+    """
+    Returns (n_targets, n_times) arrays of the apparent RA and DEC of the
+    targets, in degrees, as seen from the center of the earth. Fixed targets
+    are transformed together at the middle of the grid, the others are
+    computed at every time.
+    """
+    ra = np.zeros((len(targets), len(grid)))
+    dec = np.zeros((len(targets), len(grid)))
+    fixed = [i for i in range(0, len(targets))
+             if targets[i]['type'] == "fixed"]
+    if len(fixed) > 0:
+        coords = SkyCoord(
+            ra=[targets[i]['target'].coord.icrs.ra.deg for i in fixed]*u.deg,
+            dec=[targets[i]['target'].coord.icrs.dec.deg for i in fixed]*u.deg)
+        apparent = coords.transform_to(TETE(obstime=grid[len(grid)//2]))
+        ra[fixed] = apparent.ra.deg[:, np.newaxis]
+        dec[fixed] = apparent.dec.deg[:, np.newaxis]
+    for i in range(0, len(targets)):
+        if targets[i]['type'] == "fixed":
+            continue
+        apparent = tools.get_target_coords(targets[i], grid, None).transform_to(
+            TETE(obstime=grid))
+        ra[i] = apparent.ra.deg
+        dec[i] = apparent.dec.deg
+    return ra, dec
+
+def _crossing(alt, jd, level, window, rising):
+    """
+    Finds the first time in each row of alt, within the boolean window, that
+    the altitude passes level, going up if rising and down otherwise. jd
+    holds the Julian dates of the samples along the last axis, or of every
+    sample.
+
+    Returns the linearly interpolated Julian dates, NaN where it never does.
+    """
+    d = alt - level
+    if rising:
+        passes = (d[..., :-1] < 0) & (d[..., 1:] >= 0)
+    else:
+        passes = (d[..., :-1] >= 0) & (d[..., 1:] < 0)
+    passes &= window[..., :-1] & window[..., 1:]
+    k = np.argmax(passes, axis=-1)[..., np.newaxis]
+    jd = np.broadcast_to(jd, d.shape)
+    d0 = np.take_along_axis(d, k, axis=-1)[..., 0]
+    d1 = np.take_along_axis(d, k + 1, axis=-1)[..., 0]
+    jd0 = np.take_along_axis(jd, k, axis=-1)[..., 0]
+    jd1 = np.take_along_axis(jd, k + 1, axis=-1)[..., 0]
+    crossing = jd0 + (jd1 - jd0)*d0/(d0 - d1)
+    return np.where(passes.any(axis=-1), crossing, np.nan)
+
+def _time_string(jd):
+    if np.isnan(jd):
+        return "NA"
+    return Time(jd, format='jd').iso.split()[1][:5]
+
+def compare_sites(observers, targets, date, time_step=5.0, max_airmass=2.0,
+                  sun_alt_limit=-18.0):
+    """
+    Computes the twilights, and the visibility and best airmass of every
+    target, for several sites in one vectorized pass.
+
+    The apparent positions of the sun and the targets are computed once as
+    seen from the center of the earth, and every site only adds its local
+    sidereal time, so the altitudes of all targets at all sites come from a
+    single hour angle formula. Refraction and parallax are ignored, which is
+    fine for planning but not for the moon.
+
+    Parameters
+    -----------
+
+    observers : list of astroplan.Observer
+        The sites, see setup_sites.
+
+    targets : list of dicts
+        The targets from dino_tools.setup_target_list.
+
+    date : str
+        The date of the evening of the night, e.g. "2023-08-07". A full
+        date and time works too.
+
+    time_step : float
+        The spacing of the time grid in minutes.
+        Defaults to 5.0.
+
+    max_airmass : float
+        The highest airmass at which a target counts as observable.
+        Defaults to 2.0.
+
+    sun_alt_limit : float
+        The highest sun altitude, in degrees, at which a target counts as
+        observable.
+        Defaults to -18.0, astronomical twilight.
+
+    Returns a dict with
+        'sites' : a DataFrame with the sunset, sunrise and twilights, in UTC,
+                  and the hours of darkness of each site
+        'targets' : a DataFrame with, for each site and target, the hours the
+                    target is observable, its best airmass and the time of it,
+                    and the first and last time it is observable
+        'comparison' : a DataFrame with the observable hours of each target
+                       (rows) at each site (columns), and the best site
+        'grid' : the times, the night window of each site and the
+                 (n_sites, n_times) sun and (n_sites, n_targets, n_times)
+                 target altitudes
+    """
+    grid = night_grid(date, time_step=time_step)
+    jd = grid.jd
+    names = [observer.name for observer in observers]
+    lon = np.array([observer.location.lon.deg for observer in observers])
+    lat = np.array([observer.location.lat.deg for observer in observers])
+
+    # the night of each site runs from local noon to local noon
+    noon = Time(date.split()[0] + " 12:00:00", scale='utc').jd - lon/360
+    window = (jd >= noon[:, np.newaxis]) & (jd <= noon[:, np.newaxis] + 1)
+
+    # local sidereal time of every site at every time
+    gast = grid.sidereal_time('apparent', 'greenwich').deg
+    lst = gast[np.newaxis, :] + lon[:, np.newaxis]
+
+    sun = get_body("sun", grid).transform_to(TETE(obstime=grid))
+    sun_alt = _altitude(lat[:, np.newaxis], lst - sun.ra.deg, sun.dec.deg)
+
+    ra, dec = _apparent_coords(targets, grid)
+    alt = _altitude(lat[:, np.newaxis, np.newaxis],
+                    lst[:, np.newaxis, :] - ra[np.newaxis], dec[np.newaxis])
+
+    # the sites
+    site_rows = []
+    events = {}
+    for event, level in SUN_EVENTS.items():
+        events[event] = (_crossing(sun_alt, jd, level, window, rising=False),
+                         _crossing(sun_alt, jd, level, window, rising=True))
+    dark = window & (sun_alt < sun_alt_limit)
+    for n in range(0, len(observers)):
+        row = {"site":names[n],
+               "sunset":_time_string(events['sunset'][0][n]),
+               "sunrise":_time_string(events['sunset'][1][n])}
+        for event in ["civ_twl", "nau_twl", "ast_twl"]:
+            row[event + "_evening"] = _time_string(events[event][0][n])
+            row[event + "_morning"] = _time_string(events[event][1][n])
+        row['dark_hours'] = round(dark[n].sum()*time_step/60, 2)
+        site_rows.append(row)
+    sites = pd.DataFrame(site_rows)
+
+    # the targets at every site
+    zenith = np.radians(90.0 - alt)
+    airmass = np.where(alt > 0, 1./np.cos(np.clip(zenith, 0, np.pi/2 - 1e-6)),
+                       np.inf)
+    observable = dark[:, np.newaxis, :] & (airmass <= max_airmass)
+    dark_airmass = np.where(dark[:, np.newaxis, :], airmass, np.inf)
+    best = np.argmin(dark_airmass, axis=-1)
+    best_airmass = np.take_along_axis(dark_airmass, best[..., np.newaxis],
+                                      axis=-1)[..., 0]
+    hours = observable.sum(axis=-1)*time_step/60
+    first = np.argmax(observable, axis=-1)
+    last = observable.shape[-1] - 1 - np.argmax(observable[..., ::-1],
+                                                axis=-1)
+    target_rows = []
+    for n in range(0, len(observers)):
+        for i in range(0, len(targets)):
+            seen = observable[n, i].any()
+            target_rows.append({
+                "site":names[n],
+                "target":targets[i]['name'],
+                "hours":round(hours[n, i], 2),
+                "best_airmass":("{0:.2f}".format(best_airmass[n, i])
+                                if np.isfinite(best_airmass[n, i]) else "NA"),
+                "best_time":(_time_string(jd[best[n, i]])
+                             if np.isfinite(best_airmass[n, i]) else "NA"),
+                "start":_time_string(jd[first[n, i]]) if seen else "NA",
+                "end":_time_string(jd[last[n, i]]) if seen else "NA"})
+    target_table = pd.DataFrame(target_rows)
+
+    comparison = pd.DataFrame(np.round(hours.T, 2), columns=names,
+                              index=[target['name'] for target in targets])
+    comparison.index.name = "target"
+    comparison['best_site'] = np.where(hours.max(axis=0) > 0,
+                                       np.array(names)[hours.argmax(axis=0)],
+                                       "none")
+
+    return {"sites":sites, "targets":target_table, "comparison":comparison,
+            "grid":{"times":grid, "window":window, "sun_alt":sun_alt,
+                    "alt":alt}}
+
+def site_label(name):
+    """
+    Returns a version of a site name that can be used in file names.
+    """
+    return re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')
+
+def plot_site(result, n, targets, max_airmass=2.0, path="./report_plots"):
+    """
+    Plots the altitude of the targets over the night of site n of a
+    compare_sites result, with the twilights shaded, and saves it as
+    multisite_<site>.jpg.
+
+    If path is None nothing is written, and the image is returned as an
+    io.BytesIO instead of the figure.
+    """
+    grid = result['grid']
+    window = grid['window'][n]
+    times = grid['times'][window].to_datetime()
+    sun_alt = grid['sun_alt'][n][window]
+    name = result['sites']['site'][n]
+
+    fig = tools.new_figure(figsize=(10, 5))
+    ax = fig.add_subplot()
+    for level, alpha in [(0.0, 0.1), (-6.0, 0.15), (-12.0, 0.2),
+                         (-18.0, 0.25)]:
+        ax.fill_between(times, 0, 90, where=sun_alt < level,
+                        color="xkcd:grey", alpha=alpha, linewidth=0)
+    for i in range(0, len(targets)):
+        alt = grid['alt'][n, i][window]
+        ax.plot(times, np.ma.array(alt, mask=alt < 0),
+                label=targets[i]['name'], color=targets[i]['color'],
+                linewidth=2)
+    limit = 90 - np.degrees(np.arccos(1/max_airmass))
+    ax.axhline(limit, linestyle='--', color="xkcd:grey",
+               label="Airmass {0:.1f}".format(max_airmass))
+
+    dark = np.nonzero(sun_alt < 0.0)[0]
+    if len(dark) > 0:
+        k0 = max(dark[0] - 6, 0)
+        k1 = min(dark[-1] + 6, len(times) - 1)
+        ax.set_xlim(times[k0], times[k1])
+    ax.xaxis.set_major_locator(mdates.HourLocator())
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    setp(ax.get_xticklabels(), rotation=20, ha='right')
+    ax.set_xlabel("Time (UTC)")
+    ax.set_ylim(0, 90)
+    ax.set_ylabel("Altitude (deg)")
+    ax.set_title(name)
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.15), fancybox=True,
+              ncol=3, framealpha=0, fontsize=12)
+    image = tools.save_figure(fig, path,
+                              "multisite_{0}.jpg".format(site_label(name)),
+                              bbox_inches='tight')
+    if path is None:
+        return image
+    return fig
+
+def write_reports(result, targets, max_airmass=2.0, path="./report_plots"):
+    """
+    Writes the tables of a compare_sites result, multisite_sites.csv and
+    multisite_comparison.csv, and for each site a table of its targets,
+    multisite_<site>.csv, and a plot of their altitudes, see plot_site.
+
+    Returns the file labels of the sites.
+    """
+    result['sites'].to_csv("{0}/multisite_sites.csv".format(path),
+                           index=False)
+    result['comparison'].to_csv("{0}/multisite_comparison.csv".format(path))
+    labels = []
+    for n in range(0, len(result['sites'])):
+        name = result['sites']['site'][n]
+        label = site_label(name)
+        site_targets = result['targets'][result['targets']['site'] == name]
+        site_targets.to_csv("{0}/multisite_{1}.csv".format(path, label),
+                            index=False)
+        plot_site(result, n, targets, max_airmass=max_airmass, path=path)
+        labels.append(label)
+    return labels
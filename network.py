@@ -0,0 +1,271 @@
+import asyncio
+import threading
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from astropy.coordinates import SkyCoord
+from astroquery.jplhorizons import Horizons
+from astroquery.simbad import Simbad
+from astroquery.skyview import SkyViewClass
+
+# per-service limits, can be changed with configure()
+SERVICES = {
+    "horizons":{"concurrency":4, "timeout":60.0, "retries":3, "backoff":1.0},
+    "simbad":{"concurrency":4, "timeout":30.0, "retries":3, "backoff":1.0},
+    "skyview":{"concurrency":2, "timeout":120.0, "retries":2, "backoff":2.0},
+    "irsa":{"concurrency":2, "timeout":300.0, "retries":2, "backoff":2.0}
+}
+
+# the IRSA ZTF light curve service
+ZTF_URL = "https://irsa.ipac.caltech.edu/cgi-bin/ZTF/nph_light_curves"
+
+_loop = None
+_loop_lock = threading.Lock()
+_semaphores = {}
+_clients = {}
+_clients_lock = threading.Lock()
+# astroquery objects are not thread-safe, so every worker thread gets its own
+_local = threading.local()
+
+def configure(**services):
+    """
+    Changes the limits of the services, e.g.
+    configure(skyview={"concurrency":4, "timeout":60.0}).
+    Only takes effect for services that have not been used yet.
+    """
+    for name, settings in services.items():
+        SERVICES[name].update(settings)
+
+def _get_loop():
+    """
+    Returns the event loop all network calls run on. It lives in a daemon
+    thread, so the rest of DINOS can stay synchronous and just wait on the
+    results it needs.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, daemon=True,
+                                      name="dinos-network")
+            thread.start()
+    return _loop
+
+def submit(coroutine):
+    """
+    Starts a coroutine on the network loop and returns a
+    concurrent.futures.Future for its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop())
+
+def run(coroutine):
+    """
+    Runs a coroutine on the network loop and waits for its result.
+    """
+    return submit(coroutine).result()
+
+class _TimeoutAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that gives every request without a timeout of its own the
+    timeout of the service, as astroquery does not pass one everywhere.
+    """
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+def _session(service):
+    """
+    Returns the shared requests session of a service, so connections are
+    reused between calls. Every request made with it times out after the
+    timeout of the service.
+    """
+    with _clients_lock:
+        if service not in _clients:
+            session = requests.Session()
+            size = SERVICES[service]['concurrency']
+            adapter = _TimeoutAdapter(SERVICES[service]['timeout'],
+                                      pool_connections=size,
+                                      pool_maxsize=size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _clients[service] = session
+    return _clients[service]
+
+def _client(service):
+    """
+    Returns the astroquery object of a service for the calling thread, using
+    the shared session. Call it from the worker thread that uses the object.
+    """
+    key = service + "_client"
+    if not hasattr(_local, key):
+        if service == "simbad":
+            client = Simbad()
+            client.add_votable_fields('otype', 'sptype', 'distance',
+                                      'parallax', 'fluxdata(V)', 'ra(d)',
+                                      'dec(d)')
+        elif service == "skyview":
+            client = SkyViewClass()
+        client._session = _session(service)
+        client.TIMEOUT = SERVICES[service]['timeout']
+        setattr(_local, key, client)
+    return getattr(_local, key)
+
+# only these are worth retrying, anything else is an answer from the service
+_TRANSIENT_ERRORS = (requests.exceptions.RequestException, ConnectionError,
+                     OSError)
+
+async def gather(*coroutines):
+    """
+    Runs several coroutines concurrently and returns their results in order.
+    """
+    return await asyncio.gather(*coroutines)
+
+async def _call(service, function, *args, **kwargs):
+    """
+    Calls a blocking function in a worker thread, limited to the concurrency
+    of the service, and retried with exponential backoff when the service
+    times out or the connection fails.
+
+    The timeout is applied by the requests themselves (see _session), not
+    by waiting on the thread, so a request that timed out has really ended
+    before it is retried and the concurrency limit holds. The limit is only
+    held while a call runs, not during the backoff, so failing calls do not
+    hold up the others.
+    """
+    if service not in _semaphores:
+        _semaphores[service] = asyncio.Semaphore(
+            SERVICES[service]['concurrency'])
+    settings = SERVICES[service]
+    for attempt in range(0, settings['retries'] + 1):
+        try:
+            async with _semaphores[service]:
+                return await asyncio.to_thread(function, *args, **kwargs)
+        except _TRANSIENT_ERRORS:
+            if attempt == settings['retries']:
+                raise
+            delay = settings['backoff']*2**attempt
+            await asyncio.sleep(delay*(0.5 + random.random()))
+
+def _horizons_ephemerides(target_id, id_type, epochs, location):
+    obj = Horizons(id=target_id, id_type=id_type, location=location,
+                   epochs=epochs)
+    obj._session = _session("horizons")
+    obj.TIMEOUT = SERVICES['horizons']['timeout']
+    return obj.ephemerides()
+
+async def horizons_ephemerides(target_id, id_type, epochs, location=None):
+    """
+    Queries Horizons for the ephemerides of an object, see
+    dino_tools.get_ephemerides. epochs can be one JD or a list of JDs.
+    """
+    return await _call("horizons", _horizons_ephemerides, target_id, id_type,
+                       epochs, location)
+
+def _horizons_elements(target_id, id_type, epochs):
+    obj = Horizons(id=target_id, id_type=id_type, location='500@10',
+                   epochs=epochs)
+    obj._session = _session("horizons")
+    obj.TIMEOUT = SERVICES['horizons']['timeout']
+    return obj.elements()
+
+async def horizons_elements(target_id, id_type, epochs):
+    """
+    Queries Horizons for the heliocentric osculating orbital elements of an
+    object, referred to the ecliptic of J2000.
+    """
+    return await _call("horizons", _horizons_elements, target_id, id_type,
+                       epochs)
+
+def _simbad_query(object_name):
+    return _client("simbad").query_object(object_name)
+
+async def simbad_query(object_name):
+    """
+    Queries SIMBAD for an object, returning the raw result table that
+    object_stats.format_simbad turns into report data.
+    """
+    result = await _call("simbad", _simbad_query, object_name)
+    if result is None or len(result) == 0:
+        raise ValueError("SIMBAD does not know {0}".format(object_name))
+    return result
+
+async def resolve_name(object_name):
+    """
+    Resolves an object name to a SkyCoord through Sesame, like
+    FixedTarget.from_name does.
+
+    SkyCoord.from_name downloads through astropy, not the session of the
+    service, so the timeout of the service does not apply, only astropy's
+    remote_timeout setting.
+    """
+    return await _call("simbad", SkyCoord.from_name, object_name)
+
+def _skyview_images(**kwargs):
+    return _client("skyview").get_images(**kwargs)
+
+async def skyview_image(position, survey, radius, coordinates='icrs',
+                        **kwargs):
+    """
+    Downloads a survey image from SkyView, returning the first HDU.
+    """
+    images = await _call("skyview", _skyview_images, position=position,
+                         coordinates=coordinates, survey=survey,
+                         radius=radius, **kwargs)
+    return images[0][0]
+
+def _ztf_lightcurves(params):
+    response = _session("irsa").get(ZTF_URL, params=params,
+                                    timeout=SERVICES['irsa']['timeout'])
+    response.raise_for_status()
+    return response.text
+
+async def ztf_lightcurves(positions, radius, start_mjd=None, end_mjd=None,
+                          bands="g,r,i"):
+    """
+    Downloads the ZTF light curves around several positions with one IRSA
+    request, returning the CSV text. The POS constraints are ORed by IRSA,
+    so the rows are not labelled with the position they matched, see
+    object_stats.ztf_query.
+
+    positions is a list of (ra, dec) in degrees and radius is in degrees.
+    Only epochs after start_mjd and up to end_mjd are returned if given.
+    """
+    params = [("POS", "CIRCLE {0:.7f} {1:.7f} {2:.7f}".format(ra, dec,
+                                                              radius))
+              for ra, dec in positions]
+    params += [("BANDNAME", bands), ("FORMAT", "CSV"),
+               ("BAD_CATFLAGS_MASK", "32768")]
+    if start_mjd is not None or end_mjd is not None:
+        params.append(("TIME", "{0:.6f} {1:.6f}".format(
+            0.0 if start_mjd is None else start_mjd,
+            99999.0 if end_mjd is None else end_mjd)))
+    return await _call("irsa", _ztf_lightcurves, params)
+
+def start_lookups(targets, do_simbad=True, finder_kwargs=None):
+    """
+    Starts all the network lookups of a run at once.
+
+    Returns a dict from target name to a dict of concurrent.futures.Future
+    objects, 'simbad' for the SIMBAD result table and 'finder' for the
+    finder chart HDU, so each stage can wait for only the data it needs.
+    """
+    lookups = {}
+    for target in targets:
+        lookups[target['name']] = {}
+        if do_simbad:
+            lookups[target['name']]['simbad'] = submit(
+                simbad_query(target['name']))
+        if finder_kwargs is not None and target['target'] is not None:
+            kwargs = dict(finder_kwargs)
+            lookups[target['name']]['finder'] = submit(
+                skyview_image(target['target'].coord.icrs,
+                              kwargs.pop('survey', 'DSS'),
+                              kwargs.pop('radius'), **kwargs))
+    return lookups
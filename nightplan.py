@@ -0,0 +1,275 @@
+import json
+
+import numpy as np
+
+import astropy.units as u
+from astropy.io import fits
+from astropy.time import Time
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import GCRS
+from astropy.coordinates import EarthLocation
+from astroplan import Observer
+from astroplan import FixedTarget
+
+import dino_tools as tools
+
+PLAN_VERSION = 1
+
+# the report columns of targets.csv, which dinos.py adds to the targets
+REPORT_KEYS = ["Object", "RA", "DEC", "oType", "spType", "d", "V", "rise",
+               "set", "lowest_a", "moon_sep_min", "bright_star",
+               "bright_star_sep"]
+
+# the parts of a moon grid from dino_tools.moon_grid that are stored
+MOON_KEYS = ["alt", "az", "illumination", "sep"]
+
+def _needs_ephemeris(target):
+    """
+    True for targets whose positions come from Horizons, which are the ones a
+    night plan has to store so it can be used offline.
+    """
+    return (target['type'] in ["smallbody", "majorbody"]
+            and 'elements' not in target)
+
+def ephemeris_times(times, step=10.0):
+    """
+    Returns evenly spaced times, step minutes apart, covering the plot window
+    and the observing window with one step to spare on both sides.
+    """
+    jds = np.concatenate([np.atleast_1d(Time(times['plot_window']).jd),
+                          np.atleast_1d(Time(times['obs_window']).jd)])
+    step = step/(24*60)
+    start = jds.min() - step
+    n_steps = int(np.ceil((jds.max() + step - start)/step)) + 1
+    return Time(start + step*np.arange(n_steps), format='jd')
+
+def attach_ephemerides(observer, times, targets, step=10.0):
+    """
+    Stores the positions of the targets that come from Horizons in
+    target['ephemeris'], sampled every step minutes over the night, so they
+    are interpolated from then on instead of queried, see
+    dino_tools.interpolate_ephemeris.
+    """
+    grid = ephemeris_times(times, step=step)
+    for target in targets:
+        if not _needs_ephemeris(target) or 'ephemeris' in target:
+            continue
+        coords = tools.get_target_coords(target, grid, observer.location)
+        target['ephemeris'] = {"jd":grid.jd,
+                               "ra":coords.icrs.ra.deg,
+                               "dec":coords.icrs.dec.deg}
+    return targets
+
+def _time_meta(t):
+    """
+    Returns the JSON description of a Time (or list of Times) in the times
+    dict, and the array it is stored in.
+    """
+    if isinstance(t, list):
+        return {"list":len(t)}, np.array([Time(x).utc.jd for x in t])
+    t = Time(t)
+    return {"scalar":bool(t.isscalar)}, np.asarray(t.utc.jd)
+
+def _time_from(meta, jd):
+    t = Time(jd, format='jd', scale='utc')
+    t.format = 'iso'
+    if "list" in meta:
+        return [t[k] for k in range(0, meta['list'])]
+    return t
+
+def save_plan(path, observer, times, targets, night=None, altaz=None,
+              moon=None, hdus=None):
+    """
+    Saves everything the plots and the report need about a night into one
+    compressed numpy file, so they can be made again without any astronomy
+    or network queries, see load_plan.
+
+    Parameters
+    -----------
+
+    path : str
+        The file to write, ".npz" is added if it is missing.
+
+    observer : astroplan.Observer
+        The observer for the night.
+
+    times : dict
+        The times dictionary from dino_tools.setup_times.
+
+    targets : list of dicts
+        The targets from dino_tools.setup_target_list, with the report columns
+        added by dinos.py. Targets that come from Horizons need an ephemeris,
+        see attach_ephemerides.
+
+    night : dict
+        The "Night" section of the input file.
+
+    altaz : dict
+        Window name, e.g. "plot_window", to the altitude and azimuth grids from
+        dino_tools.altaz_grid over that window.
+
+    moon : dict
+        Window name to the moon grid from dino_tools.moon_grid over that
+        window.
+
+    hdus : list
+        The finder chart image HDU of each target, or None.
+    """
+    if altaz is None:
+        altaz = {}
+    if moon is None:
+        moon = {}
+    if hdus is None:
+        hdus = [None]*len(targets)
+    arrays = {}
+    location = observer.location
+    meta = {"version":PLAN_VERSION,
+            "created":Time.now().isot,
+            "night":night,
+            "observer":{"name":observer.name,
+                        "lon":location.lon.deg,
+                        "lat":location.lat.deg,
+                        "elevation":location.height.to_value(u.m),
+                        "timezone":str(observer.timezone)},
+            "times":{}, "blocks":None, "targets":[],
+            "altaz":list(altaz.keys()), "moon":list(moon.keys())}
+
+    for key in ["sunrise", "sunset", "civ_twl", "nau_twl", "ast_twl",
+                "events", "plot_window", "obs_window"]:
+        meta['times'][key], arrays["times." + key] = _time_meta(times[key])
+    meta['sampling'] = times['sampling']
+    if times['blocks'] != None:
+        meta['blocks'] = []
+        for k in range(0, len(times['blocks'])):
+            block = times['blocks'][k]
+            arrays["blocks.{0}".format(k)] = np.array(
+                [Time(t).utc.jd for t in block['times']])
+            meta['blocks'].append({"color":block['color']})
+
+    for i in range(0, len(targets)):
+        target = targets[i]
+        info = {"name":target['name'], "type":target['type'],
+                "color":target['color'],
+                "report":{key:target[key] for key in REPORT_KEYS
+                          if key in target}}
+        if target['target'] is not None:
+            coord = target['target'].coord.icrs
+            info['target'] = {"name":target['target'].name,
+                              "ra":coord.ra.deg, "dec":coord.dec.deg}
+        if 'elements' in target:
+            info['elements'] = target['elements']
+        if 'ephemeris' in target:
+            for key in ["jd", "ra", "dec"]:
+                arrays["ephemeris.{0}.{1}".format(i, key)] = np.asarray(
+                    target['ephemeris'][key])
+            info['ephemeris'] = True
+        if hdus[i] is not None:
+            arrays["hdu.{0}".format(i)] = np.asarray(hdus[i].data)
+            info['header'] = hdus[i].header.tostring()
+        meta['targets'].append(info)
+
+    for window, (alt, az) in altaz.items():
+        arrays["altaz.{0}.alt".format(window)] = np.asarray(alt)
+        arrays["altaz.{0}.az".format(window)] = np.asarray(az)
+    for window, grid in moon.items():
+        arrays["moon.{0}.times".format(window)] = np.asarray(
+            grid['times'].utc.jd)
+        for key in MOON_KEYS:
+            arrays["moon.{0}.{1}".format(window, key)] = np.asarray(grid[key])
+        gcrs = grid['coord'].gcrs
+        arrays["moon.{0}.coord".format(window)] = np.stack(
+            [gcrs.ra.deg, gcrs.dec.deg, gcrs.distance.to_value(u.km)])
+
+    # anything json does not know, e.g. numpy ints from SIMBAD, becomes a str
+    arrays['meta'] = np.array(json.dumps(meta, default=str))
+    np.savez_compressed(path, **arrays)
+
+def load_plan(path):
+    """
+    Loads a night plan written by save_plan.
+
+    Returns a dict with the 'night' section of the input file, the
+    'observer', the 'times' dict and the 'targets' list as DINOS makes them,
+    the 'altaz' and 'moon' grids by window name, the finder chart 'hdus' of
+    the targets, and when the plan was 'created'.
+    """
+    if not path.endswith(".npz"):
+        path = path + ".npz"
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {key:data[key] for key in data.files}
+    meta = json.loads(str(arrays['meta']))
+    if meta['version'] != PLAN_VERSION:
+        raise ValueError("{0} is a version {1} night plan, this DINOS reads "
+                         "version {2}".format(path, meta['version'],
+                                              PLAN_VERSION))
+
+    site = meta['observer']
+    location = EarthLocation.from_geodetic(site['lon']*u.deg, site['lat']*u.deg,
+                                           site['elevation']*u.m)
+    observer = Observer(location=location, name=site['name'],
+                        timezone=site['timezone'])
+
+    times = {"sampling":meta['sampling'], "blocks":None}
+    for key, info in meta['times'].items():
+        times[key] = _time_from(info, arrays["times." + key])
+    if meta['blocks'] is not None:
+        times['blocks'] = []
+        for k in range(0, len(meta['blocks'])):
+            color = meta['blocks'][k]['color']
+            if isinstance(color, list):
+                color = tuple(color)
+            times['blocks'].append({
+                "times":_time_from({"list":2}, arrays["blocks.{0}".format(k)]),
+                "color":color})
+
+    targets = []
+    hdus = []
+    for i in range(0, len(meta['targets'])):
+        info = meta['targets'][i]
+        color = info['color']
+        if isinstance(color, list):
+            color = tuple(color)
+        target = {"target":None, "color":color, "type":info['type'],
+                  "name":info['name']}
+        if 'target' in info:
+            coord = SkyCoord(ra=info['target']['ra']*u.deg,
+                             dec=info['target']['dec']*u.deg)
+            target['target'] = FixedTarget(coord, name=info['target']['name'])
+        if 'elements' in info:
+            target['elements'] = info['elements']
+        if info.get('ephemeris', False):
+            target['ephemeris'] = {
+                key:arrays["ephemeris.{0}.{1}".format(i, key)]
+                for key in ["jd", "ra", "dec"]}
+        target.update(info['report'])
+        targets.append(target)
+        if 'header' in info:
+            hdus.append(fits.PrimaryHDU(
+                data=arrays["hdu.{0}".format(i)],
+                header=fits.Header.fromstring(info['header'])))
+        else:
+            hdus.append(None)
+
+    altaz = {}
+    for window in meta['altaz']:
+        altaz[window] = (arrays["altaz.{0}.alt".format(window)],
+                         arrays["altaz.{0}.az".format(window)])
+    moon = {}
+    for window in meta['moon']:
+        grid_times = Time(arrays["moon.{0}.times".format(window)],
+                          format='jd', scale='utc')
+        ra, dec, distance = arrays["moon.{0}.coord".format(window)]
+        obsgeoloc, obsgeovel = observer.location.get_gcrs_posvel(grid_times)
+        grid = {"times":grid_times,
+                "coord":SkyCoord(ra=ra*u.deg, dec=dec*u.deg,
+                                 distance=distance*u.km,
+                                 frame=GCRS(obstime=grid_times,
+                                            obsgeoloc=obsgeoloc,
+                                            obsgeovel=obsgeovel))}
+        for key in MOON_KEYS:
+            grid[key] = arrays["moon.{0}.{1}".format(window, key)]
+        moon[window] = grid
+
+    return {"night":meta['night'], "observer":observer, "times":times,
+            "targets":targets, "altaz":altaz, "moon":moon, "hdus":hdus,
+            "created":meta['created']}
@@ -1,19 +1,32 @@
+import os
+import io
+import json
+
 import numpy as np
 import pandas as pd
 from astroquery.simbad import Simbad
 from astropy.coordinates import SkyCoord
+from astropy.time import Time
 import astropy.units as u
 
+import network
+import dino_tools as tools
+
 
-def simbad_query(object_name):
+def simbad_query(object_name, result_table=None):
     """
-    
+    Looks an object up in SIMBAD and formats the result for the report. If
+    result_table is given (e.g. from network.start_lookups) it is used instead
+    of querying again.
+    """
+    if result_table is None:
+        result_table = network.run(network.simbad_query(object_name))
+    return format_simbad(result_table)
+
+def format_simbad(result_table):
+    """
+    Formats a SIMBAD result table into the target data used in the report.
     """
-    sbd = Simbad()
-    sbd.add_votable_fields('otype', 'sptype', 'distance', 'parallax',
-                           'fluxdata(V)', 'ra(d)', 'dec(d)')
-    result_table = sbd.query_object(object_name)
-    
     coord = SkyCoord(result_table['RA'][0] +
                      " " + result_table['DEC'][0], unit=(u.hourangle, u.deg))
     
@@ -56,8 +69,197 @@ def simbad_query(object_name):
         
     return data
     
-def ztf_query(object_name):
+# the columns of the ZTF light curve cache
+ZTF_COLUMNS = ["target", "oid", "mjd", "mag", "magerr", "filtercode",
+               "catflags", "ra", "dec"]
+ZTF_CACHE_VERSION = 1
+# ZTF does not see below this declination
+ZTF_MIN_DEC = -31.0
+
+def _ztf_cache_path(cache_dir):
+    return "{0}/ztf_lightcurves.npz".format(cache_dir)
+
+def load_ztf_cache(cache_dir="./data/cache"):
     """
-    
+    Loads the ZTF light curve cache written by ztf_query.
+
+    Returns the light curves as a DataFrame with the ZTF_COLUMNS, and a dict
+    from target name to its 'ra' and 'dec', when it was last 'checked' and
+    the 'last_mjd' of its newest epoch.
+    """
+    path = _ztf_cache_path(cache_dir)
+    if not os.path.exists(path):
+        return pd.DataFrame({key:[] for key in ZTF_COLUMNS}), {}
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data['meta']))
+        if meta['version'] != ZTF_CACHE_VERSION:
+            return pd.DataFrame({key:[] for key in ZTF_COLUMNS}), {}
+        lightcurves = pd.DataFrame({key:data[key] for key in ZTF_COLUMNS})
+    return lightcurves, meta['targets']
+
+def save_ztf_cache(lightcurves, state, cache_dir="./data/cache"):
+    """
+    Writes the ZTF light curve cache as one compressed numpy file with a
+    column per array, replacing the old file only once the new one is
+    complete.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _ztf_cache_path(cache_dir)
+    arrays = {key:lightcurves[key].to_numpy() for key in ZTF_COLUMNS}
+    for key in ["target", "filtercode"]:
+        arrays[key] = arrays[key].astype(str)
+    arrays['meta'] = np.array(json.dumps({"version":ZTF_CACHE_VERSION,
+                                          "targets":state}))
+    np.savez_compressed(path + ".tmp.npz", **arrays)
+    os.replace(path + ".tmp.npz", path)
+
+def _read_ztf_csv(text):
+    """
+    Reads the CSV from network.ztf_lightcurves into a DataFrame.
+    """
+    try:
+        table = pd.read_csv(io.StringIO(text))
+    except pd.errors.EmptyDataError:
+        table = pd.DataFrame()
+    if "mjd" not in table.columns:
+        return pd.DataFrame({key:[] for key in ZTF_COLUMNS[1:]})
+    return table[ZTF_COLUMNS[1:]]
+
+def ztf_query(targets, radius=1.5, max_age=1.0, batch_size=50,
+              cache_dir="./data/cache"):
+    """
+    Returns the ZTF light curves of the fixed targets, downloading only what
+    the cache does not have yet.
+
+    Targets that were checked less than max_age days ago come straight from
+    the cache. The others are sent to IRSA in batches of batch_size
+    positions, one request per batch, asking only for the epochs after the
+    newest one in the cache. The rows of a batch are given to the nearest of
+    its targets within radius. A target whose coordinates moved by more than
+    radius since it was cached is downloaded again from scratch.
+
+    Parameters
+    -----------
+
+    targets : list of dicts
+        The targets from dino_tools.setup_target_list. Only fixed targets
+        north of ZTF_MIN_DEC are looked up.
+
+    radius : float
+        The match radius in arcseconds. Defaults to 1.5.
+
+    max_age : float
+        How old, in days, the last check of a target may be before ZTF is
+        asked again. Defaults to 1.0.
+
+    batch_size : int
+        How many positions go into one request. Defaults to 50.
+
+    cache_dir : str
+        Where the cache is kept. Defaults to "./data/cache".
+
+    Returns a DataFrame of the epochs of the targets with the ZTF_COLUMNS.
+    """
+    lightcurves, state = load_ztf_cache(cache_dir)
+    now = Time.now().mjd
+    radius_deg = radius/3600
+
+    names = []
+    pending = []
+    for target in targets:
+        if target['target'] is None:
+            continue
+        coord = target['target'].coord.icrs
+        ra, dec = float(coord.ra.deg), float(coord.dec.deg)
+        if dec < ZTF_MIN_DEC:
+            continue
+        name = target['name']
+        names.append(name)
+        entry = state.get(name)
+        if entry is not None and tools._angular_separation(
+                entry['ra'], entry['dec'], ra, dec) > radius_deg:
+            lightcurves = lightcurves[lightcurves['target'] != name]
+            entry = None
+        if entry is None:
+            entry = {"ra":ra, "dec":dec, "checked":None, "last_mjd":None}
+            state[name] = entry
+        if entry['checked'] is None or now - entry['checked'] > max_age:
+            pending.append(name)
+
+    if len(pending) > 0:
+        print("querying ZTF for {0} targets...".format(len(pending)))
+        # targets with similar newest epochs share a request, which then
+        # starts at the oldest of them
+        pending.sort(key=lambda name: state[name]['last_mjd'] or 0.0)
+        batches = [pending[k:k + batch_size]
+                   for k in range(0, len(pending), batch_size)]
+        queries = []
+        for batch in batches:
+            last = [state[name]['last_mjd'] for name in batch]
+            start = None if None in last else min(last)
+            queries.append(network.ztf_lightcurves(
+                [(state[name]['ra'], state[name]['dec']) for name in batch],
+                radius_deg, start_mjd=start))
+        results = network.run(network.gather(*queries))
+
+        new_rows = [lightcurves]
+        for batch, text in zip(batches, results):
+            table = _read_ztf_csv(text)
+            if len(table) > 0:
+                ra = np.array([state[name]['ra'] for name in batch])
+                dec = np.array([state[name]['dec'] for name in batch])
+                sep = tools._angular_separation(
+                    ra[:, np.newaxis], dec[:, np.newaxis],
+                    table['ra'].to_numpy()[np.newaxis],
+                    table['dec'].to_numpy()[np.newaxis])
+                nearest = np.argmin(sep, axis=0)
+                last = np.array([state[name]['last_mjd'] or 0.0
+                                 for name in batch])
+                keep = ((sep[nearest, np.arange(len(table))] <= radius_deg)
+                        & (table['mjd'].to_numpy() > last[nearest]))
+                table = table[keep].copy()
+                table.insert(0, "target",
+                             np.array(batch, dtype=object)[nearest[keep]])
+                new_rows.append(table)
+            for name in batch:
+                state[name]['checked'] = now
+        lightcurves = pd.concat(new_rows, ignore_index=True)
+        last_mjd = lightcurves.groupby("target")['mjd'].max()
+        for name in pending:
+            if name in last_mjd.index:
+                state[name]['last_mjd'] = float(last_mjd[name])
+        save_ztf_cache(lightcurves, state, cache_dir)
+
+    return lightcurves[lightcurves['target'].isin(names)].reset_index(
+        drop=True)
+
+def ztf_summary(lightcurves, targets, recent_days=30.0):
+    """
+    Summarizes the ZTF light curves of the targets for the report: the number
+    of good epochs, how many of them are from the last recent_days days, the
+    date of the newest one and the newest magnitude in each band.
+
+    Returns a DataFrame with one row per target.
     """
-    
\ No newline at end of file
+    good = lightcurves[lightcurves['catflags'] == 0]
+    now = Time.now().mjd
+    rows = []
+    for target in targets:
+        epochs = good[good['target'] == target['name']].sort_values("mjd")
+        row = {"target":target['name'],
+               "epochs":len(epochs),
+               "recent_epochs":int((epochs['mjd'] > now - recent_days).sum()),
+               "last_epoch":"NA"}
+        if len(epochs) > 0:
+            row['last_epoch'] = Time(epochs['mjd'].iloc[-1],
+                                     format='mjd').iso.split()[0]
+        for band in ["g", "r", "i"]:
+            in_band = epochs[epochs['filtercode'] == "z" + band]
+            if len(in_band) > 0:
+                row[band] = ("{0:.3f}".format(in_band['mag'].iloc[-1])
+                             + "$\\pm$"
+                             + "{0:0.3f}".format(in_band['magerr'].iloc[-1]))
+            else:
+                row[band] = "NA"
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -0,0 +1,229 @@
+import numpy as np
+import pandas as pd
+from matplotlib.artist import setp
+import matplotlib.dates as mdates
+
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import TETE
+from astropy.coordinates import get_body
+
+import dino_tools as tools
+import multisite
+
+# how fast the sidereal time runs, in degrees per solar day
+SIDEREAL_RATE = 360.98564736629
+
+def night_grid(start, end, observer, time_step=10.0):
+    """
+    Samples every night from the evening of start to the evening of end, both
+    dates, time_step minutes apart from local noon to local noon.
+
+    Returns the dates of the evenings as a list of str and an
+    (n_nights, n_samples) array of UTC Julian dates.
+    """
+    first = Time(start.split()[0] + " 12:00:00", scale='utc')
+    last = Time(end.split()[0] + " 12:00:00", scale='utc')
+    n_nights = int(np.round((last - first).to_value(u.day))) + 1
+    noon = first.jd + np.arange(n_nights) - observer.location.lon.deg/360
+    samples = np.arange(0, 24*60, time_step)/(24*60)
+    dates = [(first + k*u.day).iso.split()[0] for k in range(0, n_nights)]
+    return dates, noon[:, np.newaxis] + samples[np.newaxis, :]
+
+def compute(observer, targets, start, end, time_step=10.0, max_airmass=2.0,
+            sun_alt_limit=-18.0, chunk_size=32):
+    """
+    Computes how well placed every target is on every night of a date range,
+    vectorized over the targets and the nights.
+
+    Like multisite.compare_sites, the sun and the targets are computed as
+    seen from the center of the earth and turned into altitudes with the
+    local sidereal time. The sun and the sidereal time are computed once a
+    day. Fixed targets use their apparent position in the middle of the
+    range, other targets their position at the local midnight of each night.
+
+    Parameters
+    -----------
+
+    observer : astroplan.Observer
+        The observer, from dino_tools.setup_location.
+
+    targets : list of dicts
+        The targets from dino_tools.setup_target_list.
+
+    start, end : str
+        The dates of the evenings of the first and last night, e.g.
+        "2024-01-01".
+
+    time_step : float
+        The spacing of the samples within each night in minutes.
+        Defaults to 10.0.
+
+    max_airmass : float
+        The highest airmass at which a target counts as observable.
+        Defaults to 2.0.
+
+    sun_alt_limit : float
+        The highest sun altitude, in degrees, that counts as dark.
+        Defaults to -18.0, astronomical twilight.
+
+    chunk_size : int
+        How many nights are computed at once, which limits the memory used.
+        Defaults to 32.
+
+    Returns a dict with
+        'dates' : the dates of the evenings of the nights
+        'names' : the names of the targets
+        'hours' : (n_targets, n_nights) dark hours below max_airmass
+        'max_alt' : (n_targets, n_nights) highest altitude in dark time, in
+                    degrees, NaN on nights without dark time
+        'transit_alt' : (n_targets,) altitude at the meridian, in degrees
+        'moon_sep' : (n_targets, n_nights) separation from the moon at local
+                     midnight, in degrees
+        'moon_illumination' : (n_nights,) illuminated fraction of the moon at
+                              local midnight
+        'dark_hours' : (n_nights,) hours of dark time
+    """
+    dates, jd = night_grid(start, end, observer, time_step=time_step)
+    n_nights, n_samples = jd.shape
+    lon = observer.location.lon.deg
+    lat = observer.location.lat.deg
+    min_alt = 90.0 - np.degrees(np.arccos(1/max_airmass))
+
+    # the sun moves about a degree a day, so it is computed at each local
+    # noon and interpolated in between, and the sidereal time runs at a
+    # constant rate from each local noon
+    noons = Time(np.append(jd[:, 0], jd[-1, 0] + 1), format='jd', scale='utc')
+    sun = get_body("sun", noons).transform_to(TETE(obstime=noons))
+    sun_ra = np.interp(jd, noons.jd,
+                       np.degrees(np.unwrap(np.radians(sun.ra.deg))))
+    sun_dec = np.interp(jd, noons.jd, sun.dec.deg)
+    gast = noons[:-1].sidereal_time('apparent', 'greenwich').deg
+    lst = (gast[:, np.newaxis] + lon
+           + SIDEREAL_RATE*(jd - jd[:, :1]))
+    sun_alt = multisite._altitude(lat, lst - sun_ra, sun_dec)
+    dark = sun_alt < sun_alt_limit
+
+    # the targets and the moon once per night, at local midnight
+    midnight = Time(jd[:, n_samples//2], format='jd', scale='utc')
+    ra, dec = multisite._apparent_coords(targets, midnight)
+    moon = get_body("moon", midnight).transform_to(TETE(obstime=midnight))
+    moon_sep = tools._angular_separation(moon.ra.deg[np.newaxis],
+                                         moon.dec.deg[np.newaxis], ra, dec)
+
+    hours = np.zeros((len(targets), n_nights))
+    max_alt = np.full((len(targets), n_nights), np.nan)
+    for k in range(0, n_nights, chunk_size):
+        nights = slice(k, min(k + chunk_size, n_nights))
+        # (n_targets, n_chunk, n_samples)
+        alt = multisite._altitude(
+            lat, (lst[np.newaxis, nights] - ra[:, nights, np.newaxis]),
+            dec[:, nights, np.newaxis]).astype(np.float32)
+        chunk_dark = dark[np.newaxis, nights]
+        hours[:, nights] = ((alt >= min_alt) & chunk_dark).sum(axis=-1)
+        dark_alt = np.where(chunk_dark, alt, -np.inf).max(axis=-1)
+        max_alt[:, nights] = np.where(np.isfinite(dark_alt), dark_alt, np.nan)
+    hours = hours*time_step/60
+
+    return {"dates":dates,
+            "names":[target['name'] for target in targets],
+            "hours":hours,
+            "max_alt":max_alt,
+            "transit_alt":90.0 - np.abs(lat - dec.mean(axis=1)),
+            "moon_sep":moon_sep,
+            "moon_illumination":np.atleast_1d(
+                observer.moon_illumination(midnight)),
+            "dark_hours":dark.sum(axis=-1)*time_step/60}
+
+def tables(result, min_moon_sep=30.0):
+    """
+    Turns a compute result into two DataFrames: the dark hours of every
+    target (rows) on every night (columns), and the best night of every
+    target, the night with the most hours where the moon is at least
+    min_moon_sep degrees away, with its hours, highest altitude and moon
+    separation.
+    """
+    hours = pd.DataFrame(np.round(result['hours'], 2), index=result['names'],
+                         columns=result['dates'])
+    hours.index.name = "target"
+
+    score = np.where(result['moon_sep'] >= min_moon_sep, result['hours'], -1)
+    best = np.argmax(score, axis=1)
+    rows = []
+    for i in range(0, len(result['names'])):
+        k = best[i]
+        found = score[i, k] > 0
+        rows.append({"target":result['names'][i],
+                     "best_night":result['dates'][k] if found else "NA",
+                     "hours":round(result['hours'][i, k], 2) if found else 0.0,
+                     "max_alt":("{0:.1f}".format(result['max_alt'][i, k])
+                                if found else "NA"),
+                     "moon_sep":("{0:.1f}".format(result['moon_sep'][i, k])
+                                 if found else "NA"),
+                     "transit_alt":"{0:.1f}".format(
+                         result['transit_alt'][i]),
+                     "nights":int((score[i] > 0).sum())})
+    return hours, pd.DataFrame(rows)
+
+def plot(result, min_moon_sep=30.0, path="./report_plots"):
+    """
+    Plots the dark hours of every target on every night as a heatmap, with
+    the nights where the target is closer than min_moon_sep degrees to the
+    moon dimmed, and the moon illumination above it. Saved as
+    observability.jpg.
+
+    If path is None nothing is written, and the image is returned as an
+    io.BytesIO instead of the figure.
+    """
+    n_targets, n_nights = result['hours'].shape
+    dates = mdates.date2num(pd.to_datetime(result['dates']))
+    extent = [dates[0] - 0.5, dates[-1] + 0.5, n_targets - 0.5, -0.5]
+
+    fig = tools.new_figure(
+        figsize=(12, max(4, 1.5 + 0.2*min(n_targets, 60))))
+    ax_moon, ax = fig.subplots(2, 1, sharex=True,
+                               gridspec_kw={'height_ratios':[1, 8]})
+
+    ax_moon.fill_between(dates, result['moon_illumination'],
+                         color="xkcd:grey", step='mid')
+    ax_moon.set_ylim(0, 1)
+    ax_moon.set_ylabel("Moon")
+
+    image = ax.imshow(result['hours'], aspect='auto', extent=extent,
+                      cmap="viridis", interpolation='nearest')
+    ax.imshow(np.where(result['moon_sep'] < min_moon_sep, 1.0, np.nan),
+              aspect='auto', extent=extent, cmap="Greys", vmin=0, vmax=1.5,
+              alpha=0.5, interpolation='nearest')
+    if n_targets <= 60:
+        ax.set_yticks(np.arange(n_targets))
+        ax.set_yticklabels(result['names'])
+    else:
+        ax.set_ylabel("Target")
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    setp(ax.get_xticklabels(), rotation=20, ha='right')
+    ax.set_xlabel("Night")
+    fig.colorbar(image, ax=[ax_moon, ax], label="Dark hours",
+                 fraction=0.03, pad=0.01)
+
+    image = tools.save_figure(fig, path, "observability.jpg",
+                              bbox_inches='tight')
+    if path is None:
+        return image
+    return fig
+
+def write_reports(observer, targets, start, end, min_moon_sep=30.0,
+                  path="./report_plots", **compute_kwargs):
+    """
+    Computes the observability of the targets over a date range and writes
+    observability.csv with the hours of every night, observability_best.csv
+    with the best night of every target, and the heatmap, see plot.
+
+    Returns the compute result.
+    """
+    result = compute(observer, targets, start, end, **compute_kwargs)
+    hours, best = tables(result, min_moon_sep=min_moon_sep)
+    hours.to_csv("{0}/observability.csv".format(path))
+    best.to_csv("{0}/observability_best.csv".format(path), index=False)
+    plot(result, min_moon_sep=min_moon_sep, path=path)
+    return result
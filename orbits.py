@@ -0,0 +1,274 @@
+import os
+import re
+import json
+
+import numpy as np
+
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import get_body_barycentric
+from astropy.constants import c
+
+import network
+
+# Gaussian gravitational constant, in AU^(3/2) / day
+K_GAUSS = 0.01720209895
+# obliquity of the J2000 ecliptic used by Horizons, in degrees
+OBLIQUITY = 84381.448/3600
+
+def _cache_path(target_id, cache_dir):
+    name = re.sub(r'[^A-Za-z0-9]+', '_', str(target_id)).strip('_')
+    return "{0}/elements_{1}.json".format(cache_dir, name)
+
+def fetch_elements(target_id, epoch, max_age=30.0, cache_dir="./data/cache"):
+    """
+    Returns the heliocentric osculating elements of a small body, from the
+    cache if it has elements within max_age days of epoch, otherwise from
+    Horizons.
+
+    Parameters
+    -----------
+
+    target_id : str
+        The name or designation of the small body, as given to Horizons.
+
+    epoch : astropy.time.Time
+        The time the elements should be valid for, usually the night.
+
+    max_age : float
+        How far, in days, the epoch of cached elements may be from epoch.
+        Defaults to 30.0.
+
+    Returns a dict with the perihelion distance 'q' in AU, the eccentricity
+    'e', the inclination 'incl', longitude of the ascending node 'Omega' and
+    argument of perihelion 'w' in degrees, the time of perihelion 'Tp' and the
+    'epoch' of the elements as TDB Julian dates.
+    """
+    path = _cache_path(target_id, cache_dir)
+    if os.path.exists(path):
+        with open(path) as f:
+            elements = json.load(f)
+        if abs(elements['epoch'] - epoch.tdb.jd) <= max_age:
+            return elements
+
+    table = network.run(network.horizons_elements(target_id, 'smallbody',
+                                                  epoch.tdb.jd))
+    elements = {"target":str(target_id),
+                "epoch":float(table['datetime_jd'][0]),
+                "q":float(table['q'][0]),
+                "e":float(table['e'][0]),
+                "incl":float(table['incl'][0]),
+                "Omega":float(table['Omega'][0]),
+                "w":float(table['w'][0]),
+                "Tp":float(table['Tp_jd'][0])}
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(elements, f, indent=4)
+    return elements
+
+def _minus_sin(E):
+    """
+    E - sin(E), without the cancellation of the direct difference for small
+    E, where the series is used.
+    """
+    E = np.asarray(E, dtype=float)
+    series = np.zeros(E.shape)
+    term = E**3/6
+    for n in range(0, 10):
+        series = series + term
+        term = -term*E**2/((2*n + 4)*(2*n + 5))
+    return np.where(np.abs(E) < 0.5, series, E - np.sin(E))
+
+def _sinh_minus(H):
+    """
+    sinh(H) - H, without the cancellation of the direct difference for small
+    H, where the series is used.
+    """
+    H = np.asarray(H, dtype=float)
+    series = np.zeros(H.shape)
+    term = H**3/6
+    for n in range(0, 10):
+        series = series + term
+        term = term*H**2/((2*n + 4)*(2*n + 5))
+    return np.where(np.abs(H) < 0.5, series, np.sinh(H) - H)
+
+def _solve_kepler(M, e):
+    """
+    Solves Kepler's equation for the eccentric anomaly of an elliptic orbit
+    (e < 1) or the hyperbolic anomaly of a hyperbolic one (e > 1), for an
+    array of mean anomalies in radians.
+
+    The equations are written as (1 - e)E + e(E - sin E) = M and
+    (e - 1)H + e(sinh H - H) = M, so orbits close to parabolic, where both
+    terms are tiny near perihelion, keep their precision.
+    """
+    M = np.asarray(M, dtype=float)
+    if e < 1:
+        # adding pi would round away tiny mean anomalies
+        M = np.where(np.abs(M) > np.pi,
+                     np.remainder(M + np.pi, 2*np.pi) - np.pi, M)
+        # near perihelion of an almost parabolic orbit E is about (6M)^(1/3)
+        E = np.where(e > 0.8, np.clip(np.cbrt(6*M), -np.pi, np.pi), M)
+        for i in range(0, 50):
+            dE = (((1 - e)*E + e*_minus_sin(E) - M)
+                  /((1 - e) + 2*e*np.sin(E/2)**2))
+            E = E - dE
+            if np.all(np.abs(dE) <= 1e-14*np.maximum(np.abs(E), 1e-6)):
+                break
+    else:
+        E = np.where(np.abs(M) < 6*e, np.cbrt(6*M/e), np.arcsinh(M/e))
+        for i in range(0, 50):
+            dE = (((e - 1)*E + e*_sinh_minus(E) - M)
+                  /((e - 1) + 2*e*np.sinh(E/2)**2))
+            E = E - dE
+            if np.all(np.abs(dE) <= 1e-14*np.maximum(np.abs(E), 1e-6)):
+                break
+    return E
+
+def heliocentric_position(elements, jd_tdb):
+    """
+    Propagates the elements to the given TDB Julian dates on a two-body
+    orbit around the sun.
+
+    Returns a (3, n) array with the heliocentric position in AU in the ICRS
+    (equatorial J2000) orientation.
+    """
+    jd_tdb = np.atleast_1d(np.asarray(jd_tdb, dtype=float))
+    q = elements['q']
+    e = elements['e']
+    dt = jd_tdb - elements['Tp']
+
+    if abs(e - 1) < 1e-8:
+        # parabolic, Barker's equation
+        W = 3*K_GAUSS*dt/np.sqrt(2*q**3)
+        s = np.cbrt(W/2 + np.sqrt(W**2/4 + 1)) + np.cbrt(W/2 - np.sqrt(W**2/4
+                                                                    + 1))
+        x = q*(1 - s**2)
+        y = 2*q*s
+    elif e < 1:
+        a = q/(1 - e)
+        E = _solve_kepler(K_GAUSS*dt/a**1.5, e)
+        # q - a(1 - cos E), as cos E - e cancels for almost parabolic orbits
+        x = q - 2*a*np.sin(E/2)**2
+        y = a*np.sqrt(1 - e**2)*np.sin(E)
+    else:
+        a = q/(e - 1)
+        H = _solve_kepler(K_GAUSS*dt/a**1.5, e)
+        x = q - 2*a*np.sinh(H/2)**2
+        y = a*np.sqrt(e**2 - 1)*np.sinh(H)
+
+    # perifocal -> ecliptic -> equatorial
+    Om, i, w = np.radians([elements['Omega'], elements['incl'],
+                           elements['w']])
+    P = np.array([np.cos(w)*np.cos(Om) - np.sin(w)*np.sin(Om)*np.cos(i),
+                  np.cos(w)*np.sin(Om) + np.sin(w)*np.cos(Om)*np.cos(i),
+                  np.sin(w)*np.sin(i)])
+    Q = np.array([-np.sin(w)*np.cos(Om) - np.cos(w)*np.sin(Om)*np.cos(i),
+                  -np.sin(w)*np.sin(Om) + np.cos(w)*np.cos(Om)*np.cos(i),
+                  np.cos(w)*np.sin(i)])
+    ecliptic = P[:, None]*x + Q[:, None]*y
+    eps = np.radians(OBLIQUITY)
+    rotation = np.array([[1, 0, 0],
+                         [0, np.cos(eps), -np.sin(eps)],
+                         [0, np.sin(eps), np.cos(eps)]])
+    return rotation @ ecliptic
+
+def propagate(elements, times, location=None):
+    """
+    Computes the astrometric coordinates of a small body at each of the
+    given times, from its orbital elements.
+
+    The position is corrected for light time and, if location is given, seen
+    from that astropy.coordinates.EarthLocation instead of the center of the
+    earth. Perturbations by the planets are ignored, so the elements should
+    be from close to the times, see fetch_elements.
+
+    Returns a SkyCoord array in ICRS.
+    """
+    times = Time(times)
+    if times.isscalar:
+        times = times.reshape((1,))
+    jd_tdb = times.tdb.jd
+
+    # where the observer is, relative to the sun
+    observer = (get_body_barycentric('earth', times).xyz.to_value(u.au)
+                - get_body_barycentric('sun', times).xyz.to_value(u.au))
+    if location is not None:
+        gcrs, _ = location.get_gcrs_posvel(times)
+        observer = observer + gcrs.xyz.to_value(u.au)
+
+    # light time, the body is seen where it was when the light left it
+    light_days = (1*u.au/c).to_value(u.day)
+    delay = np.zeros(len(jd_tdb))
+    for i in range(0, 3):
+        rho = heliocentric_position(elements, jd_tdb - delay) - observer
+        delay = np.linalg.norm(rho, axis=0)*light_days
+
+    # no distance, like the Horizons RA and DEC, so astropy does not apply the
+    # parallax a second time when transforming to AltAz
+    ra = np.degrees(np.arctan2(rho[1], rho[0])) % 360
+    dec = np.degrees(np.arcsin(rho[2]/np.linalg.norm(rho, axis=0)))
+    return SkyCoord(ra=ra*u.deg, dec=dec*u.deg)
+
+def validate(elements, target_id, times, location=None):
+    """
+    Compares the locally propagated positions of a small body with the
+    Horizons ephemerides at the given times.
+
+    Returns the largest separation in arcseconds.
+    """
+    times = Time(times)
+    if location is not None:
+        site = {"lon":location.lon.deg, "lat":location.lat.deg,
+                "elevation":location.height.to_value(u.km)}
+    else:
+        site = None
+    table = network.run(network.horizons_ephemerides(target_id, 'smallbody',
+                                                     list(times.jd), site))
+    horizons = SkyCoord(ra=np.asarray(table['RA'])*u.deg,
+                        dec=np.asarray(table['DEC'])*u.deg)
+    local = propagate(elements, times, location)
+    return horizons.separation(local).arcsec.max()
+
+def setup_orbits(targets, times, location=None, tolerance=10.0,
+                 do_validate=True, max_age=30.0, cache_dir="./data/cache"):
+    """
+    Fetches the orbital elements of all small-body targets, so their
+    positions are computed locally from then on instead of by Horizons.
+
+    The elements are stored in target['elements']. With do_validate they are
+    only used if they match Horizons within tolerance arcseconds over the
+    observing window, otherwise the target keeps using Horizons.
+    """
+    window = Time(times['obs_window'])
+    if window.isscalar:
+        window = window.reshape((1,))
+    epoch = window[len(window)//2]
+    # the start, middle and end of the night
+    check_times = window[[0, len(window)//2, -1]]
+    for target in targets:
+        if target['type'] != "smallbody":
+            continue
+        try:
+            elements = fetch_elements(target['name'], epoch, max_age=max_age,
+                                      cache_dir=cache_dir)
+        except:
+            print("No orbital elements for {0}, using Horizons".format(
+                target['name']))
+            continue
+        if do_validate:
+            try:
+                error = validate(elements, target['name'], check_times,
+                                 location)
+            except:
+                # e.g. offline, trust the cached elements
+                print("Could not check the orbit of {0}".format(
+                    target['name']))
+                error = 0.0
+            if error > tolerance:
+                print("Orbit of {0} is off by {1} arcsec, using "
+                      "Horizons".format(target['name'], error))
+                continue
+        target['elements'] = elements
+    return targets
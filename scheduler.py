@@ -0,0 +1,206 @@
+import numpy as np
+import pandas as pd
+
+import astropy.units as u
+from astropy.time import Time
+
+import dino_tools as tools
+
+def _block_windows(times):
+    """
+    Returns a list of (name, start, end) tuples for the blocks of the night.
+    If no blocks are defined the whole observing window is used as one block.
+    """
+    windows = []
+    if times['blocks'] != None:
+        for i in range(0, len(times['blocks'])):
+            block = times['blocks'][i]
+            windows.append(("Block " + str(i+1), Time(block['times'][0]),
+                            Time(block['times'][-1])))
+    else:
+        try:
+            iter(times['obs_window'])
+            windows.append(("Night", times['obs_window'][0],
+                            times['obs_window'][-1]))
+        except:
+            windows.append(("Night", times['obs_window'], times['sunrise']))
+    return windows
+
+def visibility_grid(observer, times, targets, max_airmass=2.0,
+                    min_moon_sep=30.0, time_step=5.0):
+    """
+    Computes a vectorized visibility grid over all observing blocks.
+
+    Parameters
+    -----------
+
+    observer : astroplan.Observer
+        The observer for the night.
+
+    times : dict
+        The times dictionary from dino_tools.setup_times.
+
+    targets : list of dicts
+        The targets from dino_tools.setup_target_list.
+
+    max_airmass : float
+        The highest airmass at which a target counts as observable.
+        Defaults to 2.0.
+
+    min_moon_sep : float
+        The smallest separation from the moon, in degrees, at which a target
+        counts as observable.
+        Defaults to 30.0.
+
+    time_step : float
+        The spacing of the grid in minutes.
+        Defaults to 5.0.
+
+    Returns a dict with the sampled times, the block each sample belongs to,
+    the names and end times of the blocks, the moon grid from
+    dino_tools.moon_grid, and (n_targets, n_times) arrays of airmass and
+    observability.
+    """
+    windows = _block_windows(times)
+    grid_times = []
+    block_index = []
+    for i in range(0, len(windows)):
+        name, start, end = windows[i]
+        # the tolerance keeps e.g. 239.99999999999994 minutes from losing
+        # the last sample of the block
+        n_samples = max(int(np.floor((end - start).to_value(u.min)/time_step
+                                     + 1e-6)), 1)
+        grid_times.append(start + np.arange(n_samples)*time_step*u.min)
+        block_index.append(np.full(n_samples, i))
+    grid_times = Time(np.concatenate([t.jd for t in grid_times]), format='jd')
+    block_index = np.concatenate(block_index)
+
+    alt, az = tools.altaz_grid(observer, targets, grid_times)
+
+    moon = tools.moon_grid(observer, targets, grid_times)
+
+    zenith = np.radians(90.0 - alt)
+    airmass = np.where(alt > 0, 1./np.cos(np.clip(zenith, 0, np.pi/2 - 1e-6)),
+                       np.inf)
+    observable = ((airmass <= max_airmass)
+                  & tools.moon_constraint(moon, min_moon_sep))
+
+    return {"times":grid_times, "block_index":block_index,
+            "block_names":[w[0] for w in windows],
+            "block_ends":[w[2] for w in windows], "airmass":airmass,
+            "moon":moon, "observable":observable,
+            "time_step":time_step}
+
+def schedule(observer, times, targets, priorities=None, exposure_times=None,
+             default_priority=5, default_exposure=30.0, max_airmass=2.0,
+             min_moon_sep=30.0, time_step=5.0):
+    """
+    Assigns targets to the observing blocks of the night.
+
+    Targets are handled in order of priority (1 is the highest). Each target is
+    put in the free stretch of time, within a single block, where it can be
+    observed for its full exposure time at the lowest mean airmass. The
+    block dicts in times['blocks'] get a 'targets' list with the names of the
+    targets assigned to them.
+
+    Parameters
+    -----------
+
+    priorities : dict
+        Target name to priority, where 1 is the highest priority.
+        Targets not listed get default_priority.
+
+    exposure_times : dict
+        Target name to the total time needed on the target, in minutes.
+        Targets not listed get default_exposure.
+
+    max_airmass, min_moon_sep, time_step :
+        Passed on to visibility_grid.
+
+    Returns a pandas DataFrame with one row per target, with the block, start
+    and end time, and mean airmass of each scheduled target. Targets that could
+    not be scheduled are listed with the block "unscheduled".
+    """
+    if type(targets) != list:
+        target_list = [targets]
+    else:
+        target_list = targets
+    if priorities is None:
+        priorities = {}
+    if exposure_times is None:
+        exposure_times = {}
+
+    grid = visibility_grid(observer, times, target_list,
+                           max_airmass=max_airmass, min_moon_sep=min_moon_sep,
+                           time_step=time_step)
+    observable = grid['observable']
+    airmass = grid['airmass']
+    block_index = grid['block_index']
+    n_blocks = len(grid['block_names'])
+
+    block_bounds = [np.flatnonzero(block_index == b) for b in range(n_blocks)]
+    free = np.ones(len(block_index), dtype=bool)
+
+    # highest priority first, then the hardest to fit
+    n_observable = observable.sum(axis=1)
+    order = sorted(range(0, len(target_list)),
+                   key=lambda i: (priorities.get(target_list[i]['name'],
+                                                 default_priority),
+                                  n_observable[i]))
+
+    rows = []
+    assigned = [[] for b in range(n_blocks)]
+    for i in order:
+        name = target_list[i]['name']
+        exposure = exposure_times.get(name, default_exposure)
+        n_needed = max(int(np.ceil(exposure/time_step)), 1)
+        best = None
+        for b in range(n_blocks):
+            start = block_bounds[b][0]
+            stop = block_bounds[b][-1] + 1
+            if stop - start < n_needed:
+                continue
+            ok = observable[i, start:stop] & free[start:stop]
+            # count of observable samples in every window of length n_needed
+            counts = np.convolve(ok, np.ones(n_needed, dtype=int), 'valid')
+            fits = np.flatnonzero(counts == n_needed)
+            if len(fits) == 0:
+                continue
+            # mean airmass of every window that fits
+            window_airmass = np.convolve(np.where(ok, airmass[i, start:stop],
+                                                  0.0),
+                                         np.ones(n_needed), 'valid')[fits]
+            k = np.argmin(window_airmass)
+            mean_airmass = window_airmass[k]/n_needed
+            if best is None or mean_airmass < best[2]:
+                best = (b, start + fits[k], mean_airmass)
+
+        row = {"blockname":"unscheduled", "target":name,
+               "priority":priorities.get(name, default_priority),
+               "starttime":"NA", "endtime":"NA", "airmass":"NA",
+               "_order":np.inf}
+        if best is not None:
+            b, j, mean_airmass = best
+            start_time = grid['times'][j]
+            end_time = start_time + exposure*u.min
+            if end_time > grid['block_ends'][b]:
+                end_time = grid['block_ends'][b]
+            free[j:j+n_needed] = False
+            assigned[b].append(name)
+            row.update({"blockname":grid['block_names'][b],
+                        "starttime":start_time.iso.split()[1][:8],
+                        "endtime":end_time.iso.split()[1][:8],
+                        "airmass":"{0:.2f}".format(mean_airmass),
+                        "_order":j})
+        rows.append(row)
+
+    if times['blocks'] != None:
+        for b in range(0, n_blocks):
+            times['blocks'][b]['targets'] = assigned[b]
+
+    # sort by time, with the unscheduled targets at the end
+    df = pd.DataFrame(rows, columns=["blockname", "target", "priority",
+                                     "starttime", "endtime", "airmass",
+                                     "_order"])
+    df = df.sort_values("_order", kind="stable").drop(columns="_order")
+    return df.reset_index(drop=True)
@@ -0,0 +1,148 @@
+import os
+import ast
+import sys
+import json
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import catalogs
+
+# how to build each sky culture. 'lines' is a CSV of the stick figures by HIP
+# number, either one segment per row ("pairs", with the constellation and the
+# two HIP columns named in 'columns') or one constellation per row with a list
+# of HIP numbers taken two by two ("lists", the format of the processed
+# asterism files). A new culture only needs an entry here.
+SKY_CULTURES = {
+    "IAU":{"lines":"./constellation_line_hip.csv", "format":"pairs",
+           "columns":["Abbreviation", "1", "2"]},
+    "rey":{"lines":"./data/processed/asterisms_rey.csv", "format":"lists"}
+}
+
+# star positions for HIP numbers that are not in the star catalog
+POSITIONS = "./star_name_position_hip.csv"
+
+# the constellations of the zodiac, drawn in their own color
+ZODIAC = ["Aqr", "Ari", "Cap", "Cnc", "Gem", "Leo", "Lib", "Psc", "Sco", "Sgr",
+          "Tau", "Vir"]
+
+def _read_lines(spec):
+    """
+    Reads the stick figures of a sky culture into a DataFrame with one row
+    per segment, with the 'constellation' and the HIP numbers 'hip1' and
+    'hip2' of its ends. For "lists" files the positions written next to the
+    HIP numbers are returned too, as a DataFrame of 'hip', 'ra' and 'dec' in
+    degrees, otherwise None.
+    """
+    if spec['format'] == "pairs":
+        constellation, hip1, hip2 = spec['columns']
+        lines = pd.read_csv(spec['lines'], usecols=spec['columns'])
+        return pd.DataFrame({"constellation":lines[constellation].astype(str),
+                             "hip1":lines[hip1].astype(np.int64),
+                             "hip2":lines[hip2].astype(np.int64)}), None
+
+    lines = pd.read_csv(spec['lines'])
+    constellations, hips, ras, decs = [], [], [], []
+    for index, row in lines.iterrows():
+        stars = [int(x) for x in ast.literal_eval(row['stars'])]
+        n = 2*(len(stars)//2)
+        constellations += [row['constellation']]*(n//2)
+        hips.append(stars[:n])
+        # RA is in hours in the processed files
+        ras.append(np.array(ast.literal_eval(row['ra'])[:n])*360/24)
+        decs.append(np.array(ast.literal_eval(row['dec'])[:n]))
+    hips = np.concatenate(hips).astype(np.int64)
+    segments = pd.DataFrame({"constellation":constellations,
+                             "hip1":hips[0::2], "hip2":hips[1::2]})
+    listed = pd.DataFrame({"hip":hips, "ra":np.concatenate(ras),
+                           "dec":np.concatenate(decs)})
+    return segments, listed
+
+def _star_positions(listed=None):
+    """
+    Returns the positions of all HIP stars as a DataFrame indexed by HIP
+    number with 'ra' and 'dec' in degrees: from the star catalog where it has
+    them, then from POSITIONS, then from the positions listed in the sky
+    culture file itself.
+    """
+    stars = catalogs.load_catalog("stars", columns=["hip", "ra", "dec"])
+    stars = stars[stars['hip'].notna()]
+    tables = [pd.DataFrame({"hip":stars['hip'].astype(np.int64),
+                            "ra":stars['ra'].astype(float)*360/24,
+                            "dec":stars['dec'].astype(float)})]
+    if os.path.exists(POSITIONS):
+        positions = pd.read_csv(POSITIONS, usecols=[0, 1, 2])
+        positions.columns = ["hip", "ra", "dec"]
+        tables.append(positions.astype({"hip":np.int64}))
+    if listed is not None:
+        tables.append(listed)
+    positions = pd.concat(tables, ignore_index=True)
+    return positions.drop_duplicates("hip", keep="first").set_index("hip")
+
+def sources(name):
+    """
+    Returns the files a compiled sky culture is built from.
+    """
+    return [SKY_CULTURES[name]['lines'], catalogs.catalog_path("stars"),
+            POSITIONS]
+
+def build(name):
+    """
+    Compiles a sky culture from SKY_CULTURES into
+    catalogs.SKY_CULTURE_PATH, a numpy file with the ends of every segment
+    already joined to the star positions, which
+    catalogs.load_asterism_segments reads.
+
+    The HIP numbers of all segment ends are looked up in the star positions
+    with one join per end. Segments with a star that cannot be found are left
+    out with a warning.
+
+    Returns the segments as catalogs.load_asterism_segments does.
+    """
+    if name not in SKY_CULTURES:
+        raise ValueError("unknown sky culture {0}, the known ones are "
+                         "{1}".format(name, ", ".join(SKY_CULTURES)))
+    print("compiling the {0} sky culture...".format(name))
+    segments, listed = _read_lines(SKY_CULTURES[name])
+    positions = _star_positions(listed)
+    for end in ["1", "2"]:
+        segments = segments.join(
+            positions.rename(columns={"ra":"ra" + end, "dec":"dec" + end}),
+            on="hip" + end)
+    missing = segments[['ra1', 'ra2']].isna().any(axis=1)
+    if missing.any():
+        hips = np.union1d(segments['hip1'][segments['ra1'].isna()],
+                          segments['hip2'][segments['ra2'].isna()])
+        warnings.warn("sky culture {0}: no position for HIP {1}, leaving out "
+                      "{2} segments".format(name, ", ".join(map(str, hips)),
+                                            int(missing.sum())))
+        segments = segments[~missing]
+
+    compiled = {"constellation":segments['constellation'].to_numpy(dtype=str),
+                "hip1":segments['hip1'].to_numpy(),
+                "hip2":segments['hip2'].to_numpy(),
+                "zodiac":segments['constellation'].isin(ZODIAC).to_numpy()}
+    for key in ["ra1", "dec1", "ra2", "dec2"]:
+        compiled[key] = segments[key].to_numpy(dtype=float)
+    sources = {path:os.path.getmtime(path) for path in sources(name)
+               if os.path.exists(path)}
+    np.savez(catalogs.SKY_CULTURE_PATH.format(name),
+             meta=np.array(json.dumps({"name":name, "sources":sources})),
+             **compiled)
+    return compiled
+
+def build_all():
+    """
+    Compiles every sky culture in SKY_CULTURES.
+    """
+    for name in SKY_CULTURES:
+        segments = build(name)
+        print("{0}: {1} segments".format(name, len(segments['ra1'])))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        for name in sys.argv[1:]:
+            build(name)
+    else:
+        build_all()
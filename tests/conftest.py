@@ -0,0 +1,11 @@
+import os
+import sys
+
+# the DINOS modules are flat files in the repository root, and read their data
+# from paths relative to it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import matplotlib
+matplotlib.use("agg")
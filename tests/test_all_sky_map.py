@@ -0,0 +1,26 @@
+import os
+
+import all_sky_map
+import catalogs
+import sky_cultures
+
+
+def test_background_sources_follow_the_star_catalog(tmp_path, monkeypatch):
+    stars = tmp_path / "stars.csv"
+    stars.write_text("hip,ra,dec\n")
+    monkeypatch.setattr(catalogs, "catalog_path", lambda catalog: str(stars))
+
+    before = all_sky_map._background_sources()
+    os.utime(stars, (1.0e9, 1.0e9))
+    after = all_sky_map._background_sources()
+
+    assert str(stars) in before
+    assert before != after
+
+
+def test_background_sources_of_an_unknown_sky_culture():
+    # the map falls back to the Rey asterisms, so its cache key does too
+    assert (all_sky_map._background_sources(sky_culture="nonsense")
+            == all_sky_map._background_sources(sky_culture="rey"))
+    assert (set(sky_cultures.sources("IAU"))
+            <= set(all_sky_map._background_sources(sky_culture="IAU")))
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.time import Time
+
+import almanac
+import dino_tools as tools
+import observability
+
+START, END = "2023-08-07", "2023-08-13"
+
+
+@pytest.fixture(scope="module")
+def table():
+    observer = tools.setup_location("NOT")
+    dates, jd = observability.night_grid(START, END, observer)
+    return observer, jd[:, 0], almanac.compute(observer, START, END)
+
+
+def _check(value, time, tolerance):
+    """
+    Compares an almanac time with an astroplan time, in minutes, where a
+    masked astroplan time means the event does not happen.
+    """
+    if np.ma.is_masked(time.jd):
+        assert value == "NA"
+    else:
+        assert value != "NA"
+        difference = (Time(value) - time).to_value(u.min)
+        assert abs(difference) < tolerance
+
+
+def test_sun_matches_astroplan(table):
+    observer, noons, result = table
+    for k in range(0, len(result)):
+        noon = Time(noons[k], format='jd')
+        sunset = observer.sun_set_time(noon, which="next", horizon=0*u.deg)
+        evening = observer.twilight_evening_astronomical(noon, which="next")
+        morning = observer.twilight_morning_astronomical(evening,
+                                                         which="next")
+        sunrise = observer.sun_rise_time(sunset, which="next",
+                                         horizon=0*u.deg)
+        row = result.iloc[k]
+        _check(row['sunset'], sunset, 1.0)
+        _check(row['ast_twl_evening'], evening, 1.0)
+        _check(row['ast_twl_morning'], morning, 1.0)
+        _check(row['sunrise'], sunrise, 1.0)
+
+
+def test_moon_matches_astroplan(table):
+    observer, noons, result = table
+    n_events = 0
+    for k in range(0, len(result)):
+        noon = Time(noons[k], format='jd')
+        row = result.iloc[k]
+        for column, function in [("moonrise", observer.moon_rise_time),
+                                 ("moonset", observer.moon_set_time)]:
+            time = function(noon, which="next", horizon=0*u.deg)
+            if time.jd > noon.jd + 1:
+                # not in this night, from noon to noon
+                assert row[column] == "NA"
+                continue
+            _check(row[column], time, 1.5)
+            n_events += 1
+    assert n_events > len(result)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from astropy.time import Time
+
+import dino_tools as tools
+import live
+import nightplan
+
+
+def _ephemeris(start, n=7, step=10.0):
+    jd = Time(start).jd + np.arange(n)*step/(24*60)
+    return {"jd":jd, "ra":np.linspace(359.0, 361.0, n) % 360,
+            "dec":np.linspace(10.0, 11.0, n)}
+
+
+def test_interpolate_ephemeris_across_0h():
+    ephemeris = _ephemeris("2023-08-07 22:00:00")
+    middle = Time(ephemeris['jd'][3], format='jd')
+    coord = tools.interpolate_ephemeris(ephemeris, middle)[0]
+    assert coord.ra.deg == pytest.approx(0.0, abs=1e-6)
+    assert coord.dec.deg == pytest.approx(10.5)
+
+
+def test_interpolate_ephemeris_refuses_times_outside():
+    ephemeris = _ephemeris("2023-08-07 22:00:00")
+    with pytest.raises(ValueError):
+        tools.interpolate_ephemeris(ephemeris, Time("2023-08-07 12:00:00"))
+    with pytest.raises(ValueError):
+        tools.interpolate_ephemeris(ephemeris, Time("2023-08-08 12:00:00"))
+    # both ends are inside
+    tools.interpolate_ephemeris(ephemeris,
+                                Time(ephemeris['jd'][[0, -1]], format='jd'))
+
+
+@pytest.mark.parametrize("start", ["2023-08-07 12:00:00",
+                                   "2023-08-06 22:00:00"])
+def test_ensure_ephemerides_drops_ephemerides_not_covering_now(monkeypatch,
+                                                               start):
+    # a plan for tonight viewed during the day, and one from last night
+    monkeypatch.setattr(nightplan, "attach_ephemerides",
+                        lambda observer, times, targets, step: targets)
+    now = Time("2023-08-07 09:00:00")
+    targets = [{"name":"tonight", "type":"smallbody",
+                "ephemeris":_ephemeris(start)},
+               {"name":"now", "type":"smallbody",
+                "ephemeris":_ephemeris("2023-08-07 08:30:00")}]
+    live._ensure_ephemerides(None, targets, now, 12.0)
+    assert 'ephemeris' not in targets[0]
+    assert 'ephemeris' in targets[1]
@@ -0,0 +1,68 @@
+import concurrent.futures
+
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+from astroplan import FixedTarget
+
+import finder_image
+import network
+
+
+def _target(name, ra, dec, color):
+    coord = SkyCoord(ra=ra, dec=dec, unit="deg")
+    return {"name":name, "target":FixedTarget(coord=coord, name=name),
+            "color":color}
+
+
+def _hdu(target):
+    coord = target['target'].coord.icrs
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [coord.ra.deg, coord.dec.deg]
+    wcs.wcs.crpix = [50, 50]
+    wcs.wcs.cdelt = [-1e-3, 1e-3]
+    return fits.PrimaryHDU(data=np.random.default_rng(0).random((100, 100)),
+                           header=wcs.to_header())
+
+
+def test_plot_batch_reticle_colors_after_fallback(monkeypatch):
+    targets = [_target("A", 10.0, 20.0, "xkcd:red"),
+               _target("B", 50.0, -10.0, "xkcd:green"),
+               _target("C", 120.0, 40.0, "xkcd:blue")]
+    hdus = [_hdu(targets[0]), None, _hdu(targets[2])]
+
+    # the batch download of B fails, and plot() downloads it again
+    def failed_cutouts(targets, **kwargs):
+        futures = []
+        for target in targets:
+            future = concurrent.futures.Future()
+            future.set_exception(ConnectionError("no connection"))
+            futures.append(future)
+        return futures
+
+    async def retried_download(position, survey, radius, **kwargs):
+        return _hdu(targets[1])
+
+    monkeypatch.setattr(finder_image, "start_cutouts", failed_cutouts)
+    monkeypatch.setattr(network, "skyview_image", retried_download)
+
+    # the reticle colors of every chart the batch figure saves
+    colors = []
+    save_tight = finder_image._save_tight
+    def recording_save_tight(fig, path, filename, **kwargs):
+        colors.append({line.get_color() for line in fig.axes[0].lines})
+        return save_tight(fig, path, filename, **kwargs)
+    monkeypatch.setattr(finder_image, "_save_tight", recording_save_tight)
+
+    reticle_style_kwargs = {"linewidth":3}
+    charts = finder_image.plot_batch(
+        targets, hdus=hdus, path=None,
+        reticle_style_kwargs=reticle_style_kwargs)
+
+    assert len(charts) == 3
+    assert all(chart.getbuffer().nbytes > 0 for chart in charts)
+    assert colors == [{"xkcd:red"}, {"xkcd:blue"}]
+    assert reticle_style_kwargs == {"linewidth":3}
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.coordinates import EarthLocation
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+from astroplan import FixedTarget
+from astroplan import Observer
+
+import dino_tools as tools
+import multisite
+
+DATE = "2023-08-07"
+
+
+def _sites():
+    paranal = Observer(location=EarthLocation.from_geodetic(
+        -70.40*u.deg, -24.63*u.deg, 2635*u.m), name="Paranal")
+    return [tools.setup_location("NOT"), paranal]
+
+
+def _minutes_off(hhmm, time):
+    """
+    Minutes between an "HH:MM" string and a Time, on the same UTC day or
+    the next, so a minute that was cut off counts as up to one minute.
+    """
+    hours, minutes = hhmm.split(":")
+    minute = (time.jd - 0.5) % 1*24*60
+    difference = (int(hours)*60 + int(minutes)) - minute
+    return (difference + 12*60) % (24*60) - 12*60
+
+
+@pytest.fixture(scope="module")
+def comparison():
+    target = FixedTarget(coord=SkyCoord(ra=280.0*u.deg, dec=-10.0*u.deg),
+                         name="T")
+    targets = [{"name":"T", "target":target, "type":"fixed",
+                "color":"xkcd:red"}]
+    return _sites(), targets, multisite.compare_sites(_sites(), targets,
+                                                      DATE, time_step=5.0)
+
+
+@pytest.mark.parametrize("n", [0, 1])
+def test_twilights_match_astroplan(comparison, n):
+    observers, targets, result = comparison
+    observer = observers[n]
+    row = result['sites'].iloc[n]
+    # local noon of the evening of the night
+    noon = (Time(DATE + " 12:00:00")
+            - observer.location.lon.deg/360*u.day)
+    evening = observer.twilight_evening_astronomical(noon, which="next")
+    morning = observer.twilight_morning_astronomical(evening, which="next")
+    sunset = observer.sun_set_time(noon, which="next", horizon=0*u.deg)
+    sunrise = observer.sun_rise_time(sunset, which="next", horizon=0*u.deg)
+    # the times are cut to the minute
+    for column, time in [("ast_twl_evening", evening),
+                         ("ast_twl_morning", morning),
+                         ("sunset", sunset), ("sunrise", sunrise)]:
+        assert -2 <= _minutes_off(row[column], time) <= 1, column
+
+
+@pytest.mark.parametrize("n", [0, 1])
+def test_target_altitudes_match_astroplan(comparison, n):
+    observers, targets, result = comparison
+    grid = result['grid']
+    # refraction is left out of compare_sites, and so of astroplan here
+    altaz = observers[n].altaz(grid['times'], targets[0]['target'])
+    assert np.abs(grid['alt'][n, 0] - altaz.alt.deg).max() < 0.05
+
+
+def test_crossing():
+    jd = np.linspace(0.0, 1.0, 101)
+    alt = np.array([30*np.sin(2*np.pi*jd), -30*np.sin(2*np.pi*jd)])
+    window = np.ones(alt.shape, dtype=bool)
+    setting = multisite._crossing(alt, jd, 15.0, window, rising=False)
+    rising = multisite._crossing(alt, jd, 15.0, window, rising=True)
+    assert setting[0] == pytest.approx(5/12, abs=1e-3)
+    assert rising[1] == pytest.approx(7/12, abs=1e-3)
+    # a level that is never reached, and a window that leaves out the pass
+    assert np.isnan(multisite._crossing(alt, jd, 45.0, window,
+                                        rising=True)).all()
+    window[:, 30:] = False
+    assert np.isnan(multisite._crossing(alt, jd, 15.0, window,
+                                        rising=False)[0])
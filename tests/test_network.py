@@ -0,0 +1,32 @@
+import time
+
+import network
+
+
+def test_backoff_does_not_hold_the_concurrency_limit(monkeypatch):
+    monkeypatch.setitem(network.SERVICES, "test",
+                        {"concurrency":1, "timeout":1.0, "retries":1,
+                         "backoff":1.0})
+    monkeypatch.delitem(network._semaphores, "test", raising=False)
+    events = []
+
+    def flaky():
+        if "failed" not in events:
+            events.append("failed")
+            raise ConnectionError("no connection")
+        events.append("retried")
+        return "flaky"
+
+    def steady():
+        events.append("steady")
+        return "steady"
+
+    async def both():
+        return await network.gather(network._call("test", flaky),
+                                     network._call("test", steady))
+
+    start = time.monotonic()
+    assert network.run(both()) == ["flaky", "steady"]
+    assert time.monotonic() - start >= 0.5
+    # the steady call ran while the flaky one was backing off
+    assert events == ["failed", "steady", "retried"]
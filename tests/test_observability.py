@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import get_body
+from astropy.time import Time
+from astroplan import FixedTarget
+
+import dino_tools as tools
+import observability
+
+
+@pytest.fixture(scope="module")
+def night():
+    observer = tools.setup_location("NOT")
+    target = FixedTarget(coord=SkyCoord(ra=280.0*u.deg, dec=-10.0*u.deg),
+                         name="T")
+    targets = [{"name":"T", "target":target, "type":"fixed",
+                "color":"xkcd:red"}]
+    result = observability.compute(observer, targets, "2023-08-07",
+                                   "2023-08-13", time_step=10.0)
+    dates, jd = observability.night_grid("2023-08-07", "2023-08-13",
+                                         observer, time_step=10.0)
+    return observer, target, result, jd
+
+
+def test_dark_hours_match_astroplan(night):
+    observer, target, result, jd = night
+    for k in range(0, len(result['dates'])):
+        noon = Time(jd[k, 0], format='jd')
+        evening = observer.twilight_evening_astronomical(noon, which="next")
+        morning = observer.twilight_morning_astronomical(evening,
+                                                         which="next")
+        hours = (morning - evening).to_value(u.hour)
+        # one sample of 10 minutes either way
+        assert result['dark_hours'][k] == pytest.approx(hours, abs=0.17)
+
+
+def test_hours_and_altitudes_match_astroplan(night):
+    observer, target, result, jd = night
+    for k in range(0, len(result['dates'])):
+        times = Time(jd[k], format='jd')
+        dark = observer.sun_altaz(times).alt.deg < -18.0
+        alt = observer.altaz(times, target).alt.deg
+        hours = (dark & (alt >= 30.0)).sum()*10/60
+        assert result['hours'][0, k] == pytest.approx(hours, abs=0.17)
+        assert result['max_alt'][0, k] == pytest.approx(alt[dark].max(),
+                                                        abs=0.1)
+
+
+def test_moon_separation_matches_astropy(night):
+    observer, target, result, jd = night
+    midnight = Time(jd[:, jd.shape[1]//2], format='jd')
+    # both seen from the center of the earth
+    moon = get_body("moon", midnight)
+    separation = moon.separation(target.coord.transform_to(moon.frame)).deg
+    assert np.abs(result['moon_sep'][0] - separation).max() < 0.1
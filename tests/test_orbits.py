@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+from scipy.integrate import solve_ivp
+
+import astropy.units as u
+from astropy.constants import c
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import get_body_barycentric
+from astropy.coordinates import get_body_barycentric_posvel
+from astropy.time import Time
+
+import orbits
+
+MU = orbits.K_GAUSS**2
+TP = 2460000.5
+
+
+def _reference(q, e, dts):
+    """
+    Integrates the two-body problem numerically from perihelion, in the
+    perifocal frame, as a reference independent of Kepler's equation.
+    """
+    state = [q, 0.0, 0.0, 0.0, np.sqrt(MU*(1 + e)/q), 0.0]
+    def accel(t, s):
+        return np.concatenate([s[3:], -MU*s[:3]/np.linalg.norm(s[:3])**3])
+    positions = []
+    for dt in dts:
+        solution = solve_ivp(accel, (0.0, dt), state, method="DOP853",
+                             rtol=1e-13, atol=1e-15)
+        positions.append(solution.y[:3, -1])
+    return np.array(positions).T
+
+
+def _perifocal(elements, jd):
+    """
+    heliocentric_position rotated back from the equator to the ecliptic,
+    which is the perifocal frame when all angles are zero.
+    """
+    eps = np.radians(orbits.OBLIQUITY)
+    rotation = np.array([[1, 0, 0],
+                         [0, np.cos(eps), -np.sin(eps)],
+                         [0, np.sin(eps), np.cos(eps)]])
+    return rotation.T @ orbits.heliocentric_position(elements, jd)
+
+
+@pytest.mark.parametrize("q, e", [
+    (2.55, 0.078),       # main belt asteroid
+    (0.586, 0.967),      # Halley-like comet
+    (0.256, 1.2),        # hyperbolic, like 1I/'Oumuamua
+    (1.0, 1.0),          # parabolic, Barker's equation
+    (1.0, 1 - 1e-5),     # near-parabolic, both sides of e = 1
+    (1.0, 1 + 1e-5),
+    (1.0, 1 - 1e-7),
+    (1.0, 1 + 1e-7)])
+def test_heliocentric_position_matches_two_body_integration(q, e):
+    elements = {"q":q, "e":e, "incl":0.0, "Omega":0.0, "w":0.0, "Tp":TP}
+    dts = np.array([-300.0, -30.0, -0.01, 0.01, 30.0, 300.0])
+    local = _perifocal(elements, TP + dts)
+    reference = _reference(q, e, dts)
+    error = np.linalg.norm(local - reference, axis=0)
+    assert np.all(error < 1e-9*np.linalg.norm(reference, axis=0))
+
+
+def test_heliocentric_position_at_perihelion():
+    elements = {"q":0.9, "e":0.7, "incl":30.0, "Omega":80.0, "w":120.0,
+                "Tp":TP}
+    position = _perifocal(elements, TP)[:, 0]
+    assert np.linalg.norm(position) == pytest.approx(0.9, rel=1e-12)
+    # the ascending node is Omega, the perihelion w further along the orbit
+    Om, i, w = np.radians([80.0, 30.0, 120.0])
+    expected = 0.9*np.array([np.cos(Om)*np.cos(w)
+                             - np.sin(Om)*np.sin(w)*np.cos(i),
+                             np.sin(Om)*np.cos(w)
+                             + np.cos(Om)*np.sin(w)*np.cos(i),
+                             np.sin(w)*np.sin(i)])
+    assert position == pytest.approx(expected, abs=1e-12)
+
+
+@pytest.mark.parametrize("e", [0.0, 0.5, 0.95, 1 - 1e-6, 1 + 1e-6, 1.5, 5.0])
+def test_solve_kepler_residuals(e):
+    M = np.concatenate([np.linspace(-50, 50, 1001), [-1e-9, 1e-9]])
+    E = orbits._solve_kepler(M, e)
+    if e < 1:
+        wrapped = np.where(np.abs(M) > np.pi,
+                           np.remainder(M + np.pi, 2*np.pi) - np.pi, M)
+        residual = E - e*np.sin(E) - wrapped
+    else:
+        residual = e*np.sinh(E) - E - M
+    assert np.all(np.abs(residual) < 1e-12*np.maximum(np.abs(M), 1))
+
+
+def _osculating_elements(body, time):
+    """
+    The heliocentric osculating elements of a planet from the astropy
+    ephemeris, in the form fetch_elements returns.
+    """
+    position, velocity = get_body_barycentric_posvel(body, time)
+    sun_position, sun_velocity = get_body_barycentric_posvel("sun", time)
+    r = (position.xyz - sun_position.xyz).to_value(u.au)
+    v = (velocity.xyz - sun_velocity.xyz).to_value(u.au/u.day)
+    eps = np.radians(orbits.OBLIQUITY)
+    to_ecliptic = np.array([[1, 0, 0],
+                            [0, np.cos(eps), np.sin(eps)],
+                            [0, -np.sin(eps), np.cos(eps)]])
+    r, v = to_ecliptic @ r, to_ecliptic @ v
+    h = np.cross(r, v)
+    node = np.cross([0, 0, 1], h)
+    e_vector = np.cross(v, h)/MU - r/np.linalg.norm(r)
+    e = np.linalg.norm(e_vector)
+    a = 1/(2/np.linalg.norm(r) - v @ v/MU)
+    h_unit = h/np.linalg.norm(h)
+    nu = np.arctan2(np.cross(e_vector, r) @ h_unit, e_vector @ r)
+    E = 2*np.arctan(np.sqrt((1 - e)/(1 + e))*np.tan(nu/2))
+    M = E - e*np.sin(E)
+    return {"q":a*(1 - e), "e":e,
+            "incl":np.degrees(np.arccos(h_unit[2])),
+            "Omega":np.degrees(np.arctan2(node[1], node[0])) % 360,
+            "w":np.degrees(np.arctan2(np.cross(node, e_vector) @ h_unit,
+                                      node @ e_vector)) % 360,
+            "Tp":time.tdb.jd - M*a**1.5/orbits.K_GAUSS,
+            "epoch":time.tdb.jd}
+
+
+def test_propagate_matches_the_ephemeris_of_mars():
+    # over a day the pull of the other planets moves Mars by far less than
+    # an arcsecond, so the two-body positions must match the ephemeris
+    epoch = Time("2023-08-07 00:00:00")
+    elements = _osculating_elements("mars", epoch)
+    times = epoch + np.linspace(-1, 1, 5)*u.day
+    local = orbits.propagate(elements, times)
+
+    rho = []
+    for time in times:
+        light_time = 0*u.s
+        for i in range(0, 4):
+            this_rho = (get_body_barycentric("mars", time - light_time).xyz
+                        - get_body_barycentric("earth", time).xyz)
+            light_time = (np.linalg.norm(this_rho)/c).to(u.s)
+        rho.append(this_rho.to_value(u.au))
+    rho = np.array(rho).T
+    reference = SkyCoord(
+        ra=np.degrees(np.arctan2(rho[1], rho[0]))*u.deg,
+        dec=np.degrees(np.arcsin(rho[2]/np.linalg.norm(rho, axis=0)))*u.deg)
+    assert np.all(local.separation(reference).arcsec < 0.5)
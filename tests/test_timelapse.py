@@ -0,0 +1,16 @@
+import pytest
+
+import timelapse
+
+
+def test_all_sky_timelapse_rejects_unknown_keywords(tmp_path):
+    with pytest.raises(TypeError, match="mag_limt"):
+        timelapse.all_sky_timelapse(None, None, [], path=str(tmp_path),
+                                    mag_limt=6.0)
+
+
+def test_timelapses_need_a_path():
+    with pytest.raises(ValueError):
+        timelapse.local_sky_timelapse(None, None, [], path=None)
+    with pytest.raises(ValueError):
+        timelapse.all_sky_timelapse(None, None, [], path=None)
@@ -0,0 +1,482 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import AltAz
+import cartopy.crs as ccrs
+from astroplan import FixedTarget
+
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.image as mpl_image
+from matplotlib.collections import LineCollection
+from matplotlib.offsetbox import (OffsetImage, AnnotationBbox)
+
+import dino_tools as tools
+import catalogs
+import local_sky
+import all_sky_map
+
+# the all_sky_map.render_background settings the all-sky timelapse accepts
+BACKGROUND_KEYS = ["do_stars", "do_asterisms", "do_constellations",
+                   "sky_culture", "mag_limit", "star_marker", "ax_color",
+                   "fig_color", "do_xticks", "do_yticks", "epoch",
+                   "lod_mag", "lod_bins", "cache_dir"]
+
+def frame_times(times, n_frames=200, window="plot_window"):
+    """
+    Returns n_frames evenly spaced times from the start to the end of one of
+    the windows in the times dictionary from dino_tools.setup_times.
+    """
+    window_times = Time(times[window])
+    if window_times.isscalar:
+        return window_times.reshape((1,))
+    return Time(np.linspace(window_times[0].jd, window_times[-1].jd,
+                            n_frames), format='jd')
+
+def _target_info(targets):
+    """
+    Returns the names, colors, types and (for fixed targets) coordinates of
+    the targets as plain lists, so they can be sent to the worker processes.
+    """
+    info = {"names":[], "colors":[], "fixed":[], "ra":[], "dec":[]}
+    for target in targets:
+        info['names'].append(target['name'])
+        info['colors'].append(target['color'])
+        info['fixed'].append(target['type'] == "fixed")
+        if target['type'] == "fixed":
+            info['ra'].append(target['target'].coord.icrs.ra.deg)
+            info['dec'].append(target['target'].coord.icrs.dec.deg)
+        else:
+            info['ra'].append(np.nan)
+            info['dec'].append(np.nan)
+    return info
+
+# ---------------------------------------------------------------------------
+# local sky
+# ---------------------------------------------------------------------------
+
+def _local_sky_data(observer, times, targets, do_moon=True, do_stars=True,
+                    do_asterisms=True, mag_limit=4.0, sky_culture="rey"):
+    """
+    Computes everything that moves in the local-sky timelapse, for all frames
+    at once. Arrays in 'frames' have the frames along their last axis and are
+    split between the workers, 'static' is sent to all of them.
+    """
+    static = _target_info(targets)
+    static['do_stars'] = do_stars
+    frames = {"labels":np.array(times.strftime("%Y-%m-%d %H:%M"))}
+    # the tracks of the targets and the moon are kept whole, every chunk
+    # draws them up to its frames
+    alt, az = tools.altaz_grid(observer, targets, times)
+    if do_moon:
+        moon = tools.body_position("moon", times, observer.location).transform_to(
+            AltAz(obstime=times, location=observer.location))
+        alt = np.vstack([alt, moon.alt.deg])
+        az = np.vstack([az, moon.az.deg])
+    static['do_moon'] = do_moon
+    static['alt'] = alt
+    static['az'] = az
+    if do_stars or do_asterisms:
+        stars = local_sky.star_altaz(observer, times, mag_limit=mag_limit,
+                                     do_asterisms=do_asterisms,
+                                     sky_culture=sky_culture)
+        static['star_mag'] = stars.pop('mag')
+        static['star_color'] = stars.pop('color')
+        for key in stars:
+            frames['star_' + key] = stars[key]
+    return static, frames
+
+def _polar_to_axes(az, alt):
+    """
+    Converts azimuth and altitude in degrees to axes coordinates of the
+    local-sky polar axes (north up, zenith in the middle). The stars are
+    given in axes coordinates so matplotlib does not have to run the polar
+    transformation on every one of them in every frame.
+    """
+    r = 0.5*(90.0 - np.asarray(alt))/90.0
+    theta = np.radians(az) + np.pi/2
+    return np.column_stack([0.5 + r*np.cos(theta), 0.5 + r*np.sin(theta)])
+
+def _setup_local_sky(static, frames, first=0, do_grid=True,
+                     az_label_offset=0.0, trails=True, dpi=100, pyplot=False):
+    """
+    Builds the local-sky figure once. Everything that moves is created as an
+    animated artist, so it is left out of the static background. first is the
+    number of the first frame of the chunk.
+
+    The figure is made with dino_tools.new_figure, see there for pyplot.
+
+    Returns the figure, a function that updates the moving artists to a
+    frame and returns them, and None as there is no separate background.
+    """
+    fig = tools.new_figure(pyplot=pyplot, figsize=(7, 8), dpi=dpi)
+    ax = fig.add_subplot(projection='polar')
+    fig.subplots_adjust(bottom=0.2, top=0.88)
+    ax.set_theta_zero_location('N')
+
+    stars = None
+    if 'star_mag' in static:
+        size, rgba = local_sky._star_style({"mag":static['star_mag'],
+                                            "color":static['star_color']})
+        if static['do_stars']:
+            n_stars = len(size)
+            stars = ax.scatter(np.full(n_stars, np.nan),
+                               np.full(n_stars, np.nan), s=size, c=rgba,
+                               lw=0, zorder=1, animated=True,
+                               transform=ax.transAxes)
+    asterisms = None
+    if 'star_alt1' in frames:
+        asterisms = LineCollection([], colors='#77a9da', linewidths=0.75,
+                                   alpha=0.6, zorder=1, animated=True,
+                                   transform=ax.transAxes)
+        ax.add_collection(asterisms)
+
+    markers = []
+    tracks = []
+    for i in range(0, len(static['names'])):
+        color = static['colors'][i]
+        markers.append(ax.plot([], [], marker='o', color=color,
+                               linestyle='none', label=static['names'][i],
+                               animated=True)[0])
+        tracks.append(ax.plot([], [], color=color, alpha=0.5,
+                              animated=True)[0])
+    if static['do_moon']:
+        markers.append(ax.plot([], [], marker='o', color="xkcd:grey",
+                               linestyle='none', label="Moon",
+                               animated=True)[0])
+        tracks.append(ax.plot([], [], color="xkcd:grey", alpha=0.5,
+                              animated=True)[0])
+    label = fig.text(0.5, 0.95, "", ha='center', fontsize=14, animated=True)
+
+    ax.set_rlim(90, 0)
+    local_sky._setup_axes(ax, do_grid=do_grid,
+                          az_label_offset=az_label_offset*u.deg)
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1), fancybox=True,
+              ncol=3, framealpha=0, fontsize=12)
+
+    def update(j):
+        artists = []
+        if stars is not None:
+            alt = frames['star_alt'][:, j]
+            offsets = _polar_to_axes(frames['star_az'][:, j], alt)
+            offsets[alt <= 0] = np.nan
+            stars.set_offsets(offsets)
+            artists.append(stars)
+        if asterisms is not None:
+            up = (frames['star_alt1'][:, j] > 0) & \
+                 (frames['star_alt2'][:, j] > 0)
+            asterisms.set_segments(np.stack([
+                _polar_to_axes(frames['star_az1'][up, j],
+                               frames['star_alt1'][up, j]),
+                _polar_to_axes(frames['star_az2'][up, j],
+                               frames['star_alt2'][up, j])], axis=1))
+            artists.append(asterisms)
+        # the tracks are read from static on every frame, so live.py can
+        # swap them for the current time
+        k = first + j
+        alt = static['alt'][:, :k+1]
+        az = np.radians(static['az'][:, :k+1])
+        for i in range(0, len(markers)):
+            if trails:
+                # below the horizon is left out of the tracks
+                tracks[i].set_data(az[i], np.where(alt[i] > 0, alt[i], np.nan))
+                artists.append(tracks[i])
+            if alt[i, k] > 0:
+                markers[i].set_data([az[i, k]], [alt[i, k]])
+            else:
+                markers[i].set_data([], [])
+            artists.append(markers[i])
+        label.set_text(frames['labels'][j] + " UTC")
+        artists.append(label)
+        return artists
+
+    return fig, update, None
+
+# ---------------------------------------------------------------------------
+# all-sky map
+# ---------------------------------------------------------------------------
+
+def _all_sky_data(observer, times, targets, do_moon=True):
+    """
+    Computes everything that moves in the all-sky timelapse, for all frames
+    at once: the horizon, the moon and the non-fixed targets. Arrays in
+    'frames' have the frames along their last axis.
+    """
+    static = _target_info(targets)
+    frames = {"labels":np.array(times.strftime("%Y-%m-%d %H:%M"))}
+
+    # the horizon at every frame in one transformation
+    az = np.linspace(0, 360, 361)
+    horizon = SkyCoord(AltAz(alt=np.zeros((1, len(az)))*u.deg,
+                             az=az[np.newaxis, :]*u.deg,
+                             obstime=times[:, np.newaxis],
+                             location=observer.location)).icrs
+    frames['horizon_ra'] = horizon.ra.deg.T
+    frames['horizon_dec'] = horizon.dec.deg.T
+
+    if do_moon:
+        moon = tools.body_position("moon", times, observer.location)
+        frames['moon_ra'] = moon.ra.deg
+        frames['moon_dec'] = moon.dec.deg
+
+    ras = np.full((len(targets), len(times)), np.nan)
+    decs = np.full((len(targets), len(times)), np.nan)
+    for i in range(0, len(targets)):
+        if targets[i]['type'] != "fixed":
+            coords = tools.get_target_coords(targets[i], times,
+                                             observer.location)
+            ras[i] = coords.ra.deg
+            decs[i] = coords.dec.deg
+    frames['target_ra'] = ras
+    frames['target_dec'] = decs
+    return static, frames
+
+def _setup_all_sky(static, frames, background, projection=ccrs.Mollweide(),
+                   target_marker="*", do_target_colors=True, dpi=40,
+                   pyplot=False):
+    """
+    Builds the transparent all-sky overlay figure once, on top of the cached
+    sky background from all_sky_map.render_background. The fixed targets are
+    drawn once, the horizon, moon and non-fixed targets are animated. The
+    figure is made with dino_tools.new_figure, see there for pyplot.
+
+    Returns the figure, a function that updates the moving artists to a frame
+    and returns them, and the background resized to the figure.
+    """
+    fig = tools.new_figure(pyplot=pyplot, figsize=(30, 15), dpi=dpi,
+                           facecolor=(0, 0, 0, 0))
+    ax = fig.add_subplot(projection=projection)
+    ax.set_facecolor((0, 0, 0, 0))
+    ax.set_global()
+
+    moving = []
+    for i in range(0, len(static['names'])):
+        if do_target_colors:
+            color = static['colors'][i]
+        else:
+            color = "xkcd:white"
+        if static['fixed'][i]:
+            target = FixedTarget(SkyCoord(ra=static['ra'][i]*u.deg,
+                                          dec=static['dec'][i]*u.deg),
+                                 name=static['names'][i])
+            all_sky_map._plot_fixed_target(ax, target, color, target_marker)
+        else:
+            marker = ax.plot([], [], transform=ccrs.Geodetic(), marker="d",
+                             markersize=7, linestyle='none', color=color,
+                             animated=True)[0]
+            text = ax.text(0, 0, static['names'][i],
+                           transform=ccrs.Geodetic(), color=color, size=20,
+                           animated=True)
+            moving.append((i, marker, text))
+
+    horizon = ax.plot([], [], transform=ccrs.Geodetic(), lw=1, alpha=1,
+                      color="xkcd:green", animated=True)[0]
+
+    moon = None
+    if 'moon_ra' in frames:
+        imagebox = OffsetImage(mpl_image.imread("./report_images/moon.png"),
+                               zoom=0.15)
+        imagebox.image.axes = ax
+        moon = AnnotationBbox(imagebox, (0, 0), frameon=False,
+                              xycoords=ccrs.Geodetic()._as_mpl_transform(ax),
+                              animated=True)
+        ax.add_artist(moon)
+
+    label = ax.set_title("", fontsize=32, pad=20)
+    label.set_animated(True)
+    if background['settings']['fig_color'] == "xkcd:black":
+        label.set_color("xkcd:white")
+
+    ax.set_xlim(background['extent'][1], background['extent'][0])
+    ax.set_ylim(background['extent'][2:])
+
+    sky = Image.fromarray(background['image']).resize(
+        fig.canvas.get_width_height(), Image.LANCZOS)
+
+    def update(j):
+        artists = []
+        horizon.set_data(frames['horizon_ra'][:, j],
+                         frames['horizon_dec'][:, j])
+        artists.append(horizon)
+        if moon is not None:
+            # the image sits at xybox, which is only set to xy on creation
+            moon.xy = (frames['moon_ra'][j], frames['moon_dec'][j])
+            moon.xybox = moon.xy
+            artists.append(moon)
+        for i, marker, text in moving:
+            ra = frames['target_ra'][i, j]
+            dec = frames['target_dec'][i, j]
+            marker.set_data([ra], [dec])
+            text.set_position((ra - 3, dec))
+            artists += [marker, text]
+        label.set_text("All-Sky Map {0} (UTC)".format(frames['labels'][j]))
+        artists.append(label)
+        return artists
+
+    return fig, update, sky
+
+# ---------------------------------------------------------------------------
+# rendering
+# ---------------------------------------------------------------------------
+
+def _render_chunk(kind, static, frames, settings, first, frame_dir):
+    """
+    Renders a contiguous chunk of frames in one process. The figure is built
+    once and its static part drawn once, then every frame only restores that
+    and redraws the moving artists (blitting).
+
+    Returns the paths of the frames.
+    """
+    if kind == "local_sky":
+        fig, update, sky = _setup_local_sky(static, frames, first=first,
+                                            **settings)
+    else:
+        background = all_sky_map.render_background(
+            projection=settings.get('projection', ccrs.Mollweide()),
+            **settings.pop('background'))
+        fig, update, sky = _setup_all_sky(static, frames, background,
+                                          **settings)
+    fig.canvas.draw()
+    static_image = fig.canvas.copy_from_bbox(fig.bbox)
+
+    paths = []
+    for j in range(0, len(frames['labels'])):
+        fig.canvas.restore_region(static_image)
+        for artist in update(j):
+            fig.draw_artist(artist)
+        image = Image.fromarray(np.asarray(fig.canvas.buffer_rgba()))
+        if sky is not None:
+            image = Image.alpha_composite(sky, image)
+        this_path = "{0}/frame_{1:04d}.png".format(frame_dir, first + j)
+        # quantize here, so the GIF writer does not do it for every frame
+        image.convert("RGB").quantize(
+            256, method=Image.Quantize.FASTOCTREE).save(this_path,
+                                                        compress_level=1)
+        paths.append(this_path)
+    return paths
+
+def _render(kind, static, frames, settings, path, name, fps=10,
+            n_workers=None):
+    """
+    Splits the frames into one contiguous chunk per worker, renders the
+    chunks in parallel processes and joins the frames into a GIF.
+    """
+    frame_dir = "{0}/{1}_frames".format(path, name)
+    if not os.path.exists(frame_dir):
+        os.makedirs(frame_dir)
+    n_frames = len(frames['labels'])
+    if n_workers is None:
+        n_workers = min(os.cpu_count() or 1, 8)
+    n_chunks = max(1, min(n_workers, n_frames))
+    bounds = np.linspace(0, n_frames, n_chunks + 1).astype(int)
+    chunks = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        chunk = {key:value[..., first:last] for key, value in frames.items()}
+        chunks.append((kind, static, chunk, dict(settings), int(first),
+                       frame_dir))
+
+    if n_chunks == 1:
+        paths = [_render_chunk(*chunks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=n_chunks) as pool:
+            paths = list(pool.map(_render_chunk, *zip(*chunks)))
+    paths = [p for chunk_paths in paths for p in chunk_paths]
+
+    images = [Image.open(p) for p in paths]
+    gif_path = "{0}/{1}.gif".format(path, name)
+    images[0].save(gif_path, save_all=True, append_images=images[1:],
+                   duration=int(1000/fps), loop=0)
+    return gif_path
+
+def local_sky_timelapse(observer, times, targets, n_frames=200, fps=10,
+                        do_moon=True, do_stars=True, do_asterisms=True,
+                        mag_limit=4.0, sky_culture="rey", do_grid=True,
+                        az_label_offset=0.0, trails=True, dpi=100,
+                        path="./report_plots", n_workers=None):
+    """
+    Makes a GIF of the targets, the moon and the stars moving across the
+    local sky over the night.
+
+    Parameters
+    -----------
+
+    n_frames : int
+        The number of frames, evenly spaced over the plot window.
+        Defaults to 200.
+
+    fps : float
+        Frames per second of the GIF.
+        Defaults to 10.
+
+    trails : bool
+        Draw the track of each target up to the current frame.
+        Defaults to True.
+
+    n_workers : int or None
+        The number of processes the frames are rendered in. If None, one per
+        CPU, up to 8.
+
+    The other parameters are the same as for local_sky.plot. The frames are
+    kept in path/local_sky_frames. Unlike the plots, the timelapses need a
+    path, as the worker processes hand their frames over as files.
+
+    Returns the path of the GIF.
+    """
+    if path is None:
+        raise ValueError("the timelapses need a path to write the frames to")
+    if type(targets) != list:
+        targets = [targets]
+    static, frames = _local_sky_data(observer, frame_times(times, n_frames),
+                                     targets, do_moon=do_moon,
+                                     do_stars=do_stars,
+                                     do_asterisms=do_asterisms,
+                                     mag_limit=mag_limit,
+                                     sky_culture=sky_culture)
+    settings = {"do_grid":do_grid, "az_label_offset":float(az_label_offset),
+                "trails":trails, "dpi":dpi}
+    return _render("local_sky", static, frames, settings, path,
+                   "local_sky", fps=fps, n_workers=n_workers)
+
+def all_sky_timelapse(observer, times, targets, n_frames=200, fps=10,
+                      do_moon=True, projection=ccrs.Mollweide(),
+                      target_marker="*", do_target_colors=True, dpi=40,
+                      path="./report_plots", n_workers=None,
+                      **background_kwargs):
+    """
+    Makes a GIF of the horizon, the moon and the non-fixed targets moving
+    across the all-sky map over the night.
+
+    The stars, asterisms and constellations come from the cached background
+    of all_sky_map.render_background, which takes the background_kwargs (see
+    BACKGROUND_KEYS, other keywords raise TypeError). n_frames, fps and
+    n_workers are the same as for local_sky_timelapse. The frames are kept in
+    path/all_sky_map_frames, so path cannot be None.
+
+    Returns the path of the GIF.
+    """
+    if path is None:
+        raise ValueError("the timelapses need a path to write the frames to")
+    if type(targets) != list:
+        targets = [targets]
+    unknown = [key for key in background_kwargs if key not in BACKGROUND_KEYS]
+    if len(unknown) > 0:
+        raise TypeError("all_sky_timelapse() got unexpected keyword "
+                        "arguments: {0}".format(", ".join(unknown)))
+    # the stars are moved to the year of the night unless told otherwise
+    background_kwargs.setdefault('epoch', catalogs.epoch_year(
+        frame_times(times, 1)))
+    # render the background once here, so the workers only read the cache
+    all_sky_map.render_background(projection=projection, **background_kwargs)
+    static, frames = _all_sky_data(observer, frame_times(times, n_frames),
+                                   targets, do_moon=do_moon)
+    settings = {"background":background_kwargs, "projection":projection,
+                "target_marker":target_marker,
+                "do_target_colors":do_target_colors, "dpi":dpi}
+    return _render("all_sky", static, frames, settings, path, "all_sky_map",
+                   fps=fps, n_workers=n_workers)